@@ -1,30 +1,243 @@
-from flask import jsonify, request
+from flask import jsonify, request, make_response, Response, g, current_app
 import yaml
 import os
+import copy
+import json
+import time
+import base64
+import hashlib
 import logging
-from config_manager import load_deployment_configs
-from cloud_config_generator import generate_cloud_config
-from openstack_manager import deploy_to_openstack, get_instance_status, list_instances
+from config_manager import load_deployment_configs, load_baked_images, resolve_image_capabilities
+from cloud_config_generator import (render_cloud_config, render_cache, check_config_shape, user_data_options,
+                                    encode_user_data, user_data_size)
+from openstack_manager import (deploy_to_openstack, deploy_fleet, get_instance_status, list_instances, bake_image,
+                               service_capabilities, dry_run_deploy, resolve_clouds, list_instances_multi,
+                               get_instance_status_multi)
+from openstack_backend import cloud_names, load_cloud_profiles
+from resource_catalog import (PreflightError, RESOURCE_KINDS, catalog_for, cloud_catalog_stats, preflight,
+                              resource_catalog)
+import deployment_history
+from deployment_history import record_deployment
+from batch_render import batch_renderer, check_output_filename, OUTPUT_DIR
+from readiness import readiness_store, InvalidTokenError, READINESS_WAIT_MAX, READY
+from idempotency import (idempotency_store, IdempotencyConflictError, EXECUTED, IDEMPOTENCY_TTL,
+                         IDEMPOTENCY_INSTANCE_TTL)
+from job_manager import job_manager, JobQueueFullError, TERMINAL_STATES, FAILED
+from instance_poller import instance_poller, get_snapshot
+from instance_query import InstanceQuery, stream_json
+from metrics import registry, start_breakdown, finish_breakdown
 
 logger = logging.getLogger(__name__)
 
+HTTP_SECONDS = registry.histogram('deployer_http_request_duration_seconds', 'API请求耗时',
+                                  ('method', 'endpoint', 'status'))
+
 
 def validate_openstack_config(config):
-    """验证OpenStack配置"""
+    """验证OpenStack配置，并按资源目录检查镜像、规格、网络等是否存在（PreflightError），返回检查结果"""
     required_fields = ['instance_name', 'image', 'flavor', 'network', 'key_name']
     for field in required_fields:
         if field not in config:
             raise ValueError(f'缺少必需的OpenStack配置字段: {field}')
-    return True
+    if not isinstance(config.get('security_groups', []), list):
+        raise ValueError('security_groups 必须是列表')
+    if config.get('cloud') is not None and config['cloud'] not in cloud_names():
+        raise ValueError(f"未知的云: {config['cloud']}，可选: {', '.join(cloud_names())}")
+    return preflight(config)
+
+
+def request_clouds():
+    """?cloud= 参数：返回 (单个云名或None, 多云列表或None)；?timeout= 为每个云的超时秒数"""
+    value = request.args.get('cloud')
+    clouds = resolve_clouds(value)
+    if clouds is None and value and value not in cloud_names():
+        raise ValueError(f"未知的云: {value}，可选: {', '.join(cloud_names())}")
+    return (None if clouds else value or None), clouds
+
+
+def request_timeout():
+    try:
+        return float(request.args['timeout']) if 'timeout' in request.args else None
+    except ValueError:
+        raise ValueError('timeout 必须是数字')
 
 
 def handle_api_error(error, status_code=500):
     """统一的API错误处理"""
     logger.error(f'API错误: {str(error)}')
-    return jsonify({'error': str(error)}), status_code
+    body = {'error': str(error)}
+    if isinstance(error, PreflightError):
+        body['preflight_errors'] = error.errors
+    return jsonify(body), status_code
+
+
+def wants_dry_run(request_data):
+    """?dry_run=true 或请求体 dry_run 为true时只做校验和渲染，不创建实例"""
+    return (request.args.get('dry_run', 'false').lower() == 'true'
+            or request_data.get('dry_run') is True)
+
+
+def dry_run_response(config, preflight_report, count=None):
+    result = dry_run_deploy(config, count)
+    result['preflight'] = preflight_report
+    return jsonify(result), 200
+
+
+def wants_async():
+    """请求是否要求异步执行（?async=true 或 Prefer: respond-async）"""
+    return (request.args.get('async', 'false').lower() == 'true'
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+
+def select_services(request_data):
+    """根据 enable_* 参数从部署配置中选出要启用的服务"""
+    deployment_configs = load_deployment_configs()
+    
+    enabled_services = {}
+    for service_name, service_config in deployment_configs.get('deployments', {}).items():
+        enable_key = f'enable_{service_name}'
+        if request_data.get(enable_key, False):
+            # 请求中的配置不能与部署配置快照共享嵌套的列表
+            enabled_services[service_name] = copy.deepcopy(service_config)
+            logger.info(f'启用服务: {service_name}')
+    return enabled_services
+
+
+def build_final_config(request_data):
+    """由 enable_* 参数组装部署配置，保留 user_data_options"""
+    final_config = {
+        'openstack': request_data['openstack'],
+        'deployments': select_services(request_data)
+    }
+    if 'user_data_options' in request_data:
+        final_config['user_data_options'] = request_data['user_data_options']
+        user_data_options(final_config)
+    return final_config
+
+
+def wants_fresh():
+    """?fresh=true 时绕过实例快照直接查询OpenStack"""
+    return request.args.get('fresh', 'false').lower() == 'true'
+
+
+RESOURCE_LABELS = {'instance': '实例', 'image': '镜像'}
+
+
+def coalesce(kind, description, config, func, cacheable, resource='instance'):
+    """按 Idempotency-Key（未提供时按云和实例名）合并重复请求，返回 (结果, executed/coalesced/replayed)
+
+    同一键的并发请求只执行一次；成功的结果在TTL内直接返回给迟到的重复请求。
+    同一键正在以不同的请求内容执行时返回409，已有内容不同的成功结果时返回422。
+    """
+    body = json.dumps({'kind': kind, 'description': description, 'async': wants_async(), 'config': config},
+                      sort_keys=True, ensure_ascii=False, default=str)
+    fingerprint = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    key = request.headers.get('Idempotency-Key')
+    if key is not None:
+        if not 0 < len(key) <= 255:
+            raise ValueError('Idempotency-Key 长度必须在1到255之间')
+        key, ttl = f'Idempotency-Key {key}', IDEMPOTENCY_TTL
+    else:
+        # 没有幂等键时按云和实例名合并，同名实例不会被内容不同的请求重复创建
+        cloud = (config.get('openstack') or {}).get('cloud')
+        scope = f'{cloud}/' if cloud else ''
+        key, ttl = f'{RESOURCE_LABELS[resource]} {scope}{description}', IDEMPOTENCY_INSTANCE_TTL
+    result, outcome = idempotency_store.run(key, fingerprint, func, ttl, cacheable)
+    if outcome != EXECUTED:
+        logger.info(f'重复请求已合并（{outcome}）: {key}')
+    return result, outcome, key
+
+
+def mark_replayed(response, outcome):
+    response.headers['Idempotent-Replayed'] = 'false' if outcome == EXECUTED else 'true'
+    return response
+
+
+def run_deploy(config, instance_name, kind, deploy=deploy_to_openstack, resource='instance'):
+    """同步执行部署，或提交为异步任务并返回202；重复请求复用同一次执行"""
+    def execute():
+        result = deploy(config)
+        if result['success']:
+            # 让实例快照尽快包含新实例
+            instance_poller.poke()
+        return result
+
+    if wants_async():
+        def submit():
+            return {'job_id': job_manager.submit(kind, instance_name, execute).id}
+
+        submitted, outcome, key = coalesce(kind, instance_name, config, submit, lambda result: True, resource)
+        job = job_manager.get(submitted['job_id'])
+        if job is None or (outcome != EXECUTED and job.state == FAILED):
+            # 之前的任务已失败或已被淘汰，重新提交
+            idempotency_store.forget(key)
+            submitted, outcome, key = coalesce(kind, instance_name, config, submit, lambda result: True, resource)
+            job = job_manager.get(submitted['job_id'])
+        response = jsonify({
+            'success': True,
+            'message': f'部署任务已提交: {instance_name}',
+            'job_id': job.id,
+            'status_url': f'/api/jobs/{job.id}',
+            'job': job.to_dict()
+        })
+        response.status_code = 202
+        response.headers['Location'] = f'/api/jobs/{job.id}'
+        return mark_replayed(response, outcome)
+
+    result, outcome, _ = coalesce(kind, instance_name, config, execute, lambda result: result['success'], resource)
+    
+    if result['success']:
+        logger.info(f'部署成功: {instance_name}')
+        return mark_replayed(jsonify(result), outcome), 200
+    else:
+        return mark_replayed(jsonify(result), outcome), 500
+
+
+def wants_timing_breakdown():
+    """请求头 X-Timing-Breakdown: true 时在响应中附带各阶段耗时"""
+    return request.headers.get('X-Timing-Breakdown', 'false').lower() in ('true', '1')
+
+
+def attach_timing_breakdown(response, breakdown, elapsed):
+    """写入 Server-Timing 响应头，JSON响应体中追加 timings 字段"""
+    total_ms = round(elapsed * 1000, 3)
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{stage};dur={entry['ms']}" for stage, entry in breakdown.items()] + [f'total;dur={total_ms}'])
+    if response.is_json and not response.is_streamed:
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            data['timings'] = {'total_ms': total_ms, 'stages': breakdown}
+            response.set_data(current_app.json.dumps(data))
 
 
 def register_routes(app):
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if wants_timing_breakdown():
+            start_breakdown()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint, status=response.status_code)
+        breakdown = finish_breakdown()
+        if breakdown is not None:
+            attach_timing_breakdown(response, breakdown, elapsed)
+        return response
+
+    @app.teardown_request
+    def clear_timing_breakdown(error=None):
+        finish_breakdown()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
     
     @app.route('/api/generate-config', methods=['POST'])
     def generate_config():
@@ -33,33 +246,91 @@ def register_routes(app):
             if not json_data:
                 return handle_api_error('未提供JSON数据', 400)
             
-            logger.info(f'生成配置请求: {json_data.keys()}')
+            if not isinstance(json_data, dict):
+                return handle_api_error('请求体必须是JSON对象', 400)
             
-            yaml_content = generate_cloud_config(json_data)
+            logger.info(f'生成配置请求: {json_data.keys()}')
             
+            check_config_shape(json_data)
             save_file = request.args.get('save', 'false').lower() == 'true'
             filename = request.args.get('filename', 'config.yaml')
+            if save_file:
+                filename = check_output_filename(filename)
+            
+            options = user_data_options(json_data)
+            encoding = options['encoding']
+            yaml_content, etag, optimization = render_cloud_config(json_data)
+            payload = encode_user_data(yaml_content, encoding)
+            if encoding != 'none':
+                # 响应中包含编码后的内容，不同编码需要不同的ETag
+                etag = f"{etag}-{encoding.replace('+', '-')}"
+            
+            # 保存文件有副作用，只在纯生成请求上返回304
+            if not save_file and request.if_none_match.contains(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
             
             result = {
                 'success': True,
                 'message': '配置内容已生成',
-                'content': yaml_content
+                'content': yaml_content,
+                'user_data_size': user_data_size(yaml_content, payload, options['files'], encoding),
+                'optimization': optimization
             }
+            if encoding != 'none':
+                data = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+                result['encoded_content'] = base64.b64encode(data).decode('ascii')
             
             if save_file:
-                output_dir = 'outputs'
-                os.makedirs(output_dir, exist_ok=True)
+                os.makedirs(OUTPUT_DIR, exist_ok=True)
                 
-                file_path = os.path.join(output_dir, filename)
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(yaml_content)
+                file_path = os.path.join(OUTPUT_DIR, filename)
+                if isinstance(payload, bytes):
+                    with open(file_path, 'wb') as f:
+                        f.write(payload)
+                else:
+                    with open(file_path, 'w', encoding='utf-8') as f:
+                        f.write(payload)
                 
                 result['message'] = f'cloud-init配置已生成并保存到 {file_path}'
                 result['file_path'] = file_path
                 logger.info(f'配置文件已保存: {file_path}')
+                record_deployment('generate-config', json_data.get('openstack', {}), json_data.get('deployments', {}),
+                                  {'success': True, 'output': file_path}, yaml_content)
             
-            return jsonify(result)
+            response = jsonify(result)
+            response.set_etag(etag)
+            return response
             
+        except ValueError as e:
+            return handle_api_error(e, 400)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/generate-config/batch', methods=['POST'])
+    def generate_config_batch():
+        try:
+            json_data = request.get_json()
+            if not json_data:
+                return handle_api_error('未提供JSON数据', 400)
+
+            if not isinstance(json_data, dict):
+                return handle_api_error('请求体必须是JSON对象', 400)
+
+            save_file = request.args.get('save', 'false').lower() == 'true'
+            include_content = request.args.get('include_content', 'true').lower() == 'true'
+            items, snapshot = batch_renderer.prepare(json_data.get('items'), json_data.get('defaults', {}), save_file)
+            logger.info(f'批量生成配置请求: {len(items)} 项')
+
+            def lines():
+                for line in batch_renderer.run(items, snapshot, include_content):
+                    yield json.dumps(line, ensure_ascii=False) + '\n'
+
+            return Response(lines(), mimetype='application/x-ndjson')
+
+        except ValueError as e:
+            return handle_api_error(e, 400)
         except Exception as e:
             return handle_api_error(e)
 
@@ -68,17 +339,43 @@ def register_routes(app):
     def health_check():
         return jsonify({'status': 'healthy', 'message': 'Cloud-Init Config Generator API is running'})
 
+    @app.route('/api/cache/stats', methods=['GET'])
+    def cache_stats():
+        return jsonify({'render_cache': render_cache.stats(), 'caches': registry.cache_stats()})
+
     @app.route('/', methods=['GET'])
     def index():
         return jsonify({
             'name': 'Cloud-Init Config Generator API',
             'version': '1.0.0',
             'endpoints': {
-                'POST /api/generate-config': '接收JSON配置并生成config.yaml内容',
+                'POST /api/generate-config': '接收JSON配置并生成config.yaml内容（user_data_options 可选 write_files 输出、gzip/mime 编码、runcmd优化、package_upgrade 和按依赖并行安装，响应包含编码前后大小和优化去掉的命令数）',
+                'POST /api/generate-config/batch': '批量生成配置（items 为多个生成请求，defaults 为公共字段），在进程池中并行渲染，按完成顺序以NDJSON逐项返回，?save=true 时写入outputs目录',
                 'POST /api/deploy': '接收完整JSON配置并启动OpenStack实例',
-                'POST /api/deploy-services': '接收OpenStack配置并根据enable_*参数选择性部署服务（推荐）',
-                'GET /api/instances': '列出所有OpenStack实例',
-                'GET /api/instance/status/<name>': '获取指定实例的状态',
+                'POST /api/deploy-services': '接收OpenStack配置并根据enable_*参数选择性部署服务（推荐，?async=true 时返回202和任务ID）',
+                'POST /api/deploy-fleet': '按实例名模式和数量批量创建相同实例（user-data只渲染一次）',
+                'POST /api/deploy*?dry_run=true': '按资源目录校验镜像、规格、网络、密钥、安全组和可用区并渲染user-data，不创建实例',
+                'Idempotency-Key 请求头': '部署接口的幂等键：同一键的并发请求只执行一次，成功结果在TTL内直接返回（响应头 Idempotent-Replayed: true）；未提供时按实例名合并',
+                'GET /api/history': '查询本地部署历史（instance、image、service、services、user_data_hash、since、until、success、limit、before 过滤，按时间倒序）',
+                'GET /api/history/<id>': '查看一条部署记录（含CLI输出和各阶段耗时）',
+                'GET /api/history/user-data/<hash>': '按哈希取回部署时使用的user-data（相同内容只保存一份）',
+                'GET /api/history/summary': '部署历史汇总（次数、成功数、不同user-data数、平均/最长耗时，?instance= 过滤）',
+                'GET /api/clouds': '列出 clouds.yaml 中的云配置；部署请求的 openstack.cloud 选择云，/api/instances 和实例状态接口的 ?cloud=a,b 或 ?cloud=all 并发查询多个云（?timeout= 为每个云的超时）',
+                'GET /api/catalog': '查看资源目录的刷新状态，?kind= 时返回该类资源的名称，?cloud= 查看具名云的目录',
+                'GET /api/instances': '列出所有OpenStack实例（默认来自后台轮询快照，?fresh=true 直接查询；支持 status、name_prefix、fields、sort、limit、marker 参数）',
+                'GET /api/instance/status/<name>': '获取指定实例的状态（默认来自后台轮询快照，?fresh=true 直接查询）',
+                'POST /api/readiness/report': '实例在cloud-init中上报服务安装进度和就绪（Authorization: Bearer <部署时写入实例的令牌>）',
+                'GET /api/readiness/<instance_name>': '查询实例上报的各服务完成情况和耗时',
+                'GET /api/readiness/<instance_name>/wait-until-ready': '长轮询等待实例就绪（?timeout= 秒，?services= 只等待指定服务），由实例的上报驱动，不查询OpenStack',
+                'GET /api/instances/events': '以SSE推送实例状态变化（?name= 过滤，?since= 或 Last-Event-ID 续传）',
+                'GET /api/instances/poller': '查看实例状态轮询的状态与快照时效',
+                'POST /api/images/bake': '由已部署实例创建快照镜像并登记其能力（services/capabilities），之后用该镜像部署时省略已有的安装步骤（?async=true 时返回202）',
+                'GET /api/images/capabilities': '查看已登记的烘焙镜像，?image= 时返回该镜像已具备的能力',
+                'GET /api/cache/stats': '查看配置渲染缓存及其他缓存的命中/未命中/淘汰统计',
+                'GET /metrics': 'Prometheus格式的指标（各阶段耗时直方图、子进程调用次数、缓存命中率等）',
+                'GET /api/jobs': '查看异步部署线程池状态',
+                'GET /api/jobs/<id>': '查询异步部署任务状态（queued/running/succeeded/failed）及耗时',
+                'GET /api/jobs/<id>/stream': '以SSE推送异步部署任务的状态变化',
                 'GET /api/health': '健康检查'
             },
             'example_request_deploy_services': {
@@ -124,32 +421,73 @@ def register_routes(app):
             if 'openstack' not in request_data:
                 return handle_api_error('缺少OpenStack配置', 400)
             
-            validate_openstack_config(request_data['openstack'])
+            preflight_report = validate_openstack_config(request_data['openstack'])
             
             logger.info(f'部署服务请求: {request_data["openstack"]["instance_name"]}')
             
-            deployment_configs = load_deployment_configs()
+            final_config = build_final_config(request_data)
             
-            enabled_services = {}
-            for service_name, service_config in deployment_configs.get('deployments', {}).items():
-                enable_key = f'enable_{service_name}'
-                if request_data.get(enable_key, False):
-                    enabled_services[service_name] = service_config.copy()
-                    logger.info(f'启用服务: {service_name}')
+            if wants_dry_run(request_data):
+                return dry_run_response(final_config, preflight_report)
             
-            final_config = {
-                'openstack': request_data['openstack'],
-                'deployments': enabled_services
-            }
+            return run_deploy(final_config, request_data['openstack']['instance_name'], 'deploy-services')
+                
+        except JobQueueFullError as e:
+            return handle_api_error(e, 503)
+        except IdempotencyConflictError as e:
+            return handle_api_error(e, e.status_code)
+        except ValueError as e:
+            return handle_api_error(e, 400)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/deploy-fleet', methods=['POST'])
+    def deploy_fleet_route():
+        try:
+            request_data = request.get_json()
+            if not request_data:
+                return handle_api_error('未提供JSON数据', 400)
             
-            result = deploy_to_openstack(final_config)
+            if 'openstack' not in request_data:
+                return handle_api_error('缺少OpenStack配置', 400)
             
+            preflight_report = validate_openstack_config(request_data['openstack'])
+            
+            try:
+                count = int(request_data.get('count', 1))
+                concurrency = int(request_data['concurrency']) if 'concurrency' in request_data else None
+            except (TypeError, ValueError):
+                raise ValueError('count 和 concurrency 必须是整数')
+            multi_create = bool(request_data.get('multi_create', False))
+            pattern = request_data['openstack']['instance_name']
+            
+            logger.info(f'批量部署请求: {pattern} x {count}')
+            
+            final_config = build_final_config(request_data)
+            
+            if wants_dry_run(request_data):
+                return dry_run_response(final_config, preflight_report, count)
+            
+            if wants_async():
+                return run_deploy(final_config, f'{pattern} x {count}', 'deploy-fleet',
+                                  lambda config: deploy_fleet(config, count, concurrency, multi_create))
+            
+            result, outcome, _ = coalesce('deploy-fleet', f'{pattern} x {count}', final_config,
+                                          lambda: deploy_fleet(final_config, count, concurrency, multi_create),
+                                          lambda result: bool(result.get('succeeded')))
+            response = mark_replayed(jsonify(result), outcome)
             if result['success']:
-                logger.info(f'部署成功: {request_data["openstack"]["instance_name"]}')
-                return jsonify(result), 200
+                return response, 200
+            elif result.get('succeeded'):
+                # 部分成功
+                return response, 207
             else:
-                return jsonify(result), 500
+                return response, 500
                 
+        except JobQueueFullError as e:
+            return handle_api_error(e, 503)
+        except IdempotencyConflictError as e:
+            return handle_api_error(e, e.status_code)
         except ValueError as e:
             return handle_api_error(e, 400)
         except Exception as e:
@@ -165,18 +503,20 @@ def register_routes(app):
             if 'openstack' not in json_data:
                 return handle_api_error('缺少OpenStack配置', 400)
             
-            validate_openstack_config(json_data['openstack'])
+            preflight_report = validate_openstack_config(json_data['openstack'])
+            user_data_options(json_data)
             
             logger.info(f'部署实例请求: {json_data["openstack"]["instance_name"]}')
             
-            result = deploy_to_openstack(json_data)
+            if wants_dry_run(json_data):
+                return dry_run_response(json_data, preflight_report)
             
-            if result['success']:
-                logger.info(f'实例部署成功: {json_data["openstack"]["instance_name"]}')
-                return jsonify(result), 200
-            else:
-                return jsonify(result), 500
+            return run_deploy(json_data, json_data['openstack']['instance_name'], 'deploy')
                 
+        except JobQueueFullError as e:
+            return handle_api_error(e, 503)
+        except IdempotencyConflictError as e:
+            return handle_api_error(e, e.status_code)
         except ValueError as e:
             return handle_api_error(e, 400)
         except Exception as e:
@@ -186,13 +526,36 @@ def register_routes(app):
     def instance_status(instance_name):
         try:
             logger.info(f'查询实例状态: {instance_name}')
-            result = get_instance_status(instance_name)
+            cloud, clouds = request_clouds()
+            if clouds:
+                result = get_instance_status_multi(instance_name, clouds, request_timeout(), wants_fresh())
+                result['source'] = 'live' if wants_fresh() else 'snapshot'
+                return jsonify(result), 200 if result['success'] else 404
+            # 实例快照只覆盖默认云
+            snapshot = None if wants_fresh() or cloud else get_snapshot()
+            if snapshot is not None:
+                matches = snapshot.lookup(instance_name)
+                if len(matches) == 1:
+                    return jsonify({
+                        'success': True,
+                        'instance': matches[0],
+                        'source': 'snapshot',
+                        'age': snapshot.age
+                    })
+                if len(matches) > 1:
+                    return handle_api_error(f"More than one server exists with the name '{instance_name}'.", 409)
+                # 快照中没有时可能是刚创建的实例，回退到直接查询
+            
+            result = get_instance_status(instance_name, cloud)
             
             if result['success']:
+                result['source'] = 'live'
                 return jsonify(result)
             else:
                 return jsonify(result), 404
                 
+        except ValueError as e:
+            return handle_api_error(e, 400)
         except Exception as e:
             return handle_api_error(e)
 
@@ -200,12 +563,283 @@ def register_routes(app):
     def instances():
         try:
             logger.info('查询所有实例')
-            result = list_instances()
-            
-            if result['success']:
-                return jsonify(result)
+            query = InstanceQuery.from_args(request.args)
+            cloud, clouds = request_clouds()
+            if clouds:
+                result = list_instances_multi(query, clouds, request_timeout())
+                if not result['success']:
+                    return jsonify(result), 502
+                meta = {'source': 'live', 'clouds': result['clouds'], 'errors': result['errors'],
+                        'partial': result['partial']}
+                return Response(stream_json(result['instances'], query, meta), mimetype='application/json')
+            snapshot = None if wants_fresh() or cloud else get_snapshot()
+            if snapshot is not None:
+                rows, next_marker = query.apply(snapshot.instances)
+                meta = {'source': 'snapshot', 'age': snapshot.age}
             else:
-                return jsonify(result), 500
+                result = list_instances(query, cloud)
+                if not result['success']:
+                    return jsonify(result), 500
+                rows, next_marker = result['instances'], result.get('next_marker')
+                meta = {'source': 'live'}
+            
+            if query.limit:
+                meta['next_marker'] = next_marker
+            return Response(stream_json(rows, query, meta), mimetype='application/json')
                 
+        except ValueError as e:
+            return handle_api_error(e, 400)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/readiness/report', methods=['POST'])
+    def readiness_report():
+        try:
+            token = request.headers.get('Authorization', '')
+            if token.startswith('Bearer '):
+                token = token[len('Bearer '):]
+            record = readiness_store.report(request.get_json(silent=True) or {}, token)
+            return jsonify({'success': True, 'state': record['state']})
+        except InvalidTokenError as e:
+            return handle_api_error(e, 403)
+        except ValueError as e:
+            return handle_api_error(e, 400)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/readiness/<instance_name>', methods=['GET'])
+    def readiness_status(instance_name):
+        record = readiness_store.get(instance_name)
+        if record is None:
+            return handle_api_error(f'没有实例 {instance_name} 的就绪记录（部署时未启用 user_data_options.readiness）', 404)
+        return jsonify({'success': True, **record})
+
+    @app.route('/api/readiness/<instance_name>/wait-until-ready', methods=['GET'])
+    def wait_until_ready(instance_name):
+        # 实例上报就绪（或 ?services= 中的服务全部结束）时立即返回，超时返回202和当前进度
+        try:
+            timeout = request_timeout()
+            timeout = min(READINESS_WAIT_MAX, 30.0 if timeout is None else max(0.0, timeout))
+            services = [service for service in request.args.get('services', '').split(',') if service] or None
+            record, satisfied = readiness_store.wait(instance_name, timeout, services)
+            if record is None:
+                return handle_api_error(f'没有实例 {instance_name} 的就绪记录（部署时未启用 user_data_options.readiness）',
+                                        404)
+            body = {'success': True, 'ready': record['state'] == READY, 'timed_out': not satisfied, **record}
+            return jsonify(body), 200 if satisfied else 202
+        except ValueError as e:
+            return handle_api_error(e, 400)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/instances/events', methods=['GET'])
+    def instance_events():
+        if not instance_poller.running:
+            return handle_api_error('实例状态轮询未启用（INSTANCE_POLL_INTERVAL=0）', 503)
+        name = request.args.get('name')
+        since = request.headers.get('Last-Event-ID', request.args.get('since'))
+        try:
+            seq = int(since) if since is not None else instance_poller.last_seq
+        except ValueError:
+            return handle_api_error('since 必须是整数', 400)
+
+        def events():
+            # 以SSE推送实例的创建/状态变化/删除事件，断线重连时按 Last-Event-ID 续传
+            last = seq
+            while True:
+                batch = instance_poller.wait_for_events(last, timeout=15, name=name)
+                if not batch:
+                    yield ': keep-alive\n\n'
+                    continue
+                for event in batch:
+                    last = event['seq']
+                    yield f"id: {last}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @app.route('/api/instances/poller', methods=['GET'])
+    def instance_poller_stats():
+        return jsonify({'success': True, 'poller': instance_poller.stats()})
+
+    @app.route('/api/history', methods=['GET'])
+    def history_list():
+        history = deployment_history.history
+        if history is None:
+            return handle_api_error('部署历史未启用（HISTORY_DB 为空）', 404)
+        try:
+            args = request.args
+            success = args.get('success')
+            limit = int(args.get('limit', 100))
+            filters = {
+                'instance_name': args.get('instance'),
+                'image': args.get('image'),
+                'service': args.get('service'),
+                'services': args['services'].split(',') if 'services' in args else None,
+                'user_data_hash': args.get('user_data_hash'),
+                'since': float(args['since']) if 'since' in args else None,
+                'until': float(args['until']) if 'until' in args else None,
+                'success': None if success is None else success.lower() == 'true',
+                'limit': limit,
+                'before_id': int(args['before']) if 'before' in args else None
+            }
+        except ValueError:
+            return handle_api_error('limit、before 必须是整数，since、until 必须是Unix时间戳', 400)
+        try:
+            records = history.query(**filters)
+            result = {'success': True, 'count': len(records), 'deployments': records}
+            if len(records) == limit and records:
+                result['next'] = records[-1]['id']
+            return jsonify(result)
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/history/summary', methods=['GET'])
+    def history_summary():
+        history = deployment_history.history
+        if history is None:
+            return handle_api_error('部署历史未启用（HISTORY_DB 为空）', 404)
+        try:
+            return jsonify({'success': True, 'summary': history.summary(request.args.get('instance')),
+                            'writer': history.stats()})
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/history/<int:record_id>', methods=['GET'])
+    def history_record(record_id):
+        history = deployment_history.history
+        if history is None:
+            return handle_api_error('部署历史未启用（HISTORY_DB 为空）', 404)
+        record = history.get(record_id)
+        if record is None:
+            return handle_api_error(f'部署记录不存在: {record_id}', 404)
+        return jsonify({'success': True, 'deployment': record})
+
+    @app.route('/api/history/user-data/<digest>', methods=['GET'])
+    def history_user_data(digest):
+        history = deployment_history.history
+        if history is None:
+            return handle_api_error('部署历史未启用（HISTORY_DB 为空）', 404)
+        content = history.get_user_data(digest)
+        if content is None:
+            return handle_api_error(f'user-data不存在: {digest}', 404)
+        response = make_response(content)
+        response.headers['Content-Type'] = 'text/cloud-config; charset=utf-8'
+        response.set_etag(digest)
+        return response
+
+    @app.route('/api/clouds', methods=['GET'])
+    def clouds():
+        try:
+            profiles = load_cloud_profiles()
+        except Exception as e:
+            return handle_api_error(f'读取云配置失败: {str(e)}')
+        # 不返回认证信息
+        return jsonify({'success': True, 'clouds': [{
+            'name': name,
+            'region_name': profile.get('region_name'),
+            'auth_url': (profile.get('auth') or {}).get('auth_url'),
+            'project_name': (profile.get('auth') or {}).get('project_name'),
+            'backend': profile.get('backend')
+        } for name, profile in profiles.items()]})
+
+    @app.route('/api/catalog', methods=['GET'])
+    def catalog():
+        kind = request.args.get('kind')
+        cloud = request.args.get('cloud')
+        if cloud is not None and cloud not in cloud_names():
+            return handle_api_error(f'未知的云: {cloud}', 404)
+        selected = catalog_for(cloud)
+        if kind is None:
+            if cloud is None:
+                return jsonify({'success': True, 'catalog': resource_catalog.stats(), 'clouds': cloud_catalog_stats()})
+            return jsonify({'success': True, 'catalog': selected.stats()})
+        if kind not in RESOURCE_KINDS:
+            return handle_api_error(f'不支持的资源类型: {kind}，可选: {", ".join(RESOURCE_KINDS)}', 400)
+        names = selected.names(kind)
+        if names is None:
+            return handle_api_error(f'资源目录中还没有 {kind}', 404)
+        return jsonify({'success': True, 'kind': kind, 'names': names})
+
+    @app.route('/api/images/bake', methods=['POST'])
+    def bake_image_route():
+        try:
+            request_data = request.get_json()
+            if not request_data:
+                return handle_api_error('未提供JSON数据', 400)
+
+            for field in ('instance_name', 'image_name'):
+                if not request_data.get(field):
+                    raise ValueError(f"缺少必需字段: {field}")
+            services = request_data.get('services', [])
+            capabilities = request_data.get('capabilities', [])
+            if not isinstance(services, list) or not isinstance(capabilities, list):
+                raise ValueError("services 和 capabilities 必须是列表")
+            source_image = request_data.get('source_image')
+            if source_image is not None and not isinstance(source_image, str):
+                raise ValueError("source_image 必须是字符串")
+            if not service_capabilities(services, source_image or request_data['image_name']) and not capabilities:
+                raise ValueError("未指定烘焙镜像的服务或能力")
+
+            logger.info(f'烘焙镜像请求: {request_data["instance_name"]} -> {request_data["image_name"]}')
+
+            config = {
+                'instance_name': request_data['instance_name'],
+                'image_name': request_data['image_name'],
+                'services': services,
+                'capabilities': capabilities,
+                'source_image': source_image
+            }
+            return run_deploy(config, request_data['image_name'], 'bake-image',
+                              deploy=lambda config: bake_image(**config), resource='image')
+
+        except JobQueueFullError as e:
+            return handle_api_error(e, 503)
+        except IdempotencyConflictError as e:
+            return handle_api_error(e, e.status_code)
+        except ValueError as e:
+            return handle_api_error(e, 400)
         except Exception as e:
-            return handle_api_error(e)
\ No newline at end of file
+            return handle_api_error(e)
+
+    @app.route('/api/images/capabilities', methods=['GET'])
+    def image_capabilities():
+        try:
+            image = request.args.get('image')
+            if image:
+                return jsonify({'success': True, 'image': image,
+                                'capabilities': sorted(resolve_image_capabilities(image))})
+            return jsonify({'success': True, 'images': load_baked_images()})
+        except Exception as e:
+            return handle_api_error(e)
+
+    @app.route('/api/jobs', methods=['GET'])
+    def jobs():
+        return jsonify({'success': True, 'pool': job_manager.stats()})
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            return handle_api_error(f'任务不存在: {job_id}', 404)
+        return jsonify({'success': True, 'job': job.to_dict()})
+
+    @app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+    def job_stream(job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            return handle_api_error(f'任务不存在: {job_id}', 404)
+
+        def events():
+            # 以SSE推送每次状态变化，任务结束后关闭连接
+            revision = -1
+            while True:
+                if job.revision > revision:
+                    revision = job.revision
+                    data = job.to_dict()
+                    yield f"event: {data['state']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                    if data['state'] in TERMINAL_STATES:
+                        return
+                elif not job_manager.wait_for_change(job, revision, timeout=15):
+                    yield ': keep-alive\n\n'
+
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
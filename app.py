@@ -1,17 +1,67 @@
 import os
+import argparse
 import logging
 from flask import Flask
 from api_routes import register_routes
+from instance_poller import start_instance_poller
+from resource_catalog import start_resource_catalog
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-app = Flask(__name__)
 
-register_routes(app)
+def start_background_work():
+    """启动实例状态轮询、资源目录刷新等后台线程（重复调用无副作用）"""
+    start_instance_poller()
+    start_resource_catalog()
+
+
+def create_app(start_background: bool = True) -> Flask:
+    """创建Flask应用；start_background 为True时启动后台线程"""
+    app = Flask(__name__)
+    register_routes(app)
+    if start_background:
+        start_background_work()
+    return app
+
+
+# 供 `flask run` 等直接加载模块的方式使用：导入时不启动线程，第一次请求时再启动
+app = create_app(start_background=False)
+app.before_request(start_background_work)
+
+
+def main():
+    from server import (serve, SERVE_HOST, SERVE_PORT, SERVE_WORKERS, SERVE_THREADS,
+                        SERVE_GRACEFUL_TIMEOUT, CONFIG_WATCH_INTERVAL)
+
+    parser = argparse.ArgumentParser(description='Cloud-Init Config Generator API')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='多进程生产模式（默认）')
+    serve_parser.add_argument('--host', default=SERVE_HOST)
+    serve_parser.add_argument('--port', type=int, default=SERVE_PORT)
+    serve_parser.add_argument('--workers', type=int, default=SERVE_WORKERS, help='worker进程数')
+    serve_parser.add_argument('--threads', type=int, default=SERVE_THREADS, help='每个worker的请求线程数')
+    serve_parser.add_argument('--graceful-timeout', type=float, default=SERVE_GRACEFUL_TIMEOUT,
+                              help='重载或停止时等待处理中请求的最长时间（秒）')
+    serve_parser.add_argument('--config-watch-interval', type=float, default=CONFIG_WATCH_INTERVAL,
+                              help='检查部署配置变化的间隔（秒），0表示只在收到SIGHUP时重载')
+    dev_parser = subparsers.add_parser('dev', help='Flask开发服务器（单进程，支持debug）')
+    dev_parser.add_argument('--host', default='0.0.0.0')
+    dev_parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == 'dev' or (args.command is None and os.getenv('FLASK_ENV') == 'development'):
+        debug_mode = os.getenv('FLASK_ENV') == 'development'
+        start_background_work()
+        app.run(host=getattr(args, 'host', '0.0.0.0'), port=getattr(args, 'port', 5000), debug=debug_mode)
+        return
+    if args.command is None:
+        args = serve_parser.parse_args([])
+    serve(create_app, args.host, args.port, args.workers, args.threads,
+          args.graceful_timeout, args.config_watch_interval)
+
 
 if __name__ == '__main__':
-    debug_mode = os.getenv('FLASK_ENV') == 'development'
-    app.run(host='0.0.0.0', port=5000, debug=debug_mode)
\ No newline at end of file
+    main()
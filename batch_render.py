@@ -0,0 +1,340 @@
+import os
+import time
+import base64
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from config_manager import ConfigSnapshot, config_store, get_config_snapshot, get_config_version
+from cloud_config_generator import (render_cache, render_cache_key, render_uncached, resolve_render_image,
+                                    check_config_shape, user_data_options, encode_user_data, user_data_size)
+from deployment_history import record_deployment
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = 'outputs'
+# 服务进程是多线程的，直接fork可能让子进程继承其他线程持有的锁；
+# forkserver 由单线程的服务进程fork出渲染进程，预先导入渲染模块
+START_METHOD = 'forkserver'
+# 批量请求中只属于批量接口、不参与渲染的字段
+ITEM_FIELDS = ('id', 'filename')
+
+
+def _init_worker(snapshot: ConfigSnapshot):
+    # 子进程固定使用父进程的配置快照，批量中途修改配置文件也不会出现多个版本
+    config_store.pin(snapshot)
+
+
+def _process_item(config_data: Dict[str, Any], image, rendered, options: Dict[str, Any], file_path: Optional[str],
+                  include_content: bool) -> Tuple[Dict[str, Any], Optional[Tuple[str, str, Dict[str, Any]]]]:
+    """渲染（或复用父进程缓存的结果）、编码并按需写入文件，返回 (结果, 新渲染的缓存条目)"""
+    started = time.perf_counter()
+    entry = None
+    if rendered is None:
+        rendered = entry = render_uncached(config_data, image)
+    yaml_content, etag, report = rendered
+    encoding = options['encoding']
+    payload = encode_user_data(yaml_content, encoding)
+    result = {
+        'etag': etag if encoding == 'none' else f"{etag}-{encoding.replace('+', '-')}",
+        'user_data_size': user_data_size(yaml_content, payload, options['files'], encoding),
+        'optimization': report
+    }
+    if include_content:
+        result['content'] = yaml_content
+        if encoding != 'none':
+            data = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+            result['encoded_content'] = base64.b64encode(data).decode('ascii')
+    if file_path:
+        data = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+        temp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+        result['file_path'] = file_path
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    return result, entry
+
+
+class BatchItem:
+    """批量请求中的一项，在父进程中完成校验、缓存查询和镜像解析"""
+
+    __slots__ = ('index', 'id', 'config', 'options', 'key', 'rendered', 'image', 'file_path', 'error')
+
+    def __init__(self, index: int, spec: Any, defaults: Dict[str, Any]):
+        self.index = index
+        self.id = None
+        self.config: Dict[str, Any] = {}
+        self.options: Dict[str, Any] = {}
+        self.key: Optional[str] = None
+        self.rendered = None
+        self.image = None
+        self.file_path: Optional[str] = None
+        self.error: Optional[str] = None
+        if not isinstance(spec, dict):
+            self.error = '每一项必须是对象'
+            return
+        spec = {**defaults, **spec}
+        self.id = spec.get('id')
+        self.config = {name: value for name, value in spec.items() if name not in ITEM_FIELDS}
+        try:
+            check_config_shape(self.config)
+            self.options = user_data_options(self.config)
+            self.key = render_cache_key(self.config)
+        except ValueError as e:
+            self.error = str(e)
+            return
+        self.rendered = render_cache.get(self.key)
+        if self.rendered is None:
+            self.image = resolve_render_image(self.config)
+
+    def line(self, **fields) -> Dict[str, Any]:
+        return {'index': self.index, 'id': self.id, **fields}
+
+
+def check_output_filename(filename: Any) -> str:
+    """校验保存到输出目录的文件名，只允许文件名本身（不含路径、不以.开头）"""
+    filename = str(filename)
+    if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+        raise ValueError(f'无效的文件名: {filename}')
+    return filename
+
+
+def _output_filename(item: BatchItem, spec: Any) -> str:
+    filename = spec.get('filename') if isinstance(spec, dict) else None
+    if filename is None:
+        filename = f'{item.id}.yaml' if item.id is not None else f'config-{item.index}.yaml'
+    return check_output_filename(filename)
+
+
+class BatchRenderer:
+    """在进程池中并行渲染批量配置请求，按完成顺序逐项返回结果
+
+    进程池以forkserver方式创建，子进程固定使用创建时传入的配置快照；配置版本变化时重建进程池。
+    父进程渲染缓存中已有的项不再渲染，新渲染的结果回填到父进程缓存。
+    """
+
+    def __init__(self, workers: int, max_items: int):
+        self.workers = workers
+        self.max_items = max_items
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.counts = {'rendered': 0, 'cached': 0, 'failed': 0, 'batches': 0}
+
+    def _after_fork(self):
+        # 子进程不能使用父进程的进程池
+        self._pool = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def parallel(self) -> bool:
+        return self.workers > 1 and START_METHOD in multiprocessing.get_all_start_methods()
+
+    def _executor(self, snapshot: ConfigSnapshot) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is not None and self._version == snapshot.version:
+                return self._pool
+            if self._pool is not None:
+                # 已提交的任务会继续在旧进程池中完成
+                self._pool.shutdown(wait=False)
+                logger.info(f"部署配置已变化，重建批量渲染进程池: {self._version} -> {snapshot.version}")
+            context = multiprocessing.get_context(START_METHOD)
+            context.set_forkserver_preload([__name__])
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=context,
+                                             initializer=_init_worker, initargs=(snapshot,))
+            self._version = snapshot.version
+            return self._pool
+
+    def _reset(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+                self._version = None
+
+    def prepare(self, specs: List[Any], defaults: Dict[str, Any],
+                save: bool) -> Tuple[List[BatchItem], Optional[ConfigSnapshot]]:
+        """校验批量请求并准备每一项，返回 (各项, 准备时的配置快照)
+
+        请求本身无效时抛出ValueError，单项的问题记录在该项中。
+        """
+        if not isinstance(specs, list) or not specs:
+            raise ValueError('items 必须是非空数组')
+        if len(specs) > self.max_items:
+            raise ValueError(f'单次最多生成 {self.max_items} 个配置')
+        if not isinstance(defaults, dict):
+            raise ValueError('defaults 必须是对象')
+        try:
+            snapshot = get_config_snapshot()
+        except (OSError, ValueError):
+            snapshot = None
+        items = [BatchItem(index, spec, defaults) for index, spec in enumerate(specs)]
+        if save:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            used = set()
+            for item, spec in zip(items, specs):
+                if item.error:
+                    continue
+                try:
+                    filename = _output_filename(item, spec)
+                except ValueError as e:
+                    item.error = str(e)
+                    continue
+                if filename in used:
+                    item.error = f'文件名重复: {filename}'
+                    continue
+                used.add(filename)
+                item.file_path = os.path.join(OUTPUT_DIR, filename)
+        return items, snapshot
+
+    def run(self, items: List[BatchItem], snapshot: Optional[ConfigSnapshot],
+            include_content: bool = True) -> Iterator[Dict[str, Any]]:
+        """逐项产出结果（按完成顺序），最后产出一条汇总"""
+        started = time.perf_counter()
+        # 准备期间配置发生变化时，缓存键与子进程使用的配置版本可能不一致，不回填缓存
+        fill_cache = snapshot is not None and get_config_version() == snapshot.version
+        counts = {'succeeded': 0, 'failed': 0, 'rendered': 0, 'cached': 0}
+        pending = [item for item in items if item.error is None]
+        use_pool = self.parallel and snapshot is not None and len({item.key for item in pending if item.rendered is None}) > 1
+
+        for item in items:
+            if item.error is not None:
+                counts['failed'] += 1
+                yield item.line(success=False, error=item.error)
+
+        if use_pool:
+            outcomes = self._run_pool(snapshot, pending, include_content)
+        else:
+            outcomes = self._run_inline(pending, include_content)
+        for item, outcome, error in outcomes:
+            if error is not None:
+                counts['failed'] += 1
+                yield item.line(success=False, error=error)
+                continue
+            result, entry = outcome
+            if entry is not None:
+                counts['rendered'] += 1
+                if fill_cache:
+                    render_cache.put(item.key, entry)
+            else:
+                counts['cached'] += 1
+            if item.file_path:
+                yaml_content = (entry or item.rendered)[0]
+                record_deployment('generate-config', item.config.get('openstack', {}),
+                                  item.config.get('deployments', {}), {'success': True, 'output': item.file_path},
+                                  yaml_content)
+            counts['succeeded'] += 1
+            yield item.line(success=True, **result)
+
+        with self._lock:
+            self.counts['batches'] += 1
+            for name in ('rendered', 'cached', 'failed'):
+                self.counts[name] += counts[name]
+        logger.info(f"批量生成配置完成: {counts}")
+        yield {
+            'summary': True,
+            'total': len(items),
+            **counts,
+            'workers': self.workers if use_pool else 1,
+            'config_version': snapshot.version if snapshot else None,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 3)
+        }
+
+    @staticmethod
+    def _split(items: List[BatchItem]) -> Tuple[List[BatchItem], Dict[str, List[BatchItem]]]:
+        """渲染输入相同的项只渲染一次：返回需要先处理的项，以及等待同键首项结果的其余项"""
+        first: List[BatchItem] = []
+        waiting: Dict[str, List[BatchItem]] = {}
+        for item in items:
+            if item.rendered is None and item.key in waiting:
+                waiting[item.key].append(item)
+                continue
+            if item.rendered is None:
+                waiting[item.key] = []
+            first.append(item)
+        return first, waiting
+
+    def _run_inline(self, items: List[BatchItem], include_content: bool):
+        queue, waiting = self._split(items)
+        queue.reverse()
+        while queue:
+            item = queue.pop()
+            try:
+                outcome = _process_item(item.config, item.image, item.rendered, item.options, item.file_path,
+                                        include_content)
+            except Exception as e:
+                error = str(e)
+                yield item, None, error
+                for follower in waiting.pop(item.key, []) if item.rendered is None else ():
+                    yield follower, None, error
+                continue
+            if outcome[1] is not None:
+                for follower in reversed(waiting.pop(item.key, [])):
+                    follower.rendered = outcome[1]
+                    queue.append(follower)
+            yield item, outcome, None
+
+    def _run_pool(self, snapshot: ConfigSnapshot, items: List[BatchItem], include_content: bool):
+        pool = self._executor(snapshot)
+        first, waiting = self._split(items)
+        futures: Dict[Any, BatchItem] = {}
+        failed: List[Tuple[BatchItem, str]] = []
+
+        def submit(item: BatchItem):
+            try:
+                futures[pool.submit(_process_item, item.config, item.image, item.rendered, item.options,
+                                    item.file_path, include_content)] = item
+            except BrokenProcessPool as e:
+                self._reset(pool)
+                failed.append((item, f'批量渲染进程池不可用: {str(e)}'))
+
+        try:
+            for item in first:
+                submit(item)
+            while futures or failed:
+                while failed:
+                    item, error = failed.pop()
+                    yield item, None, error
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = futures.pop(future)
+                    try:
+                        outcome = future.result()
+                    except BrokenProcessPool as e:
+                        self._reset(pool)
+                        error = f'渲染进程异常退出: {str(e)}'
+                    except Exception as e:
+                        error = str(e)
+                    else:
+                        if outcome[1] is not None:
+                            for follower in waiting.pop(item.key, []):
+                                follower.rendered = outcome[1]
+                                submit(follower)
+                        yield item, outcome, None
+                        continue
+                    yield item, None, error
+                    for follower in waiting.pop(item.key, []) if item.rendered is None else ():
+                        yield follower, None, error
+        finally:
+            # 客户端断开时取消尚未开始的项
+            for future in futures:
+                future.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'hits': self.counts['cached'], 'misses': self.counts['rendered'], 'workers': self.workers,
+                    'parallel': self.parallel, 'pool_version': self._version, **self.counts}
+
+
+BATCH_WORKERS = int(os.getenv('BATCH_RENDER_WORKERS', '0')) or os.cpu_count() or 1
+batch_renderer = BatchRenderer(BATCH_WORKERS, int(os.getenv('BATCH_MAX_ITEMS', '1000')))
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=batch_renderer._after_fork)
+registry.register_cache('batch_render', batch_renderer.stats)
@@ -0,0 +1,258 @@
+"""配置生成热路径的离线微基准
+
+用法:
+    python benchmarks/bench_config_generation.py                    # 运行并输出结果
+    python benchmarks/bench_config_generation.py --save-baseline    # 保存为基线
+    python benchmarks/bench_config_generation.py --compare          # 与基线比较，回归时退出码为1
+    python benchmarks/bench_config_generation.py --filter render --synthetic-services 500
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import yaml
+import config_manager
+import cloud_config_generator
+from config_manager import ConfigStore, load_deployment_configs, get_docker_config_for_image
+from cloud_config_generator import generate_cloud_config, generate_lobechat_files, render_cache
+from image_resolver import ImageResolver
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+CONFIG_PATH = os.path.join(ROOT, 'deployment-configs.json')
+
+
+@contextmanager
+def use_config(path: str):
+    """临时让全局配置存储指向指定文件"""
+    original = config_manager.config_store
+    config_manager.config_store = ConfigStore(path)
+    try:
+        yield config_manager.config_store
+    finally:
+        config_manager.config_store = original
+
+
+@contextmanager
+def render_cache_disabled():
+    maxsize = render_cache.maxsize
+    render_cache.maxsize = 0
+    render_cache.clear()
+    try:
+        yield
+    finally:
+        render_cache.maxsize = maxsize
+
+
+def build_synthetic_config(base: Dict[str, Any], services: int, images: int, seed: int = 42) -> Dict[str, Any]:
+    """在真实配置基础上扩展出大量服务和镜像映射"""
+    rng = random.Random(seed)
+    config = json.loads(json.dumps(base))
+    os_types = list(config['docker_install_configs'])
+    for i in range(services):
+        config['deployments'][f'svc{i:04d}'] = {
+            'version': 'latest',
+            'packages': [f'pkg-{rng.randrange(services * 2)}' for _ in range(rng.randint(1, 6))],
+            'commands': [f'systemctl enable svc{i:04d}-{j} && systemctl start svc{i:04d}-{j}'
+                         for j in range(rng.randint(1, 8))]
+        }
+    for i in range(images):
+        os_type = os_types[i % len(os_types)]
+        config['image_mapping'][f'{os_type}-custom-{i // len(os_types)}.{rng.randrange(10)}'] = os_type
+    return config
+
+
+def service_configs(config: Dict[str, Any], names: List[str]) -> Dict[str, Any]:
+    # 与 /api/deploy-services 相同：使用默认配置的浅拷贝
+    return {name: dict(config['deployments'][name]) for name in names}
+
+
+def measure(func: Callable[[], Any], min_time: float, min_iterations: int, alloc_iterations: int) -> Dict[str, Any]:
+    func()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_iterations or time.perf_counter() < deadline:
+        start = time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns() - start)
+    samples.sort()
+
+    # 内存分配单独测量，避免tracemalloc影响耗时
+    tracemalloc.start()
+    peaks = []
+    for _ in range(alloc_iterations):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    total = sum(samples)
+    return {
+        'iterations': len(samples),
+        'ops_per_sec': round(len(samples) / (total / 1e9), 1),
+        'p50_us': round(samples[len(samples) // 2] / 1e3, 2),
+        'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] / 1e3, 2),
+        'peak_alloc_kib': round(sorted(peaks)[len(peaks) // 2] / 1024, 2)
+    }
+
+
+def cycle(items: List[Any]) -> Callable[[], Any]:
+    state = {'index': 0}
+
+    def next_item():
+        item = items[state['index'] % len(items)]
+        state['index'] += 1
+        return item
+    return next_item
+
+
+def verify_renderer(config: Dict[str, Any], images: List[str]):
+    """预编译片段的输出必须与 yaml.dump 对同一结构的输出逐字节一致"""
+    names = list(config['deployments'])
+    with render_cache_disabled():
+        for count in range(len(names) + 1):
+            for image in images:
+                content = generate_cloud_config({'openstack': {'image': image},
+                                                 'deployments': service_configs(config, names[:count])})
+                header, body = content[:len('#cloud-config\n\n')], content[len('#cloud-config\n\n'):]
+                expected = yaml.dump(yaml.safe_load(body), default_flow_style=False, allow_unicode=True, indent=2)
+                if header != '#cloud-config\n\n' or body != expected:
+                    raise AssertionError(f'渲染结果与yaml.dump不一致: services={names[:count]} image={image}')
+
+
+def define_benchmarks(config: Dict[str, Any], prefix: str, full: bool) -> Dict[str, Callable[[], Any]]:
+    names = list(config['deployments'])
+    images = list(config['image_mapping'])
+    next_image = cycle(images)
+    benchmarks = {}
+
+    benchmarks[f'{prefix}load_deployment_configs'] = load_deployment_configs
+    store = config_manager.config_store
+    benchmarks[f'{prefix}config_parse_cold'] = store._load
+    benchmarks[f'{prefix}get_docker_config_for_image'] = lambda: get_docker_config_for_image(next_image())
+    os_types = config['docker_install_configs'].keys()
+    benchmarks[f'{prefix}image_resolver_build'] = lambda: ImageResolver(config['image_mapping'], os_types)
+
+    if 'lobechat' in config['deployments']:
+        lobechat = dict(config['deployments']['lobechat'])
+        benchmarks[f'{prefix}generate_lobechat_files'] = lambda: generate_lobechat_files(lobechat)
+
+    counts = range(1, len(names) + 1) if full else sorted({1, len(names)})
+    for count in counts:
+        deployments = service_configs(config, names[:count])
+        benchmarks[f'{prefix}render_miss[{count} services]'] = (
+            lambda deployments=deployments: cloud_config_generator._render_cloud_config(
+                {'openstack': {'image': next_image()}, 'deployments': deployments})
+        )
+    all_services = service_configs(config, names)
+    benchmarks[f'{prefix}render_hit[{len(names)} services]'] = (
+        lambda: generate_cloud_config({'openstack': {'image': next_image()}, 'deployments': all_services})
+    )
+    return benchmarks
+
+
+def run_suite(args) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    base = json.load(open(CONFIG_PATH, encoding='utf-8'))
+
+    def run(benchmarks, cache_enabled):
+        for name, func in benchmarks.items():
+            if args.filter and args.filter not in name:
+                continue
+            if cache_enabled or 'render_hit' in name:
+                result = measure(func, args.min_time, args.min_iterations, args.alloc_iterations)
+            else:
+                with render_cache_disabled():
+                    result = measure(func, args.min_time, args.min_iterations, args.alloc_iterations)
+            results[name] = result
+            print(f"{name:<52} {result['ops_per_sec']:>12,.1f} ops/s  p50 {result['p50_us']:>10.2f}us  "
+                  f"p99 {result['p99_us']:>10.2f}us  alloc {result['peak_alloc_kib']:>9.2f}KiB")
+
+    with use_config(CONFIG_PATH):
+        if not args.no_verify:
+            verify_renderer(base, list(base['image_mapping']) + ['unknown-image'])
+        run(define_benchmarks(base, '', full=True), cache_enabled=False)
+
+    synthetic = build_synthetic_config(base, args.synthetic_services, args.synthetic_images)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'deployment-configs.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(synthetic, f, ensure_ascii=False)
+        with use_config(path):
+            run(define_benchmarks(synthetic, 'synthetic.', full=False), cache_enabled=False)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """p50 比基线慢 threshold 倍以上的基准视为回归"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        ratio = result['p50_us'] / previous['p50_us'] if previous['p50_us'] else 1.0
+        marker = 'REGRESSION' if ratio > threshold else 'ok'
+        print(f"{name:<52} p50 {previous['p50_us']:>10.2f}us -> {result['p50_us']:>10.2f}us  x{ratio:.2f}  {marker}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='配置生成热路径微基准')
+    parser.add_argument('--filter', help='只运行名称包含该字符串的基准')
+    parser.add_argument('--min-time', type=float, default=0.3, help='每个基准的最短运行时间（秒）')
+    parser.add_argument('--min-iterations', type=int, default=50)
+    parser.add_argument('--alloc-iterations', type=int, default=20)
+    parser.add_argument('--synthetic-services', type=int, default=200)
+    parser.add_argument('--synthetic-images', type=int, default=300)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基线文件路径')
+    parser.add_argument('--save-baseline', action='store_true', help='将本次结果保存为基线')
+    parser.add_argument('--compare', action='store_true', help='与基线比较')
+    parser.add_argument('--threshold', type=float, default=1.25, help='判定回归的p50倍数')
+    parser.add_argument('--json', help='将结果写入JSON文件')
+    parser.add_argument('--no-verify', action='store_true', help='跳过渲染结果一致性校验')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = run_suite(args)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'基线已保存: {args.baseline}')
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f'基线不存在: {args.baseline}')
+            sys.exit(2)
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'发现 {len(regressions)} 个性能回归')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import re
+import logging
+from typing import Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+BOOT_SCRIPT_PATH = '/var/lib/cloud-deployer/boot.sh'
+BOOT_LOG_DIR = '/var/log/cloud-deployer'
+REPORT_SCRIPT_PATH = '/var/lib/cloud-deployer/report.sh'
+# 每个实例（或批量部署）各自的回调地址和令牌，在部署时追加到user-data中
+CALLBACK_ENV_PATH = '/var/lib/cloud-deployer/callback.env'
+# report.sh 的第一个参数为 - 时表示整个启动过程
+READY_SERVICE = '-'
+
+# 包管理器不能并发运行，步骤中的调用通过文件锁串行执行
+_LOCKED_COMMANDS = ('apt-get', 'apt', 'yum', 'dnf')
+
+_SCRIPT_HEADER = f'''#!/bin/bash
+# 按服务依赖关系并行执行安装步骤，每个步骤的输出在 {BOOT_LOG_DIR}/<步骤>.log，耗时在 {BOOT_LOG_DIR}/timings.log
+LOG_DIR={BOOT_LOG_DIR}
+STATE_DIR=$(mktemp -d)
+PKG_LOCK=/run/cloud-deployer-pkg.lock
+mkdir -p "$LOG_DIR"
+: > "$LOG_DIR/timings.log"
+
+''' + ''.join(f'{command}() {{ flock "$PKG_LOCK" {command} "$@"; }}\n' for command in _LOCKED_COMMANDS) + '''
+now() { date +%s.%N; }
+
+# run_step <步骤> [依赖...]：等待依赖步骤结束后在子shell中执行，与runcmd一样单条命令失败不中断
+run_step() {
+    local name=$1 queued start status dep
+    shift
+    queued=$(now)
+    for dep in "$@"; do
+        while [ ! -e "$STATE_DIR/$dep" ]; do sleep 0.2; done
+    done
+    start=$(now)
+    echo "[$name] 开始"
+    ( "step_$name" ) > "$LOG_DIR/$name.log" 2>&1
+    status=$?
+    awk -v name="$name" -v queued="$queued" -v start="$start" -v end="$(now)" -v status="$status" \\
+        'BEGIN { printf "%s status=%d waited=%.2fs seconds=%.2fs\\n", name, status, start - queued, end - start }' \\
+        | tee -a "$LOG_DIR/timings.log"
+    touch "$STATE_DIR/$name"
+}
+'''
+
+_SCRIPT_FOOTER = '''wait
+awk -v start="$BOOT_START" -v end="$(now)" 'BEGIN { printf "total seconds=%.2fs\\n", end - start }' \\
+    | tee -a "$LOG_DIR/timings.log"
+rm -rf "$STATE_DIR"
+'''
+
+
+# 上报失败不影响安装；未写入回调配置（例如只生成配置文件）时不上报
+REPORT_SCRIPT = f'''#!/bin/bash
+# 向部署服务报告安装进度: report.sh <服务> started|done|<退出码> [开始时间 结束时间]，全部完成后 report.sh - ready
+[ -r {CALLBACK_ENV_PATH} ] || exit 0
+. {CALLBACK_ENV_PATH}
+''' + '''service=$1 status=$2 start=$3 end=$4
+mark="/run/cloud-deployer-$service.start"
+if [ "$status" = started ]; then
+    date +%s.%N > "$mark"
+elif [ "$status" = ready ]; then
+    # 整个启动过程的耗时从系统启动算起
+    start=0 end=$(cut -d' ' -f1 /proc/uptime)
+elif [ -z "$start" ] && [ -r "$mark" ]; then
+    start=$(cat "$mark") end=$(date +%s.%N)
+fi
+seconds=null
+if [ -n "$start" ] && [ -n "$end" ]; then
+    seconds=$(awk -v start="$start" -v end="$end" 'BEGIN { printf "%.2f", end - start }')
+fi
+# 批量部署的实例共用回调配置，实例名从元数据中获取
+instance=${DEPLOYER_INSTANCE:-$(cloud-init query ds.meta_data.name 2>/dev/null || hostname -s)}
+curl -fsS -m 5 --retry 3 --retry-delay 2 -o /dev/null -X POST \\
+    -H "Authorization: Bearer $DEPLOYER_TOKEN" -H 'Content-Type: application/json' \\
+    -d "{\\"instance\\": \\"$instance\\", \\"scope\\": \\"$DEPLOYER_SCOPE\\", \\"service\\": \\"$service\\", \\"status\\": \\"$status\\", \\"seconds\\": $seconds}" \\
+    "$DEPLOYER_CALLBACK_URL" || true
+'''
+
+# 启用就绪回调时，每个步骤开始和结束时在后台上报，不阻塞依赖它的步骤
+_REPORTING_SCRIPT_HEADER = _SCRIPT_HEADER.replace(
+    '    echo "[$name] 开始"\n',
+    '    echo "[$name] 开始"\n    report "$name" started &\n'
+).replace(
+    '    touch "$STATE_DIR/$name"\n',
+    '    report "$name" "$status" "$start" "$(now)" &\n    touch "$STATE_DIR/$name"\n'
+) + f'report() {{ {REPORT_SCRIPT_PATH} "$@"; }}\n'
+
+
+def step_name(name: str) -> str:
+    """步骤名同时用作shell函数名和状态文件名，只保留字母数字和下划线"""
+    return re.sub(r'\W', '_', name, flags=re.ASCII)
+
+
+def resolve_services(services: List[str], dependencies: Dict[str, List[str]]) -> List[str]:
+    """补全依赖的服务并按依赖关系排序（拓扑序，无依赖关系的服务保持原有顺序），存在环或未知依赖时抛出ValueError"""
+    ordered = []
+    state: Dict[str, str] = {}
+
+    def visit(service: str, path: List[str]):
+        if state.get(service) == 'done':
+            return
+        if state.get(service) == 'visiting':
+            raise ValueError(f"服务依赖存在环: {' -> '.join(path + [service])}")
+        if service not in dependencies:
+            raise ValueError(f"服务 {path[-1]} 依赖的 {service} 不存在")
+        state[service] = 'visiting'
+        for dependency in dependencies[service]:
+            visit(dependency, path + [service])
+        state[service] = 'done'
+        ordered.append(service)
+
+    for service in services:
+        visit(service, [])
+    return ordered
+
+
+def build_steps(services: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """由按拓扑序排列的服务（name、depends_on、commands、prefetch_commands）生成启动步骤
+
+    有 prefetch_commands 的服务拆出一个只依赖其依赖服务的预取步骤（如在docker就绪后立即拉取镜像），
+    服务本身的步骤再等待预取完成。
+    """
+    steps = []
+    for service in services:
+        name = step_name(service['name'])
+        depends_on = [step_name(dependency) for dependency in service['depends_on']]
+        if service.get('prefetch_commands'):
+            prefetch = f'{name}_prefetch'
+            steps.append({'name': prefetch, 'depends_on': depends_on, 'commands': list(service['prefetch_commands'])})
+            depends_on = depends_on + [prefetch]
+        steps.append({'name': name, 'depends_on': depends_on, 'commands': list(service['commands'])})
+    return steps
+
+
+def render_boot_script(steps: List[Dict[str, Any]], report: bool = False) -> str:
+    """生成并行启动脚本：各步骤在后台启动，只在依赖处等待；report 为True时通过 report.sh 上报每个步骤"""
+    parts = [_REPORTING_SCRIPT_HEADER if report else _SCRIPT_HEADER]
+    for step in steps:
+        # 函数体不缩进，heredoc 的结束标记才能被识别；只有注释的函数体不合法，补一条空命令
+        body = '\n'.join(step['commands'])
+        if not any(command.strip() and not command.strip().startswith('#') for command in step['commands']):
+            body = '\n'.join(step['commands'] + [':'])
+        parts.append(f"\nstep_{step['name']}() {{\n{body}\n}}\n")
+    parts.append('\nBOOT_START=$(now)\n')
+    for step in steps:
+        parts.append(' '.join(['run_step', step['name']] + step['depends_on']) + ' &\n')
+    parts.append(_SCRIPT_FOOTER)
+    return ''.join(parts)
@@ -1,32 +1,192 @@
+import re
 import yaml
+import gzip
+import base64
 import logging
 import json
-from typing import Dict, Any
-from config_manager import get_docker_config_for_image, load_deployment_configs
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, FrozenSet, List, Optional, Tuple, Union
+from config_manager import (load_deployment_configs, get_config_snapshot, get_config_version, resolve_image_os,
+                            resolve_image_capabilities, apply_capabilities)
+from metrics import registry, timed
+from boot_plan import (BOOT_SCRIPT_PATH, REPORT_SCRIPT_PATH, REPORT_SCRIPT, CALLBACK_ENV_PATH, READY_SERVICE,
+                       resolve_services, build_steps, render_boot_script, step_name)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_IMAGE = 'Ubuntu 22.04'
 
-def generate_lobechat_files(service_config: Dict[str, Any]) -> list:
-    """为LobeChat生成docker-compose文件和自动更新脚本"""
-    files_commands = []
-    
-    # 生成docker-compose.yml文件
+# 文件写入方式：runcmd 中的 heredoc 命令，或 cloud-init 的 write_files 条目
+FILES_MODES = ('runcmd', 'write_files')
+# 服务安装方式：runcmd中依次执行，或按依赖关系生成并行启动脚本
+BOOT_MODES = ('sequential', 'parallel')
+# 整个user-data的编码方式
+ENCODINGS = ('none', 'gzip', 'mime', 'mime+gzip')
+USER_DATA_FILES = os.getenv('USER_DATA_FILES', 'runcmd')
+USER_DATA_ENCODING = os.getenv('USER_DATA_ENCODING', 'none')
+USER_DATA_BOOT = os.getenv('USER_DATA_BOOT', 'sequential')
+# write_files 中达到该字节数的服务文件内容使用 gz+b64 编码（部署器自己的启动和上报脚本保持明文）
+WRITE_FILES_GZIP_THRESHOLD = int(os.getenv('WRITE_FILES_GZIP_THRESHOLD', '1024'))
+# Nova对base64编码后的user_data的长度限制
+NOVA_USER_DATA_LIMIT = 65535
+# 是否对runcmd做去重、合并等启动耗时优化；默认关闭，保持与之前版本相同的输出
+USER_DATA_OPTIMIZE = os.getenv('USER_DATA_OPTIMIZE', 'false').lower() == 'true'
+# package_upgrade 会在每次启动时升级全部软件包，耗时较长，默认关闭，请求中按需开启
+PACKAGE_UPGRADE = os.getenv('PACKAGE_UPGRADE', 'false').lower() == 'true'
+# 是否让实例在每个服务安装完成和全部完成时回调部署服务
+READINESS_CALLBACKS = os.getenv('READINESS_CALLBACKS', 'false').lower() == 'true'
+
+
+class RenderCache:
+    """有界LRU缓存，保存已渲染的user-data、ETag及优化报告"""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[str, str, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: Tuple[str, str, Dict[str, Any]]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+render_cache = RenderCache(int(os.getenv('RENDER_CACHE_SIZE', '256')))
+
+
+def check_config_shape(config_data: Dict[str, Any]):
+    """校验生成请求的结构（openstack、deployments 及每个服务的配置必须是对象），不符合时抛出ValueError"""
+    openstack = config_data.get('openstack', {})
+    if not isinstance(openstack, dict):
+        raise ValueError('openstack 必须是对象')
+    if not isinstance(openstack.get('image', DEFAULT_IMAGE), str):
+        raise ValueError('openstack.image 必须是字符串')
+    deployments = config_data.get('deployments', {})
+    if not isinstance(deployments, dict):
+        raise ValueError('deployments 必须是对象')
+    for service, service_config in deployments.items():
+        if not isinstance(service_config, dict):
+            raise ValueError(f'deployments.{service} 必须是对象')
+
+
+def user_data_options(config_data: Dict[str, Any]) -> Dict[str, Any]:
+    """读取请求中的 user_data_options 并补全默认值，取值无效时抛出ValueError"""
+    options = config_data.get('user_data_options') or {}
+    if not isinstance(options, dict):
+        raise ValueError('user_data_options 必须是对象')
+    result = {
+        'files': options.get('files', USER_DATA_FILES),
+        'encoding': options.get('encoding', USER_DATA_ENCODING),
+        'boot': options.get('boot', USER_DATA_BOOT),
+        'optimize': options.get('optimize', USER_DATA_OPTIMIZE),
+        'package_upgrade': options.get('package_upgrade', PACKAGE_UPGRADE),
+        'readiness': options.get('readiness', READINESS_CALLBACKS)
+    }
+    if result['files'] not in FILES_MODES:
+        raise ValueError(f'不支持的文件写入方式: {result["files"]}，可选 {", ".join(FILES_MODES)}')
+    if result['boot'] not in BOOT_MODES:
+        raise ValueError(f'不支持的服务安装方式: {result["boot"]}，可选 {", ".join(BOOT_MODES)}')
+    if result['encoding'] not in ENCODINGS:
+        raise ValueError(f'不支持的user-data编码: {result["encoding"]}，可选 {", ".join(ENCODINGS)}')
+    for name in ('optimize', 'package_upgrade', 'readiness'):
+        if not isinstance(result[name], bool):
+            raise ValueError(f'user_data_options.{name} 必须是布尔值')
+    return result
+
+
+def render_cache_key(config_data: Dict[str, Any]) -> str:
+    """对影响渲染结果的输入（启用的服务、镜像及其能力、渲染选项、配置版本）计算规范化哈希"""
+    image_name = config_data.get('openstack', {}).get('image', DEFAULT_IMAGE)
+    try:
+        snapshot = get_config_snapshot()
+        config_version = snapshot.version
+        os_type = resolve_image_os(image_name, snapshot)
+        # 烘焙镜像登记不属于部署配置版本，能力需要单独计入
+        capabilities = sorted(resolve_image_capabilities(image_name, snapshot))
+    except Exception:
+        # 配置不可用时由渲染过程报告错误
+        config_version = os_type = capabilities = None
+    # 服务顺序决定runcmd顺序，因此保留为有序列表
+    key_data = {
+        'deployments': list(config_data.get('deployments', {}).items()),
+        'image': image_name,
+        'os_type': os_type,
+        'capabilities': capabilities,
+        # 编码在渲染之后进行，不影响渲染结果
+        'options': {name: value for name, value in user_data_options(config_data).items() if name != 'encoding'},
+        'config_version': config_version
+    }
+    canonical = json.dumps(key_data, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _lobechat_compose_yaml(service_config: Dict[str, Any]) -> str:
+    # 配置来自共享的只读快照，逐层复制后再替换，避免修改原始配置
     docker_compose_content = {
         'version': service_config['docker_compose']['version'],
-        'services': service_config['docker_compose']['services'].copy()
+        'services': {name: dict(service) for name, service in service_config['docker_compose']['services'].items()}
     }
-    
+
     # 替换环境变量
     for service_name, service in docker_compose_content['services'].items():
         if 'environment' in service:
+            service['environment'] = dict(service['environment'])
             for env_key, env_value in service['environment'].items():
                 if env_value.startswith('${') and env_value.endswith('}'):
                     var_name = env_value[2:-1]  # 移除 ${ 和 }
                     if var_name in service_config['environment']:
                         service['environment'][env_key] = service_config['environment'][var_name]
     
-    docker_compose_yaml = yaml.dump(docker_compose_content, default_flow_style=False, allow_unicode=True, indent=2)
+    return yaml.dump(docker_compose_content, default_flow_style=False, allow_unicode=True, indent=2)
+
+
+LOBECHAT_UPDATE_SCRIPT = '/opt/lobechat/auto-update-lobe-chat.sh'
+LOBECHAT_UPDATE_SCHEDULE = f'0 2 * * * {LOBECHAT_UPDATE_SCRIPT} >> /var/log/lobe-chat-update.log 2>&1'
+
+
+def generate_lobechat_files(service_config: Dict[str, Any]) -> list:
+    """为LobeChat生成docker-compose文件和自动更新脚本"""
+    files_commands = []
+    
+    # 生成docker-compose.yml文件
+    docker_compose_yaml = _lobechat_compose_yaml(service_config)
     
     # 写入docker-compose.yml文件
     files_commands.append(f"cat > /opt/lobechat/docker-compose.yml << 'EOF'")
@@ -36,117 +196,637 @@ def generate_lobechat_files(service_config: Dict[str, Any]) -> list:
     # 生成自动更新脚本
     update_script = service_config.get('auto_update_script', '')
     if update_script:
-        files_commands.append(f"cat > /opt/lobechat/auto-update-lobe-chat.sh << 'EOF'")
+        files_commands.append(f"cat > {LOBECHAT_UPDATE_SCRIPT} << 'EOF'")
         files_commands.append(update_script)
         files_commands.append("EOF")
-        files_commands.append("chmod +x /opt/lobechat/auto-update-lobe-chat.sh")
+        files_commands.append(f"chmod +x {LOBECHAT_UPDATE_SCRIPT}")
         
         # 添加到crontab
-        files_commands.append("(crontab -l 2>/dev/null; echo '0 2 * * * /opt/lobechat/auto-update-lobe-chat.sh >> /var/log/lobe-chat-update.log 2>&1') | crontab -")
+        files_commands.append(f"(crontab -l 2>/dev/null; echo '{LOBECHAT_UPDATE_SCHEDULE}') | crontab -")
     
     return files_commands
 
 
+def generate_lobechat_write_files(service_config: Dict[str, Any]) -> List[Dict[str, str]]:
+    """以write_files条目生成LobeChat的docker-compose文件、自动更新脚本及其cron定时任务"""
+    files = [{'path': '/opt/lobechat/docker-compose.yml', 'content': _lobechat_compose_yaml(service_config)}]
+    update_script = service_config.get('auto_update_script', '')
+    if update_script:
+        if not update_script.endswith('\n'):
+            update_script += '\n'
+        files.append({'path': LOBECHAT_UPDATE_SCRIPT, 'content': update_script, 'permissions': '0755'})
+        # /etc/cron.d 中的条目需要指定用户，且文件须以换行结尾
+        schedule = LOBECHAT_UPDATE_SCHEDULE.replace(' * * * ', ' * * * root ', 1)
+        files.append({'path': '/etc/cron.d/lobechat-auto-update', 'content': schedule + '\n',
+                      'permissions': '0644'})
+    return files
+
+
+def write_files_entry(file: Dict[str, str]) -> Dict[str, str]:
+    """内容达到阈值且压缩后更小时改用 gz+b64 编码"""
+    content = file['content'].encode('utf-8')
+    if len(content) < WRITE_FILES_GZIP_THRESHOLD:
+        return file
+    # 固定mtime使输出可复现，渲染缓存和ETag才稳定
+    encoded = base64.b64encode(gzip.compress(content, mtime=0)).decode('ascii')
+    if len(encoded) >= len(content):
+        return file
+    return dict(file, content=encoded, encoding='gz+b64')
+
+
+def render_cloud_config(config_data: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+    """生成Cloud-Init配置内容，返回 (内容, ETag, 优化报告)，相同输入命中缓存"""
+    with timed('render'):
+        key = render_cache_key(config_data)
+        entry = render_cache.get(key)
+        if entry is not None:
+            logger.info(f"Cloud-Init配置命中缓存: {key[:12]}")
+            return entry
+
+        entry = render_uncached(config_data)
+        render_cache.put(key, entry)
+        return entry
+
+
+def render_uncached(config_data: Dict[str, Any],
+                    image: Optional[Tuple[Optional[str], FrozenSet[str]]] = None) -> Tuple[str, str, Dict[str, Any]]:
+    """不经过缓存渲染，image 为预先解析的 (操作系统类型, 镜像能力)，返回 (内容, ETag, 优化报告)"""
+    yaml_content, report = _render_cloud_config(config_data, image)
+    return yaml_content, hashlib.sha256(yaml_content.encode('utf-8')).hexdigest()[:32], report
+
+
+def resolve_render_image(config_data: Dict[str, Any]) -> Tuple[Optional[str], FrozenSet[str]]:
+    """解析请求镜像的操作系统类型和已具备的能力，解析失败时分别为None和空集合"""
+    image_name = config_data.get('openstack', {}).get('image', DEFAULT_IMAGE)
+    try:
+        os_type = resolve_image_os(image_name)
+    except Exception as e:
+        logger.warning(f"无法解析镜像操作系统: {str(e)}")
+        os_type = None
+    try:
+        capabilities = resolve_image_capabilities(image_name)
+    except Exception as e:
+        logger.warning(f"无法获取镜像能力: {str(e)}")
+        capabilities = frozenset()
+    if capabilities:
+        logger.info(f"镜像 {image_name} 已具备: {sorted(capabilities)}")
+    return os_type, capabilities
+
+
 def generate_cloud_config(config_data: Dict[str, Any]) -> str:
     """生成Cloud-Init配置内容"""
+    return render_cloud_config(config_data)[0]
+
+
+def _mime_multipart(content: str) -> str:
+    # 边界由内容哈希得出，输出可复现且不会与内容冲突
+    boundary = f"==============={hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}=="
+    return (
+        f'Content-Type: multipart/mixed; boundary="{boundary}"\n'
+        'MIME-Version: 1.0\n'
+        '\n'
+        f'--{boundary}\n'
+        'Content-Type: text/cloud-config; charset="utf-8"\n'
+        'MIME-Version: 1.0\n'
+        'Content-Transfer-Encoding: 8bit\n'
+        'Content-Disposition: attachment; filename="cloud-config.yaml"\n'
+        '\n'
+        f'{content}\n'
+        f'--{boundary}--\n'
+    )
+
+
+def encode_user_data(content: str, encoding: str) -> Union[str, bytes]:
+    """按编码方式处理整个user-data，gzip类编码返回bytes，其余返回str"""
+    if encoding == 'none':
+        return content
+    if encoding.startswith('mime'):
+        content = _mime_multipart(content)
+    if encoding.endswith('gzip'):
+        # cloud-init根据gzip魔数自动解压；固定mtime使输出可复现
+        return gzip.compress(content.encode('utf-8'), mtime=0)
+    return content
+
+
+def user_data_size(content: str, payload: Union[str, bytes], files_mode: str, encoding: str) -> Dict[str, Any]:
+    """user-data编码前后的字节数，以及base64编码后相对Nova上限的情况"""
+    raw = len(content.encode('utf-8'))
+    encoded = len(payload if isinstance(payload, bytes) else payload.encode('utf-8'))
+    base64_size = (encoded + 2) // 3 * 4
+    return {
+        'files': files_mode,
+        'encoding': encoding,
+        'raw': raw,
+        'encoded': encoded,
+        'ratio': round(encoded / raw, 3) if raw else 1.0,
+        'base64': base64_size,
+        'limit': NOVA_USER_DATA_LIMIT,
+        'within_limit': base64_size <= NOVA_USER_DATA_LIMIT
+    }
+
+
+def add_readiness_callback(yaml_content: str, callback_env: str) -> str:
+    """在渲染结果后追加实例的回调配置（write_files 是最后一个键，启用回调时总是存在）"""
+    return yaml_content + _serialize_file({'path': CALLBACK_ENV_PATH, 'content': callback_env, 'permissions': '0600'},
+                                          compress=False)
+
+
+def build_user_data(config_data: Dict[str, Any], callback_env: Optional[str] = None
+                    ) -> Tuple[str, Union[str, bytes], Dict[str, Any], Dict[str, Any]]:
+    """渲染并按 user_data_options 编码，返回 (cloud-config内容, 实际发送的payload, 大小信息, 优化报告)
+
+    启用就绪回调时 callback_env 为该实例的回调配置（含令牌），不参与渲染缓存，只写入payload；
+    返回的cloud-config内容不含回调配置，可以放进响应和部署历史。
+    """
+    options = user_data_options(config_data)
+    yaml_content, _, report = render_cloud_config(config_data)
+    sent_content = yaml_content
+    if options['readiness'] and callback_env:
+        sent_content = add_readiness_callback(yaml_content, callback_env)
+    payload = encode_user_data(sent_content, options['encoding'])
+    return yaml_content, payload, user_data_size(sent_content, payload, options['files'], options['encoding']), report
+
+
+def _docker_config_for_os(os_type: Optional[str], docker_install_configs: Dict[str, Any],
+                          capabilities: FrozenSet[str] = frozenset()) -> Dict[str, Any]:
+    if os_type is None:
+        raise Exception("部署配置文件不存在")
+    if os_type not in docker_install_configs:
+        raise Exception(f"不支持的操作系统类型: {os_type}")
+    return apply_capabilities(docker_install_configs[os_type], capabilities)
+
+
+def _build_service(service: str, service_config: Dict[str, Any], os_type: Optional[str],
+                   docker_enabled: bool, deployment_configs, files_mode: str = 'runcmd',
+                   capabilities: FrozenSet[str] = frozenset()) -> Tuple[list, list, list]:
+    """计算单个服务在给定操作系统和镜像能力下的 (packages, runcmd命令, write_files条目)"""
+    service_config = service_config.copy()
+    docker_install_configs = deployment_configs.get('docker_install_configs', {})
+    packages = []
+    commands = []
+    files = []
+
+    if service == 'docker':
+        try:
+            docker_config = _docker_config_for_os(os_type, docker_install_configs, capabilities)
+            service_config['packages'] = docker_config['packages']
+            service_config['commands'] = docker_config['commands']
+            logger.info(f"Docker配置已适配操作系统: {os_type}")
+        except Exception as e:
+            logger.warning(f"获取Docker配置失败，使用默认配置: {str(e)}")
+            if 'deployments' in deployment_configs and 'docker' in deployment_configs['deployments']:
+                default_docker = deployment_configs['deployments']['docker']
+                if 'packages' not in service_config and 'packages' in default_docker:
+                    service_config['packages'] = default_docker['packages']
+                if 'commands' not in service_config and 'commands' in default_docker:
+                    service_config['commands'] = default_docker['commands']
+    else:
+        if 'deployments' in deployment_configs and service in deployment_configs['deployments']:
+            default_service = deployment_configs['deployments'][service]
+            if 'packages' not in service_config and 'packages' in default_service:
+                service_config['packages'] = default_service['packages']
+            if 'commands' not in service_config and 'commands' in default_service:
+                service_config['commands'] = default_service['commands']
+
+    if 'packages' in service_config:
+        packages.extend(service_config['packages'])
+
+    commands.append(f'# {service} 配置')
+    if 'commands' in service_config:
+        commands.extend(service_config['commands'])
+
+    # 特殊处理LobeChat部署
+    if service == 'lobechat':
+        # 首先检查并安装Docker
+        if not docker_enabled:
+            logger.info("LobeChat需要Docker，自动添加Docker安装步骤")
+            try:
+                docker_config = _docker_config_for_os(os_type, docker_install_configs, capabilities)
+                packages.extend(docker_config['packages'])
+                commands.append('# Docker 自动配置')
+                commands.extend(docker_config['commands'])
+            except Exception as e:
+                logger.warning(f"获取Docker配置失败: {str(e)}")
+                commands.extend([
+                    'apt-get install -y docker.io',
+                    'systemctl enable docker',
+                    'systemctl start docker',
+                    'usermod -aG docker ubuntu'
+                ])
+
+        # 生成LobeChat特定的文件和配置
+        if files_mode == 'write_files':
+            files.extend(generate_lobechat_write_files(service_config))
+        else:
+            commands.extend(generate_lobechat_files(service_config))
+
+        # 启动LobeChat服务
+        commands.append('cd /opt/lobechat && docker-compose up -d')
+        logger.info("已添加LobeChat部署和自动更新配置")
+
+    if service_config.get('test_container', False) and 'test_commands' in service_config:
+        commands.extend(service_config['test_commands'])
+
+    if capabilities:
+        # 镜像中已有的包无需再安装
+        packages = [package for package in packages if package not in capabilities]
+
+    return packages, commands, files
+
+
+# 与 yaml.dump(default_flow_style=False, allow_unicode=True, indent=2) 的输出逐字节一致
+_YAML_OPTIONS = {'default_flow_style': False, 'allow_unicode': True, 'indent': 2}
+_HEADERS = {
+    package_upgrade: "#cloud-config\n\n" + yaml.dump({
+        'final_message': '应用部署完成',
+        'package_update': True,
+        'package_upgrade': package_upgrade
+    }, **_YAML_OPTIONS)
+    for package_upgrade in (False, True)
+}
+_ITEM_CACHE_MAX_SIZE = 4096
+_item_cache: "OrderedDict[str, str]" = OrderedDict()
+_item_cache_lock = threading.Lock()
+
+
+def _serialize_item(value: str) -> str:
+    """序列化单个块序列元素（含 "- " 前缀和换行），结果按字符串缓存"""
+    with _item_cache_lock:
+        chunk = _item_cache.get(value)
+        if chunk is not None:
+            _item_cache.move_to_end(value)
+            return chunk
+    # 元素在块序列中的起始列固定，单独序列化与整体序列化结果相同
+    chunk = yaml.dump({'k': [value]}, **_YAML_OPTIONS)[len('k:\n'):]
+    with _item_cache_lock:
+        _item_cache[value] = chunk
+        while len(_item_cache) > _ITEM_CACHE_MAX_SIZE:
+            _item_cache.popitem(last=False)
+    return chunk
+
+
+class _BlockStyleDumper(yaml.Dumper):
+    """多行字符串使用字面块（|）风格，便于阅读write_files中的文件内容"""
+
+
+def _represent_str(dumper, value):
+    if '\n' in value:
+        return dumper.represent_scalar('tag:yaml.org,2002:str', value, style='|')
+    return dumper.represent_str(value)
+
+
+_BlockStyleDumper.add_representer(str, _represent_str)
+
+
+def _serialize_file(file: Dict[str, str], compress: bool = True) -> str:
+    """序列化单个write_files条目（含 "- " 前缀），compress 为False时不做 gz+b64 编码"""
+    entry = write_files_entry(file) if compress else file
+    return yaml.dump({'k': [entry]}, Dumper=_BlockStyleDumper, **_YAML_OPTIONS)[len('k:\n'):]
+
+
+def emit_cloud_config(packages: list, runcmd_chunks: list, write_files_chunks: Optional[list] = None,
+                      package_upgrade: bool = True) -> str:
+    """拼接预序列化的片段生成cloud-config文本"""
+    parts = [_HEADERS[package_upgrade]]
+    if packages:
+        parts.append('packages:\n')
+        parts.extend(_serialize_item(package) for package in packages)
+    else:
+        parts.append('packages: []\n')
+    if runcmd_chunks:
+        parts.append('runcmd:\n')
+        parts.extend(runcmd_chunks)
+    else:
+        parts.append('runcmd: []\n')
+    # 键按字母序排列，write_files 位于 runcmd 之后
+    write_files_chunks = [chunk for chunk in write_files_chunks or () if chunk]
+    if write_files_chunks:
+        parts.append('write_files:\n')
+        parts.extend(write_files_chunks)
+    return ''.join(parts)
+
+
+# ---- runcmd 启动耗时优化 ----
+
+_PACKAGE_FLAGS = r'(?:\s+(?:-y|-q|-qq|--yes|--assume-yes|--quiet))*'
+_REFRESH_RE = re.compile(r'^(?:(apt-get|apt)(?:\s+-\S+)*\s+update|(yum|dnf)(?:\s+-\S+)*\s+makecache(?:\s+fast)?)'
+                         r'(?:\s+-\S+)*\s*$')
+# 只识别不带其他选项的简单安装命令，其余命令原样保留
+_INSTALL_RE = re.compile(rf'^((?:apt-get|apt|yum|dnf){_PACKAGE_FLAGS}\s+install{_PACKAGE_FLAGS})'
+                         r'((?:\s+[A-Za-z0-9][\w.+:=~-]*)+)\s*$')
+_REMOVE_RE = re.compile(r'^(?:apt-get|apt|yum|dnf)(?:\s+-\S+)*\s+(?:remove|purge|erase)\s([^|;&]*)')
+# 修改软件源的命令之后需要重新刷新索引；通过管道执行的安装脚本同样可能添加软件源
+_SOURCES_RE = re.compile(r'sources\.list|add-apt-repository|yum\.repos\.d|config-manager|\.repo\b'
+                         r'|\|\s*(?:sudo\s+)?(?:ba)?sh\b')
+_HEREDOC_RE = re.compile(r"<<-?\s*['\"]?(\w+)['\"]?")
+
+
+def _classify(command: str) -> Tuple[str, str, Tuple[str, ...]]:
+    """把单行命令归类为 (类型, 安装命令前缀或包管理器, 包名)"""
+    if '\n' in command:
+        return ('other', '', ())
+    stripped = command.strip()
+    if not stripped or stripped.startswith('#'):
+        return ('comment', '', ())
+    match = _REFRESH_RE.match(stripped)
+    if match:
+        return ('refresh', 'apt' if match.group(1) else 'yum', ())
+    match = _INSTALL_RE.match(stripped)
+    if match:
+        return ('install', match.group(1), tuple(match.group(2).split()))
+    match = _REMOVE_RE.match(stripped)
+    if match:
+        return ('remove', '', tuple(token for token in match.group(1).split() if not token.startswith('-')))
+    if _SOURCES_RE.search(stripped):
+        return ('sources', '', ())
+    return ('other', '', ())
+
+
+def classify_commands(commands: list) -> Tuple[Tuple[str, str, Tuple[str, ...]], ...]:
+    """逐条归类runcmd命令，heredoc中的内容行不参与优化"""
+    steps = []
+    delimiter = None
+    for command in commands:
+        if delimiter is not None:
+            steps.append(('other', '', ()))
+            if command.strip() == delimiter:
+                delimiter = None
+            continue
+        match = _HEREDOC_RE.search(command) if '\n' not in command else None
+        if match:
+            delimiter = match.group(1)
+            steps.append(('other', '', ()))
+            continue
+        steps.append(_classify(command))
+    return tuple(steps)
+
+
+def optimize_runcmd(commands: list, steps, packages, package_update: bool = True,
+                    provided=()) -> Tuple[list, Dict[str, int]]:
+    """去掉多余的索引刷新和已在packages中或镜像已提供的安装，合并相邻的安装命令，返回 (命令, 统计)"""
+    stats = {'refreshes_removed': 0, 'installs_removed': 0, 'installs_merged': 0, 'packages_deduplicated': 0}
+    result = []
+    # cloud-init 在执行runcmd前已刷新索引（package_update）并安装了packages
+    fresh = package_update
+    installed = set(packages).union(provided)
+    # 上一条仍可追加包的安装命令: [在result中的位置, 前缀, 包列表]
+    last_install = None
+    for command, (kind, prefix, names) in zip(commands, steps):
+        if kind == 'comment':
+            result.append(command)
+            continue
+        if kind == 'refresh':
+            # yum/dnf 安装时会自动下载缺失或过期的仓库元数据，单独的 makecache 总是多余
+            if fresh or prefix == 'yum':
+                stats['refreshes_removed'] += 1
+                continue
+            fresh = True
+        elif kind == 'sources':
+            fresh = False
+        elif kind == 'remove':
+            installed.difference_update(names)
+        elif kind == 'install':
+            new = [name for name in dict.fromkeys(names) if name not in installed]
+            stats['packages_deduplicated'] += len(names) - len(new)
+            if not new:
+                stats['installs_removed'] += 1
+                continue
+            installed.update(new)
+            if last_install is not None and last_install[1] == prefix:
+                # 两条安装命令之间没有其他命令，合并为一次事务不改变执行顺序
+                last_install[2].extend(new)
+                result[last_install[0]] = f"{prefix} {' '.join(last_install[2])}"
+                stats['installs_merged'] += 1
+                continue
+            if len(new) != len(names):
+                command = f"{prefix} {' '.join(new)}"
+            result.append(command)
+            last_install = [len(result) - 1, prefix, new]
+            continue
+        last_install = None
+        result.append(command)
+    return result, stats
+
+
+class Fragment:
+    """预编译的服务片段：包集合、已序列化的runcmd与write_files，以及供优化使用的命令归类"""
+
+    __slots__ = ('packages', 'runcmd', 'command_count', 'commands', 'steps', 'write_files', 'file_count')
+
+    def __init__(self, packages: list, commands: list, files: Optional[list] = None):
+        self.packages = frozenset(packages)
+        self.runcmd = ''.join(_serialize_item(command) for command in commands)
+        self.command_count = len(commands)
+        self.commands = tuple(commands)
+        self.steps = classify_commands(commands)
+        self.write_files = ''.join(_serialize_file(file) for file in files or ())
+        self.file_count = len(files or ())
+
+
+class CompiledTemplates:
+    """按配置版本预编译的 (服务, 操作系统, 文件写入方式) 片段，镜像具备能力时的片段按需编译后缓存"""
+
+    def __init__(self, version: Optional[str], deployment_configs):
+        self.version = version
+        self.deployment_configs = deployment_configs
+        self.defaults = deployment_configs.get('deployments', {})
+        self.fragments: Dict[Tuple[str, str, bool, str, FrozenSet[str]], Fragment] = {}
+        self.hits = 0
+        self.misses = 0
+        for os_type in deployment_configs.get('docker_install_configs', {}):
+            for service, service_config in self.defaults.items():
+                # 只有LobeChat的输出取决于是否同时启用了Docker，也只有它会写文件
+                for docker_enabled in ((False, True) if service == 'lobechat' else (False,)):
+                    for files_mode in (FILES_MODES if service == 'lobechat' else ('runcmd',)):
+                        packages, commands, files = _build_service(service, service_config, os_type,
+                                                                   docker_enabled, deployment_configs, files_mode)
+                        self.fragments[(service, os_type, docker_enabled, files_mode, frozenset())] = \
+                            Fragment(packages, commands, files)
+        self.compiled = len(self.fragments)
+        logger.info(f"已预编译{len(self.fragments)}个服务片段，配置版本: {version}")
+
+    def fragment(self, service: str, service_config: Dict[str, Any], os_type: Optional[str],
+                 docker_enabled: bool, files_mode: str = 'runcmd',
+                 capabilities: FrozenSet[str] = frozenset()) -> Fragment:
+        """请求中的服务配置与默认配置一致时返回预编译片段，否则即时编译"""
+        is_default = service_config == self.defaults.get(service)
+        if is_default:
+            is_lobechat = service == 'lobechat'
+            key = (service, os_type, docker_enabled and is_lobechat, files_mode if is_lobechat else 'runcmd',
+                   capabilities)
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.hits += 1
+                return fragment
+        self.misses += 1
+        packages, commands, files = _build_service(service, service_config, os_type, docker_enabled,
+                                                   self.deployment_configs, files_mode, capabilities)
+        fragment = Fragment(packages, commands, files)
+        if is_default and len(self.fragments) < self.compiled + LAZY_FRAGMENT_LIMIT:
+            self.fragments[key] = fragment
+        return fragment
+
+
+# 按镜像能力组合按需编译的片段数上限（登记的烘焙镜像可能不断增加）
+LAZY_FRAGMENT_LIMIT = 256
+_templates_lock = threading.Lock()
+_templates: Optional[CompiledTemplates] = None
+
+
+def _after_fork():
+    # 子进程中不存在持锁的其他线程，重建锁以免继承到已持有的锁
+    global _templates_lock, _item_cache_lock
+    _templates_lock = threading.Lock()
+    _item_cache_lock = threading.Lock()
+    render_cache._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _templates_stats() -> Dict[str, Any]:
+    templates = _templates
+    if templates is None:
+        return {'hits': 0, 'misses': 0, 'size': 0}
+    return {'hits': templates.hits, 'misses': templates.misses, 'size': len(templates.fragments)}
+
+
+registry.register_cache('render', render_cache.stats)
+registry.register_cache('compiled_templates', _templates_stats)
+
+
+def get_compiled_templates() -> CompiledTemplates:
+    """返回当前配置版本的预编译片段，配置变化时重新编译"""
+    global _templates
+    deployment_configs = load_deployment_configs()
+    version = get_config_version()
+    current = _templates
+    if current is not None and current.version == version and current.deployment_configs is deployment_configs:
+        return current
+    with _templates_lock:
+        if _templates is None or _templates.version != version or _templates.deployment_configs is not deployment_configs:
+            _templates = CompiledTemplates(version, deployment_configs)
+        return _templates
+
+
+def _service_setting(service: str, key: str, deployments: Dict[str, Any], defaults: Dict[str, Any]) -> list:
+    """请求中的服务配置未指定时沿用部署配置文件中的默认值"""
+    config = deployments.get(service)
+    if config is not None and key in config:
+        return config[key]
+    return defaults.get(service, {}).get(key, [])
+
+
+def _merge_optimization_stats(report: Dict[str, Any], stats: Dict[str, int]):
+    for name, value in stats.items():
+        report[name] = report.get(name, 0) + value
+    removed = stats['refreshes_removed'] + stats['installs_removed'] + stats['installs_merged']
+    report['commands_removed'] += removed
+    report['commands_after'] -= removed
+
+
+def _render_cloud_config(config_data: Dict[str, Any],
+                         image: Optional[Tuple[Optional[str], FrozenSet[str]]] = None) -> Tuple[str, Dict[str, Any]]:
     try:
-        deployment_configs = load_deployment_configs()
+        templates = get_compiled_templates()
         
-        enabled_services = list(config_data.get('deployments', {}).keys())
+        deployments = config_data.get('deployments', {})
+        enabled_services = list(deployments.keys())
         logger.info(f"启用的服务: {enabled_services}")
         
-        cloud_config = {
-            '#cloud-config': None,
-            'package_update': True,
-            'package_upgrade': True,
-            'packages': [],
-            'runcmd': [],
-            'final_message': '应用部署完成'
-        }
+        os_type, capabilities = image if image is not None else resolve_render_image(config_data)
+        options = user_data_options(config_data)
+        if options['boot'] == 'parallel':
+            # 依赖的服务即使未启用也会自动加入，作为独立的步骤
+            dependencies = {name: _service_setting(name, 'depends_on', deployments, templates.defaults)
+                            for name in {**templates.defaults, **deployments}}
+            enabled_services = resolve_services(enabled_services, dependencies)
+            service_configs = {name: deployments.get(name, templates.defaults.get(name)) for name in enabled_services}
+        else:
+            service_configs = deployments
+        docker_enabled = 'docker' in service_configs
         
         packages = set()
-        commands = []
-        
-        image_name = config_data.get('openstack', {}).get('image', 'Ubuntu 22.04')
+        fragments = []
+        file_count = 0
         
         for service in enabled_services:
             logger.info(f"处理服务: {service}")
-            service_config = config_data['deployments'][service].copy()
-            
-            if service == 'docker':
-                try:
-                    docker_config = get_docker_config_for_image(image_name)
-                    service_config['packages'] = docker_config['packages']
-                    service_config['commands'] = docker_config['commands']
-                    logger.info(f"Docker配置已适配镜像: {image_name}")
-                except Exception as e:
-                    logger.warning(f"获取Docker配置失败，使用默认配置: {str(e)}")
-                    if 'deployments' in deployment_configs and 'docker' in deployment_configs['deployments']:
-                        default_docker = deployment_configs['deployments']['docker']
-                        if 'packages' not in service_config and 'packages' in default_docker:
-                            service_config['packages'] = default_docker['packages']
-                        if 'commands' not in service_config and 'commands' in default_docker:
-                            service_config['commands'] = default_docker['commands']
-            else:
-                if 'deployments' in deployment_configs and service in deployment_configs['deployments']:
-                    default_service = deployment_configs['deployments'][service]
-                    if 'packages' not in service_config and 'packages' in default_service:
-                        service_config['packages'] = default_service['packages']
-                    if 'commands' not in service_config and 'commands' in default_service:
-                        service_config['commands'] = default_service['commands']
-            
-            if 'packages' in service_config:
-                packages.update(service_config['packages'])
-            
-            commands.append(f'# {service} 配置')
-            if 'commands' in service_config:
-                commands.extend(service_config['commands'])
-            
-            # 特殊处理LobeChat部署
-            if service == 'lobechat':
-                # 首先检查并安装Docker
-                if 'docker' not in enabled_services:
-                    logger.info("LobeChat需要Docker，自动添加Docker安装步骤")
-                    try:
-                        docker_config = get_docker_config_for_image(image_name)
-                        packages.update(docker_config['packages'])
-                        commands.append('# Docker 自动配置')
-                        commands.extend(docker_config['commands'])
-                    except Exception as e:
-                        logger.warning(f"获取Docker配置失败: {str(e)}")
-                        commands.extend([
-                            'apt-get install -y docker.io',
-                            'systemctl enable docker',
-                            'systemctl start docker',
-                            'usermod -aG docker ubuntu'
-                        ])
-                
-                # 生成LobeChat特定的文件和配置
-                lobechat_files = generate_lobechat_files(service_config)
-                commands.extend(lobechat_files)
-                
-                # 启动LobeChat服务
-                commands.append('cd /opt/lobechat && docker-compose up -d')
-                logger.info("已添加LobeChat部署和自动更新配置")
-            
-            if service_config.get('test_container', False) and 'test_commands' in service_config:
-                commands.extend(service_config['test_commands'])
+            fragment = templates.fragment(service, service_configs[service], os_type, docker_enabled, options['files'],
+                                          capabilities)
+            packages.update(fragment.packages)
+            fragments.append(fragment)
+            file_count += fragment.file_count
+        
+        command_count = sum(1 for fragment in fragments for kind, _, _ in fragment.steps if kind != 'comment')
+        report = {'optimized': options['optimize'], 'package_upgrade': options['package_upgrade'],
+                  'boot': options['boot'], 'image_capabilities': sorted(capabilities),
+                  'commands_before': command_count, 'commands_after': command_count, 'commands_removed': 0}
+        write_files_chunks = [fragment.write_files for fragment in fragments]
+        readiness = options['readiness']
+        if readiness:
+            write_files_chunks.insert(0, _serialize_file({'path': REPORT_SCRIPT_PATH, 'content': REPORT_SCRIPT,
+                                                          'permissions': '0755'}, compress=False))
         
-        cloud_config['packages'] = sorted(list(packages))
-        cloud_config['runcmd'] = commands
+        if options['boot'] == 'parallel':
+            # 各服务的命令在各自的步骤中按顺序执行，优化也按服务分别进行
+            service_commands = []
+            for fragment in fragments:
+                commands = list(fragment.commands)
+                if options['optimize']:
+                    commands, stats = optimize_runcmd(commands, fragment.steps, packages, provided=capabilities)
+                    _merge_optimization_stats(report, stats)
+                service_commands.append(commands)
+            steps = build_steps([{
+                'name': service,
+                'depends_on': dependencies[service],
+                'commands': commands,
+                'prefetch_commands': _service_setting(service, 'prefetch_commands', deployments, templates.defaults)
+            } for service, commands in zip(enabled_services, service_commands)])
+            report['steps'] = [{'name': step['name'], 'depends_on': step['depends_on']} for step in steps]
+            runcmd_chunks = [_serialize_item(BOOT_SCRIPT_PATH)]
+            # 启动脚本保持明文，便于在实例上排查
+            write_files_chunks.insert(0, _serialize_file({'path': BOOT_SCRIPT_PATH,
+                                                          'content': render_boot_script(steps, report=readiness),
+                                                          'permissions': '0755'}, compress=False))
+            if readiness:
+                report['readiness'] = [step['name'] for step in steps]
+        elif readiness:
+            # 每个服务的命令前后插入上报；上报命令位于服务之间，优化不会跨服务合并安装命令
+            commands = []
+            command_steps = []
+            for service, fragment in zip(enabled_services, fragments):
+                name = step_name(service)
+                hooks = [f'{REPORT_SCRIPT_PATH} {name} started &', f'{REPORT_SCRIPT_PATH} {name} done &']
+                hook_steps = classify_commands(hooks)
+                commands.extend([hooks[0], *fragment.commands, hooks[1]])
+                command_steps.extend([hook_steps[0], *fragment.steps, hook_steps[1]])
+            if options['optimize']:
+                commands, stats = optimize_runcmd(commands, command_steps, packages, provided=capabilities)
+                _merge_optimization_stats(report, stats)
+            runcmd_chunks = [_serialize_item(command) for command in commands]
+            report['readiness'] = [step_name(service) for service in enabled_services]
+        else:
+            runcmd_chunks = [fragment.runcmd for fragment in fragments]
+            if options['optimize']:
+                commands, stats = optimize_runcmd([command for fragment in fragments for command in fragment.commands],
+                                                  [step for fragment in fragments for step in fragment.steps], packages,
+                                                  provided=capabilities)
+                _merge_optimization_stats(report, stats)
+                if any(stats.values()):
+                    # 命令有变化时才需要重新拼接，否则沿用预序列化的片段
+                    runcmd_chunks = [_serialize_item(command) for command in commands]
+        if readiness:
+            # 最后一条命令在全部安装结束后执行，报告实例就绪
+            runcmd_chunks.append(_serialize_item(f'{REPORT_SCRIPT_PATH} {READY_SERVICE} ready'))
         
-        yaml_content = "#cloud-config\n\n"
-        yaml_content += yaml.dump({
-            'package_update': cloud_config['package_update'],
-            'package_upgrade': cloud_config['package_upgrade'],
-            'packages': cloud_config['packages'],
-            'runcmd': cloud_config['runcmd'],
-            'final_message': cloud_config['final_message']
-        }, default_flow_style=False, allow_unicode=True, indent=2)
+        yaml_content = emit_cloud_config(sorted(packages), runcmd_chunks, write_files_chunks, options['package_upgrade'])
         
-        logger.info(f"Cloud-Init配置已生成，包含{len(packages)}个包和{len(commands)}条命令")
-        return yaml_content
+        logger.info(f"Cloud-Init配置已生成，包含{len(packages)}个包、{report['commands_after']}条命令和{file_count}个文件"
+                    f"（优化去掉{report['commands_removed']}条）")
+        return yaml_content, report
         
     except Exception as e:
         logger.error(f"Cloud-Init配置生成失败: {str(e)}")
-        raise
\ No newline at end of file
+        raise
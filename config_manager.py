@@ -1,11 +1,175 @@
+import copy
 import json
-from typing import Dict, Any
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from types import MappingProxyType
+from typing import Dict, Any, FrozenSet, Iterable, Mapping, Optional
+import image_resolver
+from image_resolver import ImageResolver, get_resolver, parse_capabilities
+from metrics import registry, timed
 
+logger = logging.getLogger(__name__)
 
-def load_deployment_configs() -> Dict[str, Any]:
+CONFIG_FILE = 'deployment-configs.json'
+# 烘焙镜像的能力登记，由 bake 流程写入
+BAKED_IMAGES_FILE = os.getenv('BAKED_IMAGES_FILE', 'baked-images.json')
+# 文件不存在的结果在这段时间内（秒）直接复用，不再每次stat
+MISSING_RECHECK_INTERVAL = 1.0
+
+
+class ConfigSnapshot:
+    """部署配置的只读快照，version 为文件内容哈希
+
+    data 的顶层只读，嵌套的对象在所有请求间共享：交给调用方可能被修改的部分由 load_* 函数深拷贝后返回。
+    """
+
+    __slots__ = ('version', 'data', 'raw', 'path', 'mtime_ns', 'inode', 'size')
+
+    def __init__(self, raw: bytes, path: str, mtime_ns: int, inode: int, size: int):
+        self.version = hashlib.sha256(raw).hexdigest()[:16]
+        self.data: Mapping[str, Any] = MappingProxyType(json.loads(raw.decode('utf-8')))
+        # 保留原始内容，快照需要发送给批量渲染的子进程时按原文重新解析
+        self.raw = raw
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.size = size
+
+    def __reduce__(self):
+        return ConfigSnapshot, (self.raw, self.path, self.mtime_ns, self.inode, self.size)
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return (self.mtime_ns, self.inode, self.size) == (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    @property
+    def deployments(self) -> Dict[str, Any]:
+        return self.data.get('deployments', {})
+
+    @property
+    def docker_install_configs(self) -> Dict[str, Any]:
+        return self.data.get('docker_install_configs', {})
+
+    @property
+    def image_mapping(self) -> Dict[str, Any]:
+        return self.data.get('image_mapping', {})
+
+    @property
+    def image_capabilities(self) -> Dict[str, Any]:
+        return self.data.get('image_capabilities', {})
+
+
+class ConfigStore:
+    """进程级配置存储：只解析一次，文件mtime/inode变化时原子地重新加载"""
+
+    def __init__(self, path: str = CONFIG_FILE):
+        self.path = path
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self._pinned = False
+        self._missing_until = 0.0
+        self.hits = 0
+        self.reloads = 0
+
+    def _after_fork(self):
+        # 子进程中不存在持锁的其他线程，重建锁以免继承到已持有的锁
+        self._lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+
+    def _count_hit(self):
+        with self._counts_lock:
+            self.hits += 1
+
+    def pin(self, snapshot: ConfigSnapshot):
+        """固定使用给定快照、不再检查文件（用于批量渲染的子进程，保证与父进程使用同一版本）"""
+        with self._lock:
+            self._snapshot = snapshot
+            self._pinned = True
+
+    def get(self) -> ConfigSnapshot:
+        """返回当前快照，文件不存在时抛出 FileNotFoundError"""
+        if self._pinned:
+            return self._snapshot
+        stat = os.stat(self.path)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.matches(stat):
+            self._count_hit()
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.matches(stat):
+                return snapshot
+            try:
+                with self._counts_lock:
+                    self.reloads += 1
+                with timed('config_load'):
+                    self._snapshot = self._load()
+            except (OSError, ValueError) as e:
+                # 文件可能正在被写入，保留旧快照等待下一次变化
+                if snapshot is None:
+                    raise
+                logger.warning(f"重新加载部署配置失败，继续使用版本 {snapshot.version}: {str(e)}")
+                return snapshot
+            if snapshot is not None:
+                logger.info(f"部署配置已重新加载: {snapshot.version} -> {self._snapshot.version}")
+            return self._snapshot
+
+    def get_optional(self) -> Optional[ConfigSnapshot]:
+        """与 get 相同，但文件不存在时返回None，并在 MISSING_RECHECK_INTERVAL 秒内直接沿用这个结果"""
+        if self._missing_until > time.monotonic():
+            self._count_hit()
+            return None
+        try:
+            return self.get()
+        except FileNotFoundError:
+            self._missing_until = time.monotonic() + MISSING_RECHECK_INTERVAL
+            return None
+
+    def invalidate(self):
+        """本进程刚写入了文件，下次读取时重新检查"""
+        self._missing_until = 0.0
+
+    @property
+    def version(self) -> str:
+        return self.get().version
+
+    def _load(self) -> ConfigSnapshot:
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            raw = f.read()
+        return ConfigSnapshot(raw, self.path, stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+
+config_store = ConfigStore()
+baked_images_store = ConfigStore(BAKED_IMAGES_FILE)
+registry.register_cache('config', lambda: {'hits': config_store.hits, 'misses': config_store.reloads})
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=config_store._after_fork)
+    os.register_at_fork(after_in_child=baked_images_store._after_fork)
+_baked_images_lock = threading.Lock()
+
+
+def get_config_snapshot() -> ConfigSnapshot:
+    return config_store.get()
+
+
+def get_config_version() -> Optional[str]:
+    """返回当前部署配置版本，文件不存在时返回None"""
     try:
-        with open('deployment-configs.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return config_store.version
+    except FileNotFoundError:
+        return None
+
+
+def load_deployment_configs() -> Mapping[str, Any]:
+    """返回部署配置快照（只读且在请求间共享，调用方取出的服务配置需要修改或交给请求时请先 copy.deepcopy）"""
+    try:
+        return config_store.get().data
     except FileNotFoundError:
         return {'deployments': {}}
     except Exception as e:
@@ -14,31 +178,104 @@ def load_deployment_configs() -> Dict[str, Any]:
 
 def load_docker_install_configs() -> Dict[str, Any]:
     try:
-        with open('deployment-configs.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            return {
-                'docker_install_configs': config.get('docker_install_configs', {}),
-                'image_mapping': config.get('image_mapping', {})
-            }
+        snapshot = config_store.get()
+        return copy.deepcopy({
+            'docker_install_configs': snapshot.docker_install_configs,
+            'image_mapping': snapshot.image_mapping
+        })
     except FileNotFoundError:
         raise Exception("部署配置文件不存在")
     except Exception as e:
         raise Exception(f"加载Docker安装配置失败: {str(e)}")
 
 
+def _get_resolver(snapshot: ConfigSnapshot) -> ImageResolver:
+    return get_resolver(snapshot.version, snapshot.image_mapping, snapshot.docker_install_configs.keys(),
+                        snapshot.image_capabilities)
+
+
+def resolve_image_os(image_name: str, snapshot: Optional[ConfigSnapshot] = None) -> str:
+    """按当前配置版本的索引解析镜像对应的操作系统类型"""
+    if snapshot is None:
+        snapshot = config_store.get()
+    return _get_resolver(snapshot).resolve(image_name)
+
+
+def load_baked_images() -> Mapping[str, Any]:
+    """返回已登记的烘焙镜像 {镜像名或ID: 登记信息}"""
+    snapshot = baked_images_store.get_optional()
+    return snapshot.data.get('images', {}) if snapshot is not None else {}
+
+
+def register_baked_image(image_name: str, image_id: Optional[str], capabilities: Iterable[str],
+                         source_instance: Optional[str] = None) -> Dict[str, Any]:
+    """登记烘焙镜像的能力（按名称和ID各登记一条），原子地写入登记文件"""
+    entry = {
+        'name': image_name,
+        'id': image_id,
+        'capabilities': list(parse_capabilities(capabilities)),
+        'source_instance': source_instance,
+        'registered_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
+    with _baked_images_lock:
+        images = dict(load_baked_images())
+        for key in (image_name, image_id):
+            if key:
+                images[key] = entry
+        directory = os.path.dirname(os.path.abspath(BAKED_IMAGES_FILE))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False, encoding='utf-8') as f:
+            json.dump({'images': images}, f, ensure_ascii=False, indent=2)
+        os.replace(f.name, BAKED_IMAGES_FILE)
+        baked_images_store.invalidate()
+    logger.info(f"已登记烘焙镜像 {image_name}（{image_id}）的能力: {entry['capabilities']}")
+    return entry
+
+
+def resolve_image_capabilities(image_name: str, snapshot: Optional[ConfigSnapshot] = None) -> FrozenSet[str]:
+    """镜像已具备的能力：部署配置中的 image_capabilities（按镜像名token匹配）、烘焙镜像登记与Glance属性的并集"""
+    if snapshot is None:
+        snapshot = config_store.get()
+    capabilities = set(_get_resolver(snapshot).configured_capabilities(image_name))
+    baked = load_baked_images().get(image_name)
+    if baked:
+        capabilities.update(baked['capabilities'])
+    catalog = image_resolver.glance_catalog
+    if catalog is not None:
+        meta = catalog.lookup(image_name)
+        if meta:
+            capabilities.update(meta['capabilities'])
+    return frozenset(capabilities)
+
+
+def apply_capabilities(install_config: Dict[str, Any], capabilities: FrozenSet[str]) -> Dict[str, Any]:
+    """去掉镜像中已有的包；镜像具备配置 provides 中的全部能力时省略安装命令及其前置包"""
+    if not capabilities:
+        return install_config
+    result = dict(install_config)
+    provides = install_config.get('provides')
+    if provides and capabilities.issuperset(provides):
+        result['packages'] = []
+        result['commands'] = []
+    else:
+        result['packages'] = [package for package in install_config.get('packages', [])
+                              if package not in capabilities]
+    return result
+
+
 def get_docker_config_for_image(image_name: str) -> Dict[str, Any]:
-    docker_configs = load_docker_install_configs()
-    
-    os_type = None
-    for img_pattern, os_name in docker_configs['image_mapping'].items():
-        if img_pattern.lower() in image_name.lower():
-            os_type = os_name
-            break
-    
-    if not os_type:
-        os_type = 'ubuntu'
-    
-    if os_type not in docker_configs['docker_install_configs']:
+    try:
+        snapshot = config_store.get()
+    except FileNotFoundError:
+        raise Exception("部署配置文件不存在")
+    except Exception as e:
+        raise Exception(f"加载Docker安装配置失败: {str(e)}")
+
+    docker_install_configs = snapshot.docker_install_configs
+    os_type = resolve_image_os(image_name, snapshot)
+
+    if os_type not in docker_install_configs:
         raise Exception(f"不支持的操作系统类型: {os_type}")
-    
-    return docker_configs['docker_install_configs'][os_type]
\ No newline at end of file
+
+    # 返回的安装配置属于调用方，不与快照共享嵌套的列表
+    return copy.deepcopy(apply_capabilities(docker_install_configs[os_type],
+                                            resolve_image_capabilities(image_name, snapshot)))
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+from metrics import registry, timed
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB = os.getenv('HISTORY_DB', 'deployment-history.db')
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', '100'))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '0.5'))
+HISTORY_QUEUE_SIZE = int(os.getenv('HISTORY_QUEUE_SIZE', '10000'))
+MAX_QUERY_LIMIT = 1000
+
+HISTORY_WRITES = registry.counter('deployer_history_writes_total', '写入部署历史的记录数', ('result',))
+HISTORY_BATCH_SECONDS = registry.histogram('deployer_history_batch_seconds', '部署历史每批写入的耗时')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_data (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deployments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    instance_name TEXT,
+    image TEXT,
+    flavor TEXT,
+    network TEXT,
+    services TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    elapsed REAL,
+    user_data_hash TEXT REFERENCES user_data(hash),
+    timings TEXT,
+    output TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS deployment_services (
+    deployment_id INTEGER NOT NULL REFERENCES deployments(id),
+    service TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_deployments_instance ON deployments(instance_name, created_at);
+CREATE INDEX IF NOT EXISTS idx_deployments_created ON deployments(created_at);
+CREATE INDEX IF NOT EXISTS idx_deployments_image ON deployments(image, created_at);
+CREATE INDEX IF NOT EXISTS idx_deployments_services ON deployments(services, created_at);
+CREATE INDEX IF NOT EXISTS idx_deployments_user_data ON deployments(user_data_hash);
+CREATE INDEX IF NOT EXISTS idx_deployment_services ON deployment_services(service, deployment_id);
+'''
+
+# 列表查询不返回CLI输出，按ID查询时才返回
+_LIST_COLUMNS = ('id', 'created_at', 'kind', 'instance_name', 'image', 'flavor', 'network', 'services',
+                 'success', 'elapsed', 'user_data_hash', 'timings', 'error')
+_DETAIL_COLUMNS = _LIST_COLUMNS + ('output',)
+
+
+def user_data_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _row_to_dict(row: Tuple, columns: Tuple[str, ...]) -> Dict[str, Any]:
+    record = dict(zip(columns, row))
+    record['services'] = record['services'].split(',') if record['services'] else []
+    record['success'] = bool(record['success'])
+    if record.get('timings'):
+        record['timings'] = json.loads(record['timings'])
+    return record
+
+
+class DeploymentHistory:
+    """部署历史的SQLite存储：记录在后台线程中按批写入，不占用请求线程；相同的user-data只保存一份
+
+    WAL模式下多个worker进程可以同时写入同一个数据库文件。
+    """
+
+    def __init__(self, path: str, batch_size: int = 100, flush_interval: float = 0.5, max_queue: int = 10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.written = 0
+        self._init_process_state()
+
+    def _init_process_state(self):
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(self.max_queue)
+        self._local = threading.local()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _after_fork(self):
+        # 连接和线程不能跨fork使用
+        self._init_process_state()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if not self._schema_ready:
+            conn.executescript(_SCHEMA)
+            self._schema_ready = True
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # ---- 写入 ----
+
+    def record(self, record: Dict[str, Any]):
+        """登记一条部署记录（非阻塞），队列已满时丢弃"""
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._writer, name='history-writer', daemon=True)
+                    self._thread.start()
+        record.setdefault('created_at', time.time())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            HISTORY_WRITES.inc(result='dropped')
+            logger.warning(f"部署历史写入队列已满，丢弃记录: {record.get('instance_name')}")
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [record for record in batch if record is not None]
+            if batch:
+                self._write_batch(conn, batch)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Dict[str, Any]]):
+        start = time.perf_counter()
+        user_data = {}
+        for record in batch:
+            content = record.pop('user_data', None)
+            if content is not None:
+                digest = user_data_hash(content)
+                user_data[digest] = (digest, content, len(content.encode('utf-8')), record['created_at'])
+                record['user_data_hash'] = digest
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO user_data (hash, content, size, created_at) VALUES (?, ?, ?, ?)',
+                                 list(user_data.values()))
+                for record in batch:
+                    services = sorted(record.get('services', []))
+                    cursor = conn.execute(
+                        'INSERT INTO deployments (created_at, kind, instance_name, image, flavor, network, services, '
+                        'success, elapsed, user_data_hash, timings, output, error) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (record['created_at'], record['kind'], record.get('instance_name'), record.get('image'),
+                         record.get('flavor'), record.get('network'), ','.join(services),
+                         int(bool(record.get('success'))), record.get('elapsed'), record.get('user_data_hash'),
+                         json.dumps(record['timings']) if record.get('timings') else None,
+                         record.get('output'), record.get('error')))
+                    conn.executemany('INSERT INTO deployment_services (deployment_id, service) VALUES (?, ?)',
+                                     [(cursor.lastrowid, service) for service in services])
+        except sqlite3.Error as e:
+            self.dropped += len(batch)
+            HISTORY_WRITES.inc(len(batch), result='error')
+            logger.error(f"写入部署历史失败（{len(batch)}条）: {str(e)}")
+            return
+        self.written += len(batch)
+        HISTORY_WRITES.inc(len(batch), result='ok')
+        HISTORY_BATCH_SECONDS.observe(time.perf_counter() - start)
+
+    def flush(self, timeout: float = 5.0):
+        """等待队列中的记录写完（用于退出前）"""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self, timeout: float = 5.0):
+        """写完队列中的记录后停止写入线程（worker退出前调用，os._exit 不会执行atexit）"""
+        self.flush(timeout)
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            return
+        thread.join(max(0.0, timeout))
+
+    # ---- 查询 ----
+
+    def query(self, instance_name: Optional[str] = None, image: Optional[str] = None, service: Optional[str] = None,
+              services: Optional[List[str]] = None, user_data_hash: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None, success: Optional[bool] = None,
+              limit: int = 100, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按条件查询部署记录，按时间倒序；before_id 用于翻页"""
+        clauses, params = [], []
+        for column, value in (('instance_name', instance_name), ('image', image),
+                              ('user_data_hash', user_data_hash)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if services is not None:
+            clauses.append('services = ?')
+            params.append(','.join(sorted(services)))
+        if service is not None:
+            clauses.append('id IN (SELECT deployment_id FROM deployment_services WHERE service = ?)')
+            params.append(service)
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(until)
+        if success is not None:
+            clauses.append('success = ?')
+            params.append(int(success))
+        if before_id is not None:
+            clauses.append('id < ?')
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        sql = f"SELECT {', '.join(_LIST_COLUMNS)} FROM deployments {where} ORDER BY id DESC LIMIT ?"
+        with timed('history_query'):
+            rows = self._reader().execute(sql, params + [min(limit, MAX_QUERY_LIMIT)]).fetchall()
+        return [_row_to_dict(row, _LIST_COLUMNS) for row in rows]
+
+    def get(self, record_id: int) -> Optional[Dict[str, Any]]:
+        row = self._reader().execute(f"SELECT {', '.join(_DETAIL_COLUMNS)} FROM deployments WHERE id = ?",
+                                     (record_id,)).fetchone()
+        return _row_to_dict(row, _DETAIL_COLUMNS) if row else None
+
+    def get_user_data(self, digest: str) -> Optional[str]:
+        row = self._reader().execute('SELECT content FROM user_data WHERE hash = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def summary(self, instance_name: Optional[str] = None) -> Dict[str, Any]:
+        """记录数、成功数、不同user-data数及平均/最长耗时"""
+        where, params = ('WHERE instance_name = ?', (instance_name,)) if instance_name else ('', ())
+        row = self._reader().execute(
+            f'SELECT COUNT(*), SUM(success), COUNT(DISTINCT user_data_hash), AVG(elapsed), MAX(elapsed) '
+            f'FROM deployments {where}', params).fetchone()
+        return {
+            'deployments': row[0],
+            'succeeded': row[1] or 0,
+            'distinct_user_data': row[2],
+            'avg_elapsed': round(row[3], 3) if row[3] is not None else None,
+            'max_elapsed': row[4]
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'path': self.path,
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped
+        }
+
+
+history: Optional[DeploymentHistory] = None
+if HISTORY_DB:
+    history = DeploymentHistory(HISTORY_DB, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_QUEUE_SIZE)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=history._after_fork)
+    atexit.register(history.flush)
+    registry.gauge('deployer_history_queue_size', '等待写入部署历史的记录数', lambda: history._queue.qsize())
+
+
+def record_deployment(kind: str, openstack_config: Dict[str, Any], services, result: Dict[str, Any],
+                      user_data: Optional[str] = None, timings: Optional[Dict[str, float]] = None,
+                      instance_name: Optional[str] = None):
+    """在部署历史中登记一次实例创建（HISTORY_DB 为空时不记录）"""
+    if history is None:
+        return
+    history.record({
+        'kind': kind,
+        'instance_name': instance_name or openstack_config.get('instance_name'),
+        'image': openstack_config.get('image'),
+        'flavor': openstack_config.get('flavor'),
+        'network': openstack_config.get('network'),
+        'services': list(services),
+        'success': result.get('success', False),
+        'elapsed': result.get('elapsed', (timings or {}).get('total')),
+        'timings': timings,
+        'output': result.get('output'),
+        'error': result.get('error'),
+        'user_data': user_data
+    })
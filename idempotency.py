@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional, Tuple
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+EXECUTED = 'executed'
+COALESCED = 'coalesced'
+REPLAYED = 'replayed'
+REMOTE_POLL_INTERVAL = 0.25
+# 每登记这么多条结果清理一次共享目录中过期的记录
+SWEEP_EVERY = 100
+
+IDEMPOTENT_REQUESTS = registry.counter('deployer_idempotent_requests_total',
+                                       '带幂等键的部署请求数（executed/coalesced/replayed）', ('outcome',))
+
+
+class IdempotencyConflictError(Exception):
+    """同一幂等键对应了不同的请求内容（422），或该键正在以不同的请求内容执行、等待超时（409）"""
+
+    def __init__(self, message: str, status_code: int = 409):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Flight:
+    """进程内正在执行的一次请求，重复请求等待其结果；执行失败时 result 保持为None"""
+
+    __slots__ = ('fingerprint', 'event', 'result')
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.event = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class IdempotencyStore:
+    """按幂等键合并并发的重复请求（single-flight），并在TTL内向迟到的重复请求返回已完成的结果
+
+    设置 state_dir 时通过其中的记录文件在多个worker进程间协调：先创建记录文件的进程执行，
+    其他进程轮询等待结果；执行进程退出而未写入结果时由下一个请求接管。
+    执行失败（异常或结果不可缓存）时，无论等待者在同一进程还是其他进程，都由等待者重新执行；
+    等待最多 wait_timeout 秒。
+    """
+
+    def __init__(self, max_entries: int = 10000, state_dir: Optional[str] = None, wait_timeout: float = 600.0):
+        self.max_entries = max_entries
+        self.state_dir = state_dir
+        self.wait_timeout = wait_timeout
+        self._results: "OrderedDict[str, Tuple[float, str, Dict[str, Any]]]" = OrderedDict()
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stored = 0
+        self.counts = {EXECUTED: 0, COALESCED: 0, REPLAYED: 0}
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    @staticmethod
+    def _mismatch(key: str) -> IdempotencyConflictError:
+        return IdempotencyConflictError(f'{key} 已用于内容不同的请求', 422)
+
+    @staticmethod
+    def _busy(key: str) -> IdempotencyConflictError:
+        return IdempotencyConflictError(f'{key} 正在以不同的请求内容执行，请稍后重试', 409)
+
+    def _timeout(self, key: str) -> IdempotencyConflictError:
+        return IdempotencyConflictError(f'{key} 仍在执行，等待超过{self.wait_timeout:.0f}秒，请稍后重试', 409)
+
+    def _lookup(self, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        expires_at, stored_fingerprint, result = entry
+        if expires_at <= time.time():
+            del self._results[key]
+            return None
+        if stored_fingerprint != fingerprint:
+            raise self._mismatch(key)
+        return result
+
+    def run(self, key: str, fingerprint: str, func: Callable[[], Dict[str, Any]], ttl: float,
+            cacheable: Callable[[Dict[str, Any]], bool]) -> Tuple[Dict[str, Any], str]:
+        """执行 func 或复用同一键的结果，返回 (结果, executed/coalesced/replayed)"""
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self._lock:
+                result = self._lookup(key, fingerprint)
+                flight = self._flights.get(key)
+                owner = result is None and flight is None
+                if owner:
+                    flight = self._flights[key] = _Flight(fingerprint)
+            if result is not None:
+                return self._count(result, REPLAYED)
+            if owner:
+                break
+            if flight.fingerprint != fingerprint:
+                raise self._busy(key)
+            if not flight.event.wait(max(0.0, deadline - time.monotonic())):
+                raise self._timeout(key)
+            if flight.result is not None:
+                return self._count(flight.result, COALESCED)
+            # 执行失败：与其他进程中的等待者一样，重新竞争执行
+
+        try:
+            remote = self._claim(key, fingerprint, deadline)
+            if remote is not None:
+                result, outcome = remote
+                flight.result = result
+                return self._count(result, outcome)
+            try:
+                result = func()
+            except BaseException:
+                self._release(key)
+                raise
+            if cacheable(result):
+                self._store(key, fingerprint, result, ttl)
+                flight.result = result
+            else:
+                self._release(key)
+            return self._count(result, EXECUTED)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def _count(self, result: Dict[str, Any], outcome: str) -> Tuple[Dict[str, Any], str]:
+        self.counts[outcome] += 1
+        IDEMPOTENT_REQUESTS.inc(outcome=outcome)
+        return result, outcome
+
+    def forget(self, key: str):
+        """丢弃已缓存的结果（例如对应的异步任务已失败，允许重新执行）"""
+        with self._lock:
+            self._results.pop(key, None)
+        if self.state_dir:
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def _store(self, key: str, fingerprint: str, result: Dict[str, Any], ttl: float):
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._results[key] = (expires_at, fingerprint, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+            self._stored += 1
+            sweep = self._stored % SWEEP_EVERY == 0
+        if not self.state_dir:
+            return
+        path = self._path(key)
+        try:
+            with open(f'{path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'state': 'done', 'fingerprint': fingerprint, 'expires_at': expires_at, 'result': result},
+                          f, ensure_ascii=False)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f'写入幂等记录失败: {key}: {str(e)}')
+            self._release(key)
+        if sweep:
+            self._sweep()
+
+    # ---- 多进程协调 ----
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.state_dir, f"idem-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}.json")
+
+    def _read(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _claim(self, key: str, fingerprint: str, deadline: float) -> Optional[Tuple[Dict[str, Any], str]]:
+        """创建记录文件后返回None由本进程执行；其他进程已有结果或正在执行时返回其结果，最多等到 deadline"""
+        if not self.state_dir:
+            return None
+        path = self._path(key)
+        waited = False
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({'state': 'running', 'fingerprint': fingerprint, 'pid': os.getpid()}, f)
+                return None
+            data = self._read(path)
+            if data is None or 'state' not in data:
+                # 记录文件刚被创建、尚未写完；长时间不完整说明创建者已退出
+                try:
+                    if time.time() - os.stat(path).st_mtime > 5:
+                        os.unlink(path)
+                except OSError:
+                    pass
+                time.sleep(REMOTE_POLL_INTERVAL / 5)
+                continue
+            if data['state'] == 'done':
+                if data['expires_at'] <= time.time():
+                    self._unlink_if_same(path, data)
+                    continue
+                if data['fingerprint'] != fingerprint:
+                    raise self._mismatch(key)
+                with self._lock:
+                    self._results[key] = (data['expires_at'], fingerprint, data['result'])
+                return data['result'], COALESCED if waited else REPLAYED
+            if data['fingerprint'] != fingerprint:
+                raise self._busy(key)
+            if not _pid_alive(data['pid']):
+                logger.warning(f'幂等记录的执行进程 {data["pid"]} 已退出，接管: {key}')
+                self._unlink_if_same(path, data)
+                continue
+            if time.monotonic() >= deadline:
+                raise self._timeout(key)
+            waited = True
+            time.sleep(REMOTE_POLL_INTERVAL)
+
+    def _unlink_if_same(self, path: str, data: Dict[str, Any]):
+        # 其他进程可能已经接管并重写了记录
+        if self._read(path) == data:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _release(self, key: str):
+        if self.state_dir:
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def _sweep(self):
+        now = time.time()
+        try:
+            names = [name for name in os.listdir(self.state_dir) if name.startswith('idem-') and name.endswith('.json')]
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.state_dir, name)
+            data = self._read(path)
+            if data and data.get('state') == 'done' and data['expires_at'] <= now:
+                self._unlink_if_same(path, data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'hits': self.counts[COALESCED] + self.counts[REPLAYED], 'misses': self.counts[EXECUTED],
+                    'size': len(self._results), 'in_flight': len(self._flights), **self.counts}
+
+
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_INSTANCE_TTL = float(os.getenv('IDEMPOTENCY_INSTANCE_TTL', '300'))
+idempotency_store = IdempotencyStore(int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '10000')),
+                                     os.getenv('JOB_STATE_DIR') or None,
+                                     float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', '600')))
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=idempotency_store._after_fork)
+registry.register_cache('idempotency', idempotency_store.stats)
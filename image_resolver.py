@@ -0,0 +1,279 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Iterable, List, Optional, Tuple
+from metrics import registry, timed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OS_TYPE = 'ubuntu'
+MEMO_MAX_SIZE = 1024
+# 烘焙镜像上登记已安装能力的Glance属性，值为逗号分隔的能力名
+CAPABILITIES_PROPERTY = 'deployer_capabilities'
+
+_TOKEN_RE = re.compile(r'[a-z]+|\d+')
+
+
+def normalize_tokens(name: str) -> Tuple[str, ...]:
+    """将镜像名规范化为token序列：小写，按非字母数字及字母/数字边界切分"""
+    return tuple(_TOKEN_RE.findall(name.lower()))
+
+
+def parse_capabilities(value: Any) -> Tuple[str, ...]:
+    """解析能力列表（逗号分隔的字符串或列表）"""
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(sorted({str(item).strip() for item in value or () if str(item).strip()}))
+
+
+def _parse_properties(raw: Any) -> Dict[str, str]:
+    """解析 image list --long 输出中的 Properties 字段（dict 或 key='value' 字符串）"""
+    if isinstance(raw, dict):
+        return {str(k): str(v) for k, v in raw.items()}
+    if isinstance(raw, str):
+        return dict(re.findall(r"(\w+)='([^']*)'", raw))
+    return {}
+
+
+class TokenIndex:
+    """按token序列索引的镜像名模式，查找镜像名中最长的匹配（依次比较token数、优先级、字符数）"""
+
+    def __init__(self, patterns: Iterable[Tuple[str, Any, int]]):
+        self._index: Dict[str, List[Tuple[Tuple[str, ...], Any, Tuple[int, int, int]]]] = {}
+        for pattern, value, priority in patterns:
+            tokens = normalize_tokens(pattern)
+            if not tokens:
+                continue
+            rank = (len(tokens), priority, len(''.join(tokens)))
+            self._index.setdefault(tokens[0], []).append((tokens, value, rank))
+        for candidates in self._index.values():
+            candidates.sort(key=lambda c: c[2], reverse=True)
+
+    def match(self, name: str) -> Optional[Any]:
+        tokens = normalize_tokens(name)
+        best = None
+        for i, token in enumerate(tokens):
+            for pattern, value, rank in self._index.get(token, ()):
+                if best is not None and rank <= best[1]:
+                    break
+                if tokens[i:i + len(pattern)] == pattern:
+                    best = (value, rank)
+                    break
+        return best[0] if best else None
+
+
+class GlanceImageCatalog:
+    """缓存的Glance镜像元数据快照，按镜像ID和名称索引 os_distro/os_version 及已安装能力
+
+    第一次使用时同步获取；之后超过TTL时在后台线程刷新，刷新完成前继续使用旧快照。
+    """
+
+    def __init__(self, fetch: Callable[[], List[Dict[str, Any]]], ttl: float = 300.0):
+        self._fetch = fetch
+        self.ttl = ttl
+        self._index: Dict[str, Dict[str, str]] = {}
+        self._fetched_at: Optional[float] = None
+        self.generation = 0
+        # _lock 保护 _refreshing；_fetch_lock 保证同时只获取一次，后台获取期间请求不等待
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        with self._lock:
+            self._refreshing = False
+
+    def _stale(self) -> bool:
+        return self._fetched_at is None or time.monotonic() - self._fetched_at >= self.ttl
+
+    def refresh_if_stale(self):
+        """还没有快照时同步获取，快照过期时启动后台刷新并立即返回"""
+        if not self._stale():
+            return
+        if self._fetched_at is None:
+            with self._fetch_lock:
+                if self._fetched_at is None:
+                    self._refresh()
+            return
+        with self._lock:
+            if self._refreshing or not self._stale():
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name='glance-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._fetch_lock:
+                self._refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh(self):
+        try:
+            with timed('glance_refresh'):
+                images = self._fetch()
+        except Exception as e:
+            # 获取失败时沿用旧快照，避免每次请求都重试
+            logger.warning(f"获取Glance镜像元数据失败: {str(e)}")
+            self._fetched_at = time.monotonic()
+            return
+        index = {}
+        for image in images:
+            props = _parse_properties(image.get('Properties', image.get('properties')))
+            if 'os_distro' not in props and CAPABILITIES_PROPERTY not in props:
+                continue
+            meta = {'os_distro': props.get('os_distro', '').lower(), 'os_version': props.get('os_version', ''),
+                    'capabilities': parse_capabilities(props.get(CAPABILITIES_PROPERTY))}
+            for key in (image.get('ID', image.get('id')), image.get('Name', image.get('name'))):
+                if key:
+                    index[key] = meta
+        self._index = index
+        self._fetched_at = time.monotonic()
+        self.generation += 1
+        logger.info(f"Glance镜像元数据已刷新，{len(index)}个镜像含os_distro或能力属性")
+
+    def lookup(self, image: str) -> Optional[Dict[str, str]]:
+        self.refresh_if_stale()
+        return self._index.get(image)
+
+
+class ImageResolver:
+    """基于 image_mapping 构建的镜像->操作系统索引，按最长token匹配并按镜像名缓存结果
+
+    image_capabilities 中的镜像名同样按token匹配，如 ubuntu-22.04-20240101 使用 Ubuntu 22.04 登记的能力。
+    两个缓存各自最多保留 MEMO_MAX_SIZE 项，按最近使用淘汰。
+    """
+
+    def __init__(self, image_mapping: Dict[str, str], os_types, catalog: Optional[GlanceImageCatalog] = None,
+                 image_capabilities: Optional[Dict[str, Any]] = None):
+        self.os_types = frozenset(os_types)
+        self.catalog = catalog
+        # 操作系统名本身作为最低优先级的模式，用于识别未登记版本的镜像
+        self._names = TokenIndex([(os_type, os_type, 0) for os_type in self.os_types] +
+                                 [(pattern, os_type, 1) for pattern, os_type in image_mapping.items()])
+        self._capabilities = TokenIndex((pattern, parse_capabilities(capabilities), 0)
+                                        for pattern, capabilities in (image_capabilities or {}).items())
+        self._memo: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+        self._capability_memo: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _after_fork(self):
+        self._memo_lock = threading.Lock()
+
+    def _memo_get(self, memo: OrderedDict, key) -> Optional[Any]:
+        with self._memo_lock:
+            value = memo.get(key)
+            if value is not None:
+                memo.move_to_end(key)
+            return value
+
+    def _memo_put(self, memo: OrderedDict, key, value):
+        with self._memo_lock:
+            memo[key] = value
+            memo.move_to_end(key)
+            while len(memo) > MEMO_MAX_SIZE:
+                memo.popitem(last=False)
+
+    def _match_name(self, image_name: str) -> Optional[str]:
+        return self._names.match(image_name)
+
+    def configured_capabilities(self, image_name: str) -> Tuple[str, ...]:
+        """部署配置 image_capabilities 中与镜像名匹配的能力"""
+        capabilities = self._memo_get(self._capability_memo, image_name)
+        if capabilities is None:
+            capabilities = self._capabilities.match(image_name) or ()
+            self._memo_put(self._capability_memo, image_name, capabilities)
+        return capabilities
+
+    def _match_metadata(self, image_name: str) -> Optional[str]:
+        if self.catalog is None:
+            return None
+        meta = self.catalog.lookup(image_name)
+        if not meta or not meta['os_distro']:
+            return None
+        if meta['os_distro'] in self.os_types:
+            return meta['os_distro']
+        return self._match_name(f"{meta['os_distro']} {meta['os_version']}")
+
+    def resolve(self, image_name: str) -> str:
+        # 先检查快照是否过期，Glance元数据刷新后 generation 变化，旧的结果不再命中
+        if self.catalog is not None:
+            self.catalog.refresh_if_stale()
+        generation = self.catalog.generation if self.catalog else 0
+        key = (image_name, generation)
+        os_type = self._memo_get(self._memo, key)
+        if os_type is not None:
+            with self._memo_lock:
+                self.hits += 1
+            return os_type
+
+        with self._memo_lock:
+            self.misses += 1
+        os_type = self._match_metadata(image_name) or self._match_name(image_name)
+        if os_type is None:
+            logger.warning(f"无法识别镜像 {image_name} 的操作系统，默认使用 {DEFAULT_OS_TYPE}")
+            os_type = DEFAULT_OS_TYPE
+
+        self._memo_put(self._memo, key, os_type)
+        return os_type
+
+
+def _fetch_glance_images() -> List[Dict[str, Any]]:
+    from openstack_manager import list_images
+    result = list_images()
+    if not result['success']:
+        raise Exception(result['error'])
+    return result['images']
+
+
+glance_catalog: Optional[GlanceImageCatalog] = None
+if os.getenv('OPENSTACK_IMAGE_METADATA', 'false').lower() == 'true':
+    glance_catalog = GlanceImageCatalog(_fetch_glance_images, float(os.getenv('OPENSTACK_IMAGE_METADATA_TTL', '300')))
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=glance_catalog._after_fork)
+
+_resolver_lock = threading.Lock()
+_resolver: Optional[Tuple[str, ImageResolver]] = None
+
+
+def _after_fork():
+    global _resolver_lock
+    _resolver_lock = threading.Lock()
+    if _resolver is not None:
+        _resolver[1]._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _resolver_stats() -> Dict[str, Any]:
+    resolver = _resolver[1] if _resolver else None
+    if resolver is None:
+        return {'hits': 0, 'misses': 0, 'size': 0}
+    with resolver._memo_lock:
+        return {'hits': resolver.hits, 'misses': resolver.misses, 'size': len(resolver._memo)}
+
+
+registry.register_cache('image_resolver', _resolver_stats)
+
+
+def get_resolver(version: str, image_mapping: Dict[str, str], os_types,
+                 image_capabilities: Optional[Dict[str, Any]] = None) -> ImageResolver:
+    """每个配置版本只构建一次解析器"""
+    global _resolver
+    current = _resolver
+    if current is not None and current[0] == version:
+        return current[1]
+    with _resolver_lock:
+        if _resolver is None or _resolver[0] != version:
+            _resolver = (version, ImageResolver(image_mapping, os_types, glance_catalog, image_capabilities))
+        return _resolver[1]
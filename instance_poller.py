@@ -0,0 +1,284 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+from openstack_backend import get_backend
+from metrics import registry, timed
+from shared_state import LeaderLock, SharedFile, SHARED_POLL_INTERVAL, touch, mtime
+
+logger = logging.getLogger(__name__)
+
+
+def _list_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """将 server list --long 的行转换为 server list 的列"""
+    return {
+        'ID': row.get('ID'),
+        'Name': row.get('Name'),
+        'Status': row.get('Status'),
+        'Networks': row.get('Networks', {}),
+        'Image': row.get('Image Name', row.get('Image')),
+        'Flavor': row.get('Flavor Name', row.get('Flavor'))
+    }
+
+
+def _status_record(row: Dict[str, Any]) -> Dict[str, Any]:
+    """与 get_instance_status 返回的 instance 字段一致（CLI的列表输出不含created/updated）"""
+    return {
+        'id': row.get('ID'),
+        'name': row.get('Name'),
+        'status': row.get('Status'),
+        'power_state': row.get('Power State'),
+        'task_state': row.get('Task State'),
+        'created': row.get('Created'),
+        'updated': row.get('Updated'),
+        'addresses': row.get('Networks', {})
+    }
+
+
+class InstanceSnapshot:
+    """一次 server list --long 的结果，按名称和ID索引"""
+
+    def __init__(self, rows: List[Dict[str, Any]], fetched_at: Optional[float] = None):
+        self.fetched_at = fetched_at or time.time()
+        # 从共享文件加载的快照按写入时间换算
+        self._fetched_monotonic = time.monotonic() - max(0.0, time.time() - self.fetched_at)
+        self.rows = rows
+        self.instances = [_list_row(row) for row in rows]
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.by_name: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            record = _status_record(row)
+            self.by_id[record['id']] = record
+            self.by_name.setdefault(record['name'], []).append(record)
+
+    @property
+    def age(self) -> float:
+        return round(time.monotonic() - self._fetched_monotonic, 3)
+
+    def lookup(self, name_or_id: str) -> List[Dict[str, Any]]:
+        record = self.by_id.get(name_or_id)
+        if record is not None:
+            return [record]
+        return self.by_name.get(name_or_id, [])
+
+
+class InstancePoller:
+    """后台线程定期执行一次 server list --long，维护实例快照并记录状态变化事件
+
+    设置 state_dir 时多个worker中只有一个（leader）查询OpenStack，快照和事件写入共享目录，
+    其他worker读取同一份快照，事件序号在所有worker间一致。
+    """
+
+    def __init__(self, interval: float = 10.0, max_events: int = 1000, state_dir: Optional[str] = None):
+        self.interval = interval
+        self.state_dir = state_dir
+        self.snapshot: Optional[InstanceSnapshot] = None
+        self.last_error: Optional[str] = None
+        self._events = deque(maxlen=max_events)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._leader: Optional[LeaderLock] = None
+        self._shared: Optional[SharedFile] = None
+        self._poke_seen = 0.0
+
+    def _after_fork(self):
+        # 线程不会被fork复制，子进程需要重新启动轮询
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if self._leader is not None:
+            self._leader._after_fork()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.state_dir:
+            self._leader = LeaderLock(self.state_dir, 'instance-poller')
+            self._shared = SharedFile(os.path.join(self.state_dir, 'instances.json'))
+        self._thread = threading.Thread(target=self._loop, name='instance-poller', daemon=True)
+        self._thread.start()
+        logger.info(f"实例状态轮询已启动，间隔 {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def poke(self):
+        """提前触发一次轮询（例如刚创建了实例）"""
+        if self._leader is not None and not self._leader.held:
+            touch(self._poke_path())
+        self._wakeup.set()
+
+    def _poke_path(self) -> str:
+        return os.path.join(self.state_dir, 'instances.poke')
+
+    def _loop(self):
+        next_refresh = 0.0
+        while not self._stop.is_set():
+            if self._lead():
+                if time.monotonic() >= next_refresh or self._poke_requested():
+                    self.refresh()
+                    next_refresh = time.monotonic() + self.interval
+                timeout = next_refresh - time.monotonic()
+                if self._leader is not None:
+                    # 还要检查其他worker的提前轮询请求
+                    timeout = min(timeout, SHARED_POLL_INTERVAL)
+            else:
+                self._follow()
+                timeout = SHARED_POLL_INTERVAL
+            if self._wakeup.wait(max(0.0, timeout)):
+                self._wakeup.clear()
+                next_refresh = 0.0
+
+    def _lead(self) -> bool:
+        if self._leader is None or self._leader.held:
+            return True
+        if not self._leader.acquire():
+            return False
+        # 接替上一任leader：从其写入的快照继续，事件序号保持连续
+        self._follow()
+        return True
+
+    def _poke_requested(self) -> bool:
+        if self._leader is None:
+            return False
+        requested = mtime(self._poke_path())
+        if requested > self._poke_seen:
+            self._poke_seen = requested
+            return True
+        return False
+
+    def _follow(self):
+        data = self._shared.load_if_changed()
+        if data is None:
+            return
+        snapshot = InstanceSnapshot(data['rows'], data['fetched_at']) if data.get('fetched_at') else None
+        with self._cond:
+            self.snapshot = snapshot
+            self.last_error = data.get('last_error')
+            self._seq = data.get('seq', 0)
+            self._events.clear()
+            self._events.extend(data.get('events', []))
+            self._cond.notify_all()
+
+    def _publish(self):
+        if self._shared is None:
+            return
+        snapshot = self.snapshot
+        try:
+            self._shared.write({
+                'fetched_at': snapshot.fetched_at if snapshot else None,
+                'rows': snapshot.rows if snapshot else [],
+                'last_error': self.last_error,
+                'seq': self._seq,
+                'events': list(self._events)
+            })
+        except OSError as e:
+            logger.warning(f"写入共享实例快照失败: {str(e)}")
+
+    def refresh(self):
+        try:
+            with timed('instance_poll'):
+                rows = get_backend().list_servers(long=True)
+        except Exception as e:
+            # 保留旧快照，通过 age 体现数据陈旧程度
+            self.last_error = str(e)
+            logger.warning(f"实例状态轮询失败: {self.last_error}")
+            with self._cond:
+                self._publish()
+            return
+        snapshot = InstanceSnapshot(rows)
+        with self._cond:
+            previous = self.snapshot
+            if previous is not None:
+                self._record_transitions(previous, snapshot)
+            self.snapshot = snapshot
+            self.last_error = None
+            self._publish()
+            self._cond.notify_all()
+
+    def _record_transitions(self, previous: InstanceSnapshot, current: InstanceSnapshot):
+        for instance_id, record in current.by_id.items():
+            old = previous.by_id.get(instance_id)
+            if old is None:
+                self._append_event('created', record, None)
+            elif (old['status'], old['power_state'], old['task_state']) != \
+                    (record['status'], record['power_state'], record['task_state']):
+                self._append_event('changed', record, old)
+        for instance_id, old in previous.by_id.items():
+            if instance_id not in current.by_id:
+                self._append_event('deleted', old, old)
+
+    def _append_event(self, event_type: str, record: Dict[str, Any], old: Optional[Dict[str, Any]]):
+        self._seq += 1
+        self._events.append({
+            'seq': self._seq,
+            'time': time.time(),
+            'type': event_type,
+            'id': record['id'],
+            'name': record['name'],
+            'status': None if event_type == 'deleted' else record['status'],
+            'power_state': None if event_type == 'deleted' else record['power_state'],
+            'task_state': None if event_type == 'deleted' else record['task_state'],
+            'previous_status': old['status'] if old else None
+        })
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def wait_for_events(self, seq: int, timeout: float, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """等待 seq 之后的事件，超时返回空列表"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = [event for event in self._events
+                          if event['seq'] > seq and (name is None or name in (event['name'], event['id']))]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._cond.wait(remaining)
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            'enabled': self.running,
+            'interval': self.interval,
+            'age': snapshot.age if snapshot else None,
+            'instances': len(snapshot.instances) if snapshot else 0,
+            'last_seq': self._seq,
+            'last_error': self.last_error,
+            'role': None if self._leader is None else ('leader' if self._leader.held else 'follower')
+        }
+
+
+POLL_INTERVAL = float(os.getenv('INSTANCE_POLL_INTERVAL', '10'))
+instance_poller = InstancePoller(POLL_INTERVAL, state_dir=os.getenv('JOB_STATE_DIR') or None)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=instance_poller._after_fork)
+registry.gauge('deployer_instance_snapshot_age_seconds', '实例快照距上次成功轮询的时间（无快照时为-1）',
+               lambda: instance_poller.snapshot.age if instance_poller.snapshot else -1)
+
+
+def start_instance_poller():
+    """INSTANCE_POLL_INTERVAL 大于0时启动后台轮询"""
+    if POLL_INTERVAL > 0:
+        instance_poller.start()
+
+
+def get_snapshot() -> Optional[InstanceSnapshot]:
+    """轮询已启用且已有快照时返回快照"""
+    if not instance_poller.running:
+        return None
+    return instance_poller.snapshot
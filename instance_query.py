@@ -0,0 +1,125 @@
+import json
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+# server list 输出的列
+COLUMNS = ('ID', 'Name', 'Status', 'Networks', 'Image', 'Flavor')
+_COLUMNS_BY_LOWER = {column.lower(): column for column in COLUMNS}
+
+# 排序字段 -> (列名, Nova sort_key)
+SORT_KEYS = {
+    'id': ('ID', 'uuid'),
+    'name': ('Name', 'display_name'),
+    'status': ('Status', 'vm_state')
+}
+
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 100
+
+
+class InstanceQuery:
+    """/api/instances 的过滤、投影、排序与分页参数"""
+
+    def __init__(self, statuses: Optional[List[str]] = None, name_prefix: Optional[str] = None,
+                 fields: Optional[List[str]] = None, limit: Optional[int] = None,
+                 marker: Optional[str] = None, sort: Optional[str] = None, sort_desc: bool = False):
+        self.statuses = [status.upper() for status in statuses] if statuses else []
+        self.name_prefix = name_prefix
+        self.fields = fields
+        self.limit = limit
+        self.marker = marker
+        self.sort = sort
+        self.sort_desc = sort_desc
+
+    @classmethod
+    def from_args(cls, args) -> 'InstanceQuery':
+        """从请求参数解析，参数无效时抛出ValueError"""
+        statuses = [s for s in args.get('status', '').split(',') if s]
+
+        fields = None
+        if args.get('fields'):
+            fields = []
+            for field in args['fields'].split(','):
+                column = _COLUMNS_BY_LOWER.get(field.strip().lower())
+                if column is None:
+                    raise ValueError(f"未知字段: {field}，可选: {', '.join(COLUMNS)}")
+                fields.append(column)
+
+        limit = None
+        if args.get('limit'):
+            try:
+                limit = int(args['limit'])
+            except ValueError:
+                raise ValueError('limit 必须是整数')
+            if not 1 <= limit <= MAX_LIMIT:
+                raise ValueError(f'limit 必须在1到{MAX_LIMIT}之间')
+
+        sort = args.get('sort')
+        sort_desc = False
+        if sort:
+            sort_desc = sort.startswith('-')
+            sort = sort.lstrip('-').lower()
+            if sort not in SORT_KEYS:
+                raise ValueError(f"不支持的排序字段: {sort}，可选: {', '.join(SORT_KEYS)}")
+
+        return cls(statuses, args.get('name_prefix') or None, fields, limit,
+                   args.get('marker') or None, sort, sort_desc)
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.statuses or self.name_prefix or self.fields or self.limit or self.marker or self.sort)
+
+    def matches(self, row: Dict[str, Any]) -> bool:
+        if self.statuses and (row.get('Status') or '').upper() not in self.statuses:
+            return False
+        if self.name_prefix and not (row.get('Name') or '').startswith(self.name_prefix):
+            return False
+        return True
+
+    def _sort_key(self, row: Dict[str, Any]):
+        # 以ID作为次级排序键，保证marker分页稳定
+        return (row.get(SORT_KEYS[self.sort][0]) or '', row.get('ID') or '')
+
+    def apply(self, rows: Iterable[Dict[str, Any]], paginate: bool = True) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """在内存中过滤、排序并分页，返回 (结果, 下一页marker)"""
+        result = [row for row in rows if self.matches(row)]
+        if self.sort:
+            result.sort(key=self._sort_key, reverse=self.sort_desc)
+        if not paginate:
+            return result, None
+
+        if self.marker:
+            for index, row in enumerate(result):
+                if row.get('ID') == self.marker:
+                    result = result[index + 1:]
+                    break
+            else:
+                raise ValueError(f'marker 不存在: {self.marker}')
+        if self.limit and len(result) > self.limit:
+            result = result[:self.limit]
+            return result, result[-1].get('ID')
+        return result, None
+
+    def project(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        if not self.fields:
+            return row
+        projected = {field: row.get(field) for field in self.fields}
+        if 'Cloud' in row:
+            # 多云查询的结果始终保留所属云
+            projected['Cloud'] = row['Cloud']
+        return projected
+
+
+def stream_json(rows: Iterable[Dict[str, Any]], query: InstanceQuery, meta: Dict[str, Any]) -> Iterator[str]:
+    """逐批序列化实例列表，避免在内存中构建完整的响应体"""
+    yield '{"success": true, "instances": ['
+    batch = []
+    first = True
+    for row in rows:
+        batch.append(json.dumps(query.project(row), ensure_ascii=False))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield ('' if first else ',') + ','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield '], ' + json.dumps(meta, ensure_ascii=False)[1:] if meta else ']}'
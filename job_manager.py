@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Optional
+from metrics import registry, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+REMOTE_POLL_INTERVAL = 0.25
+INTERRUPTED_ERROR = '服务停止时任务尚未完成，已中断'
+
+
+class JobQueueFullError(Exception):
+    """任务队列已满或服务正在停止"""
+
+
+class Job:
+    """一次异步部署任务的状态与耗时"""
+
+    def __init__(self, kind: str, description: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        # 每次状态变化递增，供流式接口判断是否有新状态
+        self.revision = 0
+        # 由其他worker进程执行、从共享状态目录读取的任务
+        self.remote = False
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Job':
+        job = cls(data['kind'], data['description'])
+        job.remote = True
+        job._update(data)
+        return job
+
+    def _update(self, data: Dict[str, Any]):
+        self.id = data['id']
+        self.state = data['state']
+        self.created_at = data['created_at']
+        self.started_at = data.get('started_at')
+        self.finished_at = data.get('finished_at')
+        self.result = data.get('result')
+        self.error = data.get('error')
+        self.revision = data.get('revision', 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        now = time.time()
+        queue_end = self.started_at or self.finished_at or now
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'description': self.description,
+            'state': self.state,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'timings': {
+                'queued_seconds': round(queue_end - self.created_at, 3),
+                'running_seconds': round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+                'total_seconds': round((self.finished_at or now) - self.created_at, 3)
+            }
+        }
+        if self.result is not None:
+            data['result'] = self.result
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+
+class JobManager:
+    """有界线程池执行部署任务，限制并发数与排队深度"""
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 64, retention: int = 1000,
+                 state_dir: Optional[str] = None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retention = retention
+        # 多进程部署时各worker共享的任务状态目录，使任意worker都能查询任务
+        self.state_dir = state_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='deploy-job')
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def submit(self, kind: str, description: str, func: Callable[[], Dict[str, Any]]) -> Job:
+        """提交任务；func 返回带 success 字段的结果字典"""
+        with self._cond:
+            if self._closed:
+                raise JobQueueFullError('服务正在停止，不再接受新任务')
+            if self._pending >= self.max_workers + self.max_queue:
+                raise JobQueueFullError(f'任务队列已满（并发{self.max_workers}，排队上限{self.max_queue}）')
+            job = Job(kind, description)
+            self._jobs[job.id] = job
+            self._pending += 1
+            self._evict()
+            self._publish(job)
+        self._executor.submit(self._run, job, func)
+        logger.info(f'任务已提交: {job.id} ({kind}: {description})')
+        return job
+
+    def _evict(self):
+        # 只淘汰已结束的任务，保留排队和运行中的任务
+        if len(self._jobs) <= self.retention:
+            return
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.retention:
+                break
+            if self._jobs[job_id].state in TERMINAL_STATES:
+                del self._jobs[job_id]
+                if self.state_dir:
+                    try:
+                        os.unlink(self._state_path(job_id))
+                    except OSError:
+                        pass
+
+    def _state_path(self, job_id: str) -> str:
+        return os.path.join(self.state_dir, f'{job_id}.json')
+
+    def _publish(self, job: Job):
+        if not self.state_dir:
+            return
+        path = self._state_path(job.id)
+        try:
+            with open(f'{path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+                json.dump(dict(job.to_dict(), revision=job.revision), f, ensure_ascii=False)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except OSError as e:
+            logger.warning(f'写入任务状态失败: {job.id}: {str(e)}')
+
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not self.state_dir or not job_id.isalnum():
+            return None
+        try:
+            with open(self._state_path(job_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _transition(self, job: Job, state: str):
+        with self._cond:
+            if job.state in TERMINAL_STATES:
+                # 停止时已被标记为中断
+                return
+            job.state = state
+            job.revision += 1
+            if state == RUNNING:
+                job.started_at = time.time()
+            elif state in TERMINAL_STATES:
+                job.finished_at = time.time()
+                self._pending -= 1
+            self._publish(job)
+            self._cond.notify_all()
+
+    def _run(self, job: Job, func: Callable[[], Dict[str, Any]]):
+        self._transition(job, RUNNING)
+        if job.state != RUNNING:
+            return
+        STAGE_SECONDS.observe(job.started_at - job.created_at, stage='job_queue_wait')
+        result, error = None, None
+        try:
+            result = func()
+            state = SUCCEEDED if result.get('success') else FAILED
+            if state == FAILED:
+                error = result.get('error')
+        except Exception as e:
+            logger.error(f'任务执行失败: {job.id}: {str(e)}')
+            error = str(e)
+            state = FAILED
+        with self._cond:
+            if job.state != RUNNING:
+                # 停止时已被标记为中断
+                return
+            job.result = result
+            job.error = error
+            self._transition(job, state)
+        STAGE_SECONDS.observe(job.finished_at - job.started_at, stage='job_run')
+        logger.info(f'任务结束: {job.id} {state}')
+
+    def close(self):
+        """停止接受新任务"""
+        with self._cond:
+            self._closed = True
+
+    def shutdown(self, timeout: float) -> int:
+        """停止接受新任务并最多等待 timeout 秒让已提交的任务结束，未结束的任务标记为失败，返回中断的任务数
+
+        进程随后会直接退出，标记后的状态写入共享状态目录，其他worker查询时能看到任务已中断。
+        """
+        self.close()
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending == 0, timeout=max(0.0, timeout))
+            unfinished = [job for job in self._jobs.values() if job.state not in TERMINAL_STATES]
+            for job in unfinished:
+                job.error = INTERRUPTED_ERROR
+                job.state = FAILED
+                job.revision += 1
+                job.finished_at = time.time()
+                self._pending -= 1
+                self._publish(job)
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if unfinished:
+            logger.warning(f'{len(unfinished)} 个任务未在 {timeout:.1f}s 内完成，已标记为中断')
+        return len(unfinished)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is None:
+            data = self._load(job_id)
+            if data is not None:
+                job = Job.from_dict(data)
+        return job
+
+    def wait_for_change(self, job: Job, revision: int, timeout: float) -> bool:
+        """等待任务状态版本超过 revision，超时返回False"""
+        if not job.remote:
+            with self._cond:
+                return self._cond.wait_for(lambda: job.revision > revision, timeout=timeout)
+        # 其他worker的任务只能轮询共享状态文件
+        deadline = time.monotonic() + timeout
+        while True:
+            data = self._load(job.id)
+            if data is not None and data.get('revision', 0) > revision:
+                job._update(data)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(REMOTE_POLL_INTERVAL, remaining))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job.state == RUNNING)
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'running': running,
+                'queued': self._pending - running,
+                'tracked_jobs': len(self._jobs),
+                'pid': os.getpid()
+            }
+
+
+job_manager = JobManager(
+    max_workers=int(os.getenv('DEPLOY_WORKERS', '4')),
+    max_queue=int(os.getenv('DEPLOY_QUEUE_SIZE', '64')),
+    retention=int(os.getenv('JOB_RETENTION', '1000')),
+    state_dir=os.getenv('JOB_STATE_DIR') or None
+)
+registry.gauge('deployer_jobs_running', '正在执行的异步部署任务数', lambda: job_manager.stats()['running'])
+registry.gauge('deployer_jobs_queued', '排队中的异步部署任务数', lambda: job_manager.stats()['queued'])
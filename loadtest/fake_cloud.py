@@ -0,0 +1,280 @@
+"""模拟 Keystone/Nova/Glance/Neutron 的本地HTTP服务，用于压测和调试
+
+    python loadtest/fake_cloud.py --port 5001 --latency-ms 200 --jitter-ms 50 --failure-rate 0.02 --fleet-size 500
+
+API后端设置 OS_AUTH_URL=http://127.0.0.1:5001/v3 即可连接；loadtest/bin/openstack 通过
+FAKE_OPENSTACK_URL 使用同一份状态。
+"""
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import Dict, Any, List, Optional
+
+IMAGES = [
+    {'name': 'Ubuntu 22.04', 'os_distro': 'ubuntu', 'os_version': '22.04'},
+    {'name': 'Ubuntu 20.04', 'os_distro': 'ubuntu', 'os_version': '20.04'},
+    {'name': 'CentOS 7', 'os_distro': 'centos', 'os_version': '7'},
+    {'name': 'Debian 11', 'os_distro': 'debian', 'os_version': '11'}
+]
+FLAVORS = ['p1', 'p2', 'p4']
+NETWORKS = ['pku']
+KEYPAIRS = ['load']
+SECURITY_GROUPS = ['default']
+AVAILABILITY_ZONES = ['nova']
+
+
+class FakeCloud:
+    """内存中的云状态"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, failure_rate: float = 0.0,
+                 fleet_size: int = 0, build_seconds: float = 5.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.build_seconds = build_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.images = [dict(image, id=str(uuid.UUID(int=i + 1)), status='active', visibility='public')
+                       for i, image in enumerate(IMAGES)]
+        self.flavors = [{'id': f'flavor-{name}', 'name': name} for name in FLAVORS]
+        self.networks = [{'id': str(uuid.UUID(int=1000 + i)), 'name': name} for i, name in enumerate(NETWORKS)]
+        self.servers: Dict[str, Dict[str, Any]] = {}
+        # 已签发的token；带着不在其中的token的请求返回401
+        self.tokens = set()
+        self.counters = {'requests': 0, 'failures': 0, 'auth': 0, 'created': 0}
+        for i in range(fleet_size):
+            self.add_server(f'fleet-{i}', self.images[0]['id'], self.flavors[1], created_at=0.0)
+
+    def add_server(self, name: str, image_id: str, flavor: Dict[str, Any], created_at: Optional[float] = None):
+        server_id = str(uuid.uuid4())
+        self.servers[server_id] = {
+            'id': server_id,
+            'name': name,
+            'image': {'id': image_id},
+            'flavor': {'id': flavor['id'], 'original_name': flavor['name']},
+            'addresses': {'pku': [{'addr': f'10.0.{len(self.servers) // 250}.{len(self.servers) % 250 + 2}'}]},
+            'created_at': time.time() if created_at is None else created_at,
+            'metadata': {}
+        }
+        return self.servers[server_id]
+
+    def revoke_tokens(self):
+        """吊销全部已签发的token（模拟token被提前吊销）"""
+        with self.lock:
+            self.tokens.clear()
+
+    def delay(self):
+        if self.latency_ms or self.jitter_ms:
+            time.sleep(max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+
+    def should_fail(self) -> bool:
+        return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+    def render_server(self, server: Dict[str, Any]) -> Dict[str, Any]:
+        building = time.time() - server['created_at'] < self.build_seconds
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(server['created_at']))
+        return dict(
+            {key: value for key, value in server.items() if key != 'created_at'},
+            status='BUILD' if building else 'ACTIVE',
+            created=created,
+            updated=created,
+            **{
+                'OS-EXT-STS:power_state': 0 if building else 1,
+                'OS-EXT-STS:task_state': 'spawning' if building else None,
+                'OS-EXT-AZ:availability_zone': 'nova'
+            }
+        )
+
+    def list_servers(self, query: Dict[str, List[str]], base: str) -> Dict[str, Any]:
+        with self.lock:
+            servers = [self.render_server(server) for server in self.servers.values()]
+        if 'status' in query:
+            servers = [s for s in servers if s['status'] == query['status'][0].upper()]
+        if 'name' in query:
+            pattern = re.compile(query['name'][0])
+            servers = [s for s in servers if pattern.search(s['name'])]
+        sort_key = {'display_name': 'name', 'uuid': 'id', 'vm_state': 'status'}.get(
+            query.get('sort_key', ['created_at'])[0], 'created')
+        servers.sort(key=lambda s: (s.get(sort_key) or '', s['id']),
+                     reverse=query.get('sort_dir', ['desc' if sort_key == 'created' else 'asc'])[0] == 'desc')
+        if 'marker' in query:
+            ids = [s['id'] for s in servers]
+            if query['marker'][0] not in ids:
+                return {'error': {'code': 400, 'message': f"marker [{query['marker'][0]}] not found"}}
+            servers = servers[ids.index(query['marker'][0]) + 1:]
+        result = {'servers': servers}
+        if 'limit' in query:
+            limit = int(query['limit'][0])
+            if len(servers) > limit:
+                result['servers'] = servers[:limit]
+                result['servers_links'] = [{
+                    'rel': 'next',
+                    'href': f"{base}/compute/v2.1/servers/detail?limit={limit}&marker={servers[limit - 1]['id']}"
+                }]
+        return result
+
+    def create_servers(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        request = body['server']
+        flavor = next((f for f in self.flavors if request['flavorRef'] in (f['id'], f['name'])), None)
+        if flavor is None:
+            return {'error': {'code': 400, 'message': f"Flavor {request['flavorRef']} could not be found."}}
+        count = int(request.get('max_count', 1))
+        with self.lock:
+            if count > 1:
+                names = [f"{request['name']}-{i}" for i in range(1, count + 1)]
+            else:
+                names = [request['name']]
+            created = [self.add_server(name, request['imageRef'], flavor) for name in names]
+            self.counters['created'] += len(created)
+        return {'server': {'id': created[0]['id'], 'adminPass': 'fake'}}
+
+
+def make_handler(cloud: FakeCloud):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # 响应头和响应体分两次写出，避免Nagle与客户端延迟ACK叠加出约40ms的额外延迟
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self) -> Dict[str, Any]:
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        @property
+        def base(self) -> str:
+            return f'http://{self.headers.get("Host")}'
+
+        def handle_request(self, method: str):
+            parsed = urlsplit(self.path)
+            path, query = parsed.path, parse_qs(parsed.query)
+            body = self.read_json() if method == 'POST' else {}
+
+            if path == '/_stats':
+                return self.send_json(200, dict(cloud.counters, servers=len(cloud.servers)))
+
+            with cloud.lock:
+                cloud.counters['requests'] += 1
+            cloud.delay()
+
+            if method == 'POST' and path == '/v3/auth/tokens':
+                with cloud.lock:
+                    cloud.counters['auth'] += 1
+                token = uuid.uuid4().hex
+                with cloud.lock:
+                    cloud.tokens.add(token)
+                expires = time.strftime('%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime(time.time() + 3600))
+                catalog = [
+                    {'type': service_type, 'endpoints': [{'interface': 'public', 'region_id': 'RegionOne',
+                                                          'url': f'{self.base}{prefix}'}]}
+                    for service_type, prefix in (('compute', '/compute/v2.1'), ('image', '/image'),
+                                                 ('network', '/network'))
+                ]
+                return self.send_json(201, {'token': {'expires_at': expires, 'catalog': catalog}},
+                                      {'X-Subject-Token': token})
+
+            token = self.headers.get('X-Auth-Token')
+            if token is not None and token not in cloud.tokens:
+                return self.send_json(401, {'error': {'code': 401, 'message': 'The request you have made requires '
+                                                                              'authentication.'}})
+
+            if cloud.should_fail():
+                with cloud.lock:
+                    cloud.counters['failures'] += 1
+                return self.send_json(500, {'error': {'code': 500, 'message': 'injected failure'}})
+
+            if path == '/compute/v2.1/flavors/detail':
+                return self.send_json(200, {'flavors': cloud.flavors})
+            if path == '/compute/v2.1/servers' and method == 'POST':
+                result = cloud.create_servers(body)
+                return self.send_json(400 if 'error' in result else 202, result)
+            if path == '/compute/v2.1/servers/detail':
+                result = cloud.list_servers(query, self.base)
+                return self.send_json(400 if 'error' in result else 200, result)
+            match = re.fullmatch(r'/compute/v2\.1/servers/([^/]+)', path)
+            if match:
+                server = cloud.servers.get(match.group(1))
+                if server is None:
+                    return self.send_json(404, {'itemNotFound': {'code': 404, 'message': 'Instance could not be found.'}})
+                return self.send_json(200, {'server': cloud.render_server(server)})
+            if path == '/image/v2/images':
+                images = cloud.images
+                if 'name' in query:
+                    images = [image for image in images if image['name'] == query['name'][0]]
+                return self.send_json(200, {'images': images})
+            if path == '/network/v2.0/networks':
+                networks = cloud.networks
+                if 'name' in query:
+                    networks = [network for network in networks if network['name'] == query['name'][0]]
+                return self.send_json(200, {'networks': networks})
+            if path == '/compute/v2.1/os-keypairs':
+                return self.send_json(200, {'keypairs': [{'keypair': {'name': name, 'type': 'ssh'}} for name in KEYPAIRS]})
+            if path == '/network/v2.0/security-groups':
+                return self.send_json(200, {'security_groups': [
+                    {'id': str(uuid.UUID(int=2000 + i)), 'name': name} for i, name in enumerate(SECURITY_GROUPS)
+                ]})
+            if path == '/compute/v2.1/os-availability-zone':
+                return self.send_json(200, {'availabilityZoneInfo': [
+                    {'zoneName': name, 'zoneState': {'available': True}} for name in AVAILABILITY_ZONES
+                ]})
+            return self.send_json(404, {'error': {'code': 404, 'message': f'{method} {path} not found'}})
+
+        def do_GET(self):
+            self.handle_request('GET')
+
+        def do_POST(self):
+            self.handle_request('POST')
+
+    return Handler
+
+
+def start(cloud: FakeCloud, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """在后台线程启动服务，port 为0时自动分配"""
+    server = ThreadingHTTPServer((host, port), make_handler(cloud))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-cloud', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟OpenStack云')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='每个请求的平均延迟')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='延迟的标准差')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='注入500错误的比例（不含认证）')
+    parser.add_argument('--fleet-size', type=int, default=0, help='预置的实例数量（fleet-0..N-1）')
+    parser.add_argument('--build-seconds', type=float, default=5.0, help='新实例从BUILD变为ACTIVE的时间')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    cloud = FakeCloud(args.latency_ms, args.jitter_ms, args.failure_rate, args.fleet_size,
+                      args.build_seconds, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cloud))
+    server.daemon_threads = True
+    print(f'fake cloud listening on http://{args.host}:{server.server_port}/v3', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
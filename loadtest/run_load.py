@@ -0,0 +1,292 @@
+"""app.py 的端到端压测
+
+按目标速率（开环，按计划发送时间计算延迟）请求 /api/deploy-services、/api/instances 和
+/api/instance/status/<name>，输出各接口的吞吐量和延迟分位数。
+
+    # 自动启动模拟云和应用（API后端）
+    python loadtest/run_load.py --spawn --backend api --duration 30 \\
+        --rate deploy=2 --rate instances=20 --rate status=50 --latency-ms 200 --failure-rate 0.01 --fleet-size 500
+
+    # 使用替代的 openstack CLI
+    python loadtest/run_load.py --spawn --backend cli --cli-startup-ms 1500 --rate deploy=1 --rate status=10
+
+    # 压测已在运行的服务
+    python loadtest/run_load.py --target http://127.0.0.1:5000 --rate status=100 --status-names fleet-0,fleet-1
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from typing import Dict, Any, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOADTEST_DIR = os.path.join(ROOT, 'loadtest')
+
+ENDPOINTS = ('deploy', 'instances', 'status')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    parsed = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.netloc, timeout=2)
+            conn.request('GET', parsed.path)
+            if conn.getresponse().status < 500:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'服务未就绪: {url}')
+
+
+class Recorder:
+    """线程安全地记录每个接口的请求结果"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {name: [] for name in ENDPOINTS}
+        self.statuses: Dict[str, Dict[str, int]] = {name: {} for name in ENDPOINTS}
+
+    def record(self, endpoint: str, latency: float, status: str):
+        with self.lock:
+            self.samples[endpoint].append(latency)
+            self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class LoadTest:
+    def __init__(self, target: str, rates: Dict[str, float], duration: float, concurrency: int,
+                 services: List[str], status_names: List[str], timeout: float):
+        self.target = urlsplit(target)
+        self.rates = rates
+        self.duration = duration
+        self.services = services
+        self.status_names = status_names
+        self.timeout = timeout
+        self.recorder = Recorder()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load')
+        self.local = threading.local()
+        self.deployed: List[str] = []
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+
+    def connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.target.netloc, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> int:
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload else {}
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+        return 0
+
+    def next_name(self) -> str:
+        with self.counter_lock:
+            self.counter += 1
+            return f'load-{os.getpid()}-{self.counter}'
+
+    def call(self, endpoint: str):
+        if endpoint == 'deploy':
+            name = self.next_name()
+            body = {
+                'openstack': {'instance_name': name, 'image': 'Ubuntu 22.04', 'flavor': 'p2',
+                              'network': 'pku', 'key_name': 'load'}
+            }
+            body.update({f'enable_{service}': True for service in self.services})
+            status = self.request('POST', '/api/deploy-services', body)
+            if status == 200:
+                with self.counter_lock:
+                    self.deployed.append(name)
+            return status
+        if endpoint == 'instances':
+            return self.request('GET', '/api/instances')
+        names = self.status_names or self.deployed or ['fleet-0']
+        return self.request('GET', f'/api/instance/status/{random.choice(names)}')
+
+    def fire(self, endpoint: str, scheduled: float):
+        try:
+            status = str(self.call(endpoint))
+        except Exception as e:
+            status = type(e).__name__
+        # 从计划发送时间开始计算，排队等待也计入延迟
+        self.recorder.record(endpoint, time.perf_counter() - scheduled, status)
+
+    def drive(self, endpoint: str, rate: float, start: float):
+        interval = 1.0 / rate
+        index = 0
+        while True:
+            scheduled = start + index * interval
+            if scheduled - start >= self.duration:
+                return
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.executor.submit(self.fire, endpoint, scheduled)
+            index += 1
+
+    def run(self) -> Dict[str, Any]:
+        start = time.perf_counter() + 0.1
+        drivers = [threading.Thread(target=self.drive, args=(endpoint, rate, start), daemon=True)
+                   for endpoint, rate in self.rates.items() if rate > 0]
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        self.executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        report = {'elapsed': round(elapsed, 3), 'endpoints': {}}
+        for endpoint, rate in self.rates.items():
+            samples = self.recorder.samples[endpoint]
+            statuses = self.recorder.statuses[endpoint]
+            ok = sum(count for status, count in statuses.items() if status.startswith('2'))
+            report['endpoints'][endpoint] = {
+                'target_rps': rate,
+                'requests': len(samples),
+                'ok': ok,
+                'errors': len(samples) - ok,
+                'throughput_rps': round(ok / elapsed, 2) if elapsed else 0.0,
+                'statuses': statuses,
+                'latency_ms': {
+                    name: round(value * 1000, 2) if value is not None else None
+                    for name, value in (('p50', percentile(samples, 0.50)), ('p90', percentile(samples, 0.90)),
+                                        ('p99', percentile(samples, 0.99)), ('max', max(samples) if samples else None))
+                }
+            }
+        return report
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n耗时 {report['elapsed']}s")
+    print(f"{'endpoint':<10} {'target':>8} {'sent':>7} {'ok':>7} {'err':>6} {'ok rps':>9} "
+          f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for endpoint, data in report['endpoints'].items():
+        latency = data['latency_ms']
+        print(f"{endpoint:<10} {data['target_rps']:>8} {data['requests']:>7} {data['ok']:>7} {data['errors']:>6} "
+              f"{data['throughput_rps']:>9} " + ' '.join(
+                  f"{latency[name] if latency[name] is not None else '-':>9}" for name in ('p50', 'p90', 'p99', 'max')))
+        print(f"{'':<10} statuses: {data['statuses']}")
+
+
+def spawn(args) -> List[subprocess.Popen]:
+    """启动模拟云和应用进程，返回进程列表并设置 args.target"""
+    cloud_port = free_port()
+    app_port = free_port()
+    processes = [subprocess.Popen([
+        sys.executable, os.path.join(LOADTEST_DIR, 'fake_cloud.py'), '--port', str(cloud_port),
+        '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+        '--failure-rate', str(args.failure_rate), '--fleet-size', str(args.fleet_size)
+    ], stdout=subprocess.DEVNULL)]
+    wait_for(f'http://127.0.0.1:{cloud_port}/_stats')
+
+    env = dict(os.environ, OPENSTACK_BACKEND=args.backend, INSTANCE_POLL_INTERVAL=str(args.poll_interval))
+    if args.backend == 'api':
+        env.update(OS_AUTH_URL=f'http://127.0.0.1:{cloud_port}/v3', OS_USERNAME='load', OS_PASSWORD='test',
+                   OS_PROJECT_NAME='load')
+    else:
+        env.pop('OS_AUTH_URL', None)
+        env.update(PATH=os.path.join(LOADTEST_DIR, 'bin') + os.pathsep + env.get('PATH', ''),
+                   FAKE_OPENSTACK_URL=f'http://127.0.0.1:{cloud_port}',
+                   FAKE_CLI_STARTUP_MS=str(args.cli_startup_ms))
+    app_log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+    processes.append(subprocess.Popen([
+        sys.executable, 'app.py', 'serve', '--host', '127.0.0.1', '--port', str(app_port),
+        '--workers', str(args.workers), '--threads', str(args.threads), '--graceful-timeout', '5'
+    ], cwd=ROOT, env=env, stdout=app_log, stderr=app_log))
+    args.target = f'http://127.0.0.1:{app_port}'
+    wait_for(f'{args.target}/api/health')
+    return processes
+
+
+def parse_rates(values: List[str]) -> Dict[str, float]:
+    rates = {}
+    for value in values:
+        endpoint, _, rate = value.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise SystemExit(f'未知接口: {endpoint}，可选: {", ".join(ENDPOINTS)}')
+        rates[endpoint] = float(rate)
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='app.py 端到端压测')
+    parser.add_argument('--target', default='http://127.0.0.1:5000', help='被测服务地址（--spawn 时忽略）')
+    parser.add_argument('--rate', action='append', default=[], help='接口=每秒请求数，可重复，如 status=50')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--concurrency', type=int, default=64, help='客户端最大并发请求数')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--services', default='docker', help='部署时启用的服务，逗号分隔')
+    parser.add_argument('--status-names', default='', help='状态查询使用的实例名，默认使用本次部署的实例')
+    parser.add_argument('--json', help='将报告写入JSON文件')
+    parser.add_argument('--spawn', action='store_true', help='自动启动模拟云和应用')
+    parser.add_argument('--backend', choices=['api', 'cli'], default='api')
+    parser.add_argument('--latency-ms', type=float, default=100.0)
+    parser.add_argument('--jitter-ms', type=float, default=20.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--fleet-size', type=int, default=100)
+    parser.add_argument('--cli-startup-ms', type=float, default=1000.0, help='替代CLI的启动耗时')
+    parser.add_argument('--workers', type=int, default=1, help='--spawn 时应用的worker进程数')
+    parser.add_argument('--threads', type=int, default=32, help='--spawn 时每个worker的请求线程数')
+    parser.add_argument('--poll-interval', type=float, default=10.0, help='应用的 INSTANCE_POLL_INTERVAL')
+    parser.add_argument('--app-log', help='--spawn 时应用日志的输出文件')
+    args = parser.parse_args()
+
+    rates = parse_rates(args.rate) or {'deploy': 1.0, 'instances': 5.0, 'status': 20.0}
+    processes = spawn(args) if args.spawn else []
+    try:
+        status_names = [name for name in args.status_names.split(',') if name]
+        if args.spawn and not status_names and 'deploy' not in rates:
+            status_names = [f'fleet-{i}' for i in range(max(1, args.fleet_size))]
+        test = LoadTest(args.target, rates, args.duration, args.concurrency,
+                        [s for s in args.services.split(',') if s], status_names, args.timeout)
+        report = test.run()
+        report.update(target=args.target, backend=args.backend if args.spawn else None)
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import time
+import bisect
+import threading
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+# 覆盖从缓存命中（微秒级）到CLI调用和实例创建（数十秒）的范围
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签组合: [各桶计数..., +Inf桶计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def labels(self, **labels) -> '_BoundHistogram':
+        """返回绑定了标签的子直方图，热路径上可避免每次重复处理标签"""
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        return _BoundHistogram(self, state)
+
+    def observe(self, value: float, **labels):
+        self.labels(**labels).observe(value)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(state[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class _BoundHistogram:
+    __slots__ = ('_histogram', '_state')
+
+    def __init__(self, histogram: Histogram, state: List[float]):
+        self._histogram = histogram
+        self._state = state
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._histogram.buckets, value)
+        with self._histogram._lock:
+            self._state[index] += 1
+            self._state[-1] += value
+
+
+class CallbackMetric(_Metric):
+    """导出时调用 func 取值，func 返回 {标签值元组: 数值}"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...],
+                 func: Callable[[], Dict[Tuple[str, ...], float]], metric_type: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self._func = func
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._func().items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Registry:
+    """进程内指标注册表，按Prometheus文本格式导出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._caches: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        for name, documentation, field, metric_type in (
+            ('deployer_cache_hits_total', '缓存命中次数', 'hits', 'counter'),
+            ('deployer_cache_misses_total', '缓存未命中次数', 'misses', 'counter'),
+            ('deployer_cache_hit_ratio', '缓存命中率（进程启动以来）', 'hit_ratio', 'gauge'),
+            ('deployer_cache_size', '缓存当前条目数', 'size', 'gauge')
+        ):
+            self.register(CallbackMetric(name, documentation, ('cache',),
+                                         lambda field=field: self._cache_values(field), metric_type))
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'指标已注册: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, func: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, (), lambda: {(): func()}))
+
+    def register_cache(self, name: str, stats: Callable[[], Dict[str, Any]]):
+        """登记一个缓存，stats 返回包含 hits、misses（可选 size）的字典"""
+        self._caches[name] = stats
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for name, stats in list(self._caches.items()):
+            try:
+                values = dict(stats())
+            except Exception:
+                continue
+            if not values:
+                continue
+            lookups = values.get('hits', 0) + values.get('misses', 0)
+            values.setdefault('hit_ratio', values.get('hits', 0) / lookups if lookups else 0.0)
+            result[name] = values
+        return result
+
+    def _cache_values(self, field: str) -> Dict[Tuple[str, ...], float]:
+        return {(name,): values[field] for name, values in self.cache_stats().items() if field in values}
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    'deployer_stage_duration_seconds', '部署流程各阶段耗时（阶段可能嵌套，如render包含config_load）', ('stage',))
+
+# ---- 单个请求的耗时分解 ----
+
+_local = threading.local()
+_stages: Dict[str, _BoundHistogram] = {}
+
+
+class _StageTimer:
+    __slots__ = ('stage', 'histogram', 'start')
+
+    def __init__(self, stage: str):
+        histogram = _stages.get(stage)
+        if histogram is None:
+            histogram = _stages[stage] = STAGE_SECONDS.labels(stage=stage)
+        self.stage = stage
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed)
+        breakdown = getattr(_local, 'breakdown', None)
+        if breakdown is not None:
+            entry = breakdown.get(self.stage)
+            if entry is None:
+                breakdown[self.stage] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+        return False
+
+
+def timed(stage: str) -> _StageTimer:
+    """记录阶段耗时到直方图，并计入当前线程上正在收集的请求耗时分解"""
+    return _StageTimer(stage)
+
+
+def start_breakdown():
+    _local.breakdown = {}
+
+
+def finish_breakdown() -> Optional[Dict[str, Dict[str, Any]]]:
+    """结束收集并返回 {阶段: {'count': 次数, 'ms': 累计毫秒}}"""
+    breakdown = getattr(_local, 'breakdown', None)
+    _local.breakdown = None
+    if breakdown is None:
+        return None
+    return {stage: {'count': count, 'ms': round(elapsed * 1000, 3)} for stage, (count, elapsed) in breakdown.items()}
@@ -0,0 +1,788 @@
+import os
+import re
+import json
+import time
+import base64
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import http.client
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from urllib.parse import urlsplit, urlencode, quote
+from typing import Dict, Any, List, Optional, Tuple, Union
+import yaml
+from metrics import registry, timed
+
+logger = logging.getLogger(__name__)
+
+SUBPROCESS_TOTAL = registry.counter('deployer_subprocess_total', 'openstack CLI子进程调用次数', ('command',))
+SUBPROCESS_FAILURES = registry.counter('deployer_subprocess_failures_total', 'openstack CLI子进程失败次数',
+                                       ('command', 'returncode'))
+SUBPROCESS_SECONDS = registry.histogram('deployer_subprocess_duration_seconds', 'openstack CLI子进程耗时（含启动）',
+                                        ('command',))
+API_REQUESTS = registry.counter('deployer_openstack_api_requests_total', 'OpenStack REST API请求次数',
+                                ('service', 'method', 'status'))
+API_SECONDS = registry.histogram('deployer_openstack_api_duration_seconds', 'OpenStack REST API请求耗时',
+                                 ('service', 'method'))
+
+_UUID_RE = re.compile(r'^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$')
+
+# 与 openstack CLI 的 power_state 显示一致
+POWER_STATES = {
+    0: 'NOSTATE',
+    1: 'Running',
+    3: 'Paused',
+    4: 'Shutdown',
+    6: 'Crashed',
+    7: 'Suspended'
+}
+
+
+class BackendError(Exception):
+    """OpenStack后端调用失败，detail 为CLI的stderr或API的错误信息"""
+
+    def __init__(self, detail: str, returncode: Optional[int] = None, status: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.returncode = returncode
+        self.status = status
+
+
+@contextmanager
+def temp_yaml_file(content: Union[str, bytes]):
+    """上下文管理器用于处理临时YAML文件，bytes内容（如gzip压缩的user-data）按二进制写入"""
+    temp_file = None
+    try:
+        with timed('tempfile_write'):
+            mode = 'wb' if isinstance(content, bytes) else 'w'
+            temp_file = tempfile.NamedTemporaryFile(mode=mode, suffix='.yaml', delete=False)
+            temp_file.write(content)
+            temp_file.flush()
+        yield temp_file.name
+    finally:
+        if temp_file:
+            temp_file.close()
+            if os.path.exists(temp_file.name):
+                os.unlink(temp_file.name)
+
+
+class CLIBackend:
+    """通过 openstack CLI 子进程访问OpenStack"""
+
+    name = 'cli'
+    # openstack CLI 以文本方式读取 --user-data 文件，无法传递gzip压缩的内容
+    supports_binary_user_data = False
+
+    def __init__(self, cloud: Optional[str] = None):
+        # 云配置名，对应 openstack --os-cloud（从 clouds.yaml 读取认证信息）
+        self.cloud = cloud
+
+    def _command(self, cmd: List[str]) -> List[str]:
+        return cmd[:1] + ['--os-cloud', self.cloud] + cmd[1:] if self.cloud else cmd
+
+    def _run(self, cmd: List[str], timeout: Optional[float] = None) -> str:
+        command = ' '.join(cmd[1:3])
+        SUBPROCESS_TOTAL.inc(command=command)
+        start = time.perf_counter()
+        try:
+            with timed('openstack_cli'):
+                result = subprocess.run(self._command(cmd), capture_output=True, text=True, check=True,
+                                        timeout=timeout)
+        except subprocess.CalledProcessError as e:
+            SUBPROCESS_FAILURES.inc(command=command, returncode=e.returncode)
+            raise BackendError(e.stderr, returncode=e.returncode)
+        except subprocess.TimeoutExpired:
+            SUBPROCESS_FAILURES.inc(command=command, returncode='timeout')
+            raise
+        except OSError:
+            SUBPROCESS_FAILURES.inc(command=command, returncode='oserror')
+            raise
+        finally:
+            SUBPROCESS_SECONDS.observe(time.perf_counter() - start, command=command)
+        return result.stdout
+
+    def prepare_user_data(self, user_data: Union[str, bytes]):
+        """批量创建时只写一次临时文件，返回其路径"""
+        return temp_yaml_file(user_data)
+
+    def create_server(self, params: Dict[str, Any], user_data: Union[str, bytes], min_count: int = 1,
+                      max_count: int = 1, user_data_file: Optional[str] = None) -> str:
+        with (nullcontext(user_data_file) if user_data_file else temp_yaml_file(user_data)) as temp_file_path:
+            cmd = [
+                'openstack', 'server', 'create',
+                '--image', params['image'],
+                '--flavor', params['flavor'],
+                '--network', params['network'],
+                '--user-data', temp_file_path,
+                '--key-name', params['key_name']
+            ]
+
+            for sg in params.get('security_groups', []):
+                cmd.extend(['--security-group', sg])
+
+            if 'availability_zone' in params:
+                cmd.extend(['--availability-zone', params['availability_zone']])
+
+            if max_count > 1:
+                cmd.extend(['--min', str(min_count), '--max', str(max_count)])
+
+            cmd.append(params['instance_name'])
+
+            logger.info(f"OpenStack命令: {' '.join(cmd[:3])} ... {params['instance_name']}")
+            return self._run(cmd)
+
+    def show_server(self, name_or_id: str) -> Dict[str, Any]:
+        return json.loads(self._run(['openstack', 'server', 'show', name_or_id, '--format', 'json']))
+
+    # CLI的排序在客户端完成，无法与 --limit/--marker 组合
+    supports_sort = False
+
+    def list_servers(self, long: bool = False, status: Optional[str] = None, name: Optional[str] = None,
+                     limit: Optional[int] = None, marker: Optional[str] = None,
+                     sort_key: Optional[str] = None, sort_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+        cmd = ['openstack', 'server', 'list', '--format', 'json']
+        if long:
+            cmd.append('--long')
+        if status:
+            cmd.extend(['--status', status])
+        if name:
+            cmd.extend(['--name', name])
+        if limit:
+            cmd.extend(['--limit', str(limit)])
+        if marker:
+            cmd.extend(['--marker', marker])
+        return json.loads(self._run(cmd))
+
+    def list_images(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'image', 'list', '--long', '--format', 'json']))
+
+    def list_flavors(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'flavor', 'list', '--format', 'json']))
+
+    def list_networks(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'network', 'list', '--format', 'json']))
+
+    def list_keypairs(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'keypair', 'list', '--format', 'json']))
+
+    def list_security_groups(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'security', 'group', 'list', '--format', 'json']))
+
+    def list_availability_zones(self) -> List[Dict[str, Any]]:
+        return json.loads(self._run(['openstack', 'availability', 'zone', 'list', '--compute', '--format', 'json']))
+
+    def create_image(self, server: str, image_name: str, properties: Dict[str, str], timeout: float) -> Dict[str, Any]:
+        """由实例创建快照镜像并等待其可用，再写入镜像属性"""
+        cmd = ['openstack', 'server', 'image', 'create', '--name', image_name, '--wait', '--format', 'json', server]
+        logger.info(f"OpenStack命令: server image create ... {server} -> {image_name}")
+        try:
+            image = json.loads(self._run(cmd, timeout=timeout))
+        except subprocess.TimeoutExpired:
+            raise BackendError(f"等待镜像 {image_name} 可用超时（{timeout:.0f}秒）")
+        if properties:
+            cmd = ['openstack', 'image', 'set']
+            for key, value in properties.items():
+                cmd.extend(['--property', f'{key}={value}'])
+            self._run(cmd + [image['id']])
+        return {'id': image.get('id'), 'name': image.get('name', image_name), 'status': image.get('status')}
+
+
+# 重复发送不会产生额外副作用的HTTP方法，复用连接失败时可以直接重试
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE'})
+
+
+class ConnectionPool:
+    """按 (scheme, host:port) 复用的keep-alive HTTP连接池"""
+
+    def __init__(self, maxsize: int = 10, timeout: float = 30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.created = 0
+
+    def _acquire(self, key: Tuple[str, str]) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+        scheme, netloc = key
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(netloc, timeout=self.timeout), False
+
+    def _release(self, key: Tuple[str, str], conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def _retryable(method: str, sent: bool, error: Exception) -> bool:
+        """复用的空闲连接可能已被服务端关闭，换新连接重试
+
+        超时不重试；POST等非幂等请求可能已被服务端处理，只在发送时发现连接已关闭（请求未送达）时重试，
+        避免重复创建实例或镜像。
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        return not sent and isinstance(error, (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        parsed = urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        while True:
+            conn, reused = self._acquire(key)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                # 出错的连接状态未知，不放回池中
+                conn.close()
+                if reused and self._retryable(method, sent, e):
+                    logger.debug(f"复用连接失败，重新建立连接: {str(e)}")
+                    continue
+                raise BackendError(f'{method} {url} 请求失败: {str(e) or type(e).__name__}')
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return response.status, {k.lower(): v for k, v in response.getheaders()}, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def _parse_expires_at(value: str) -> float:
+    value = value.replace('Z', '+00:00')
+    return datetime.fromisoformat(value).timestamp()
+
+
+class APIBackend:
+    """直接调用Keystone/Nova/Glance/Neutron REST API，缓存token并复用HTTP连接"""
+
+    name = 'api'
+    supports_binary_user_data = True
+    TOKEN_REFRESH_MARGIN = 60.0
+    LOOKUP_TTL = 300.0
+    # 2.47 起 server 详情中的 flavor 带有 original_name
+    COMPUTE_MICROVERSION = '2.47'
+
+    def __init__(self, auth_url: str, username: Optional[str] = None, password: Optional[str] = None,
+                 project_name: Optional[str] = None, user_domain_name: str = 'Default',
+                 project_domain_name: str = 'Default', region_name: Optional[str] = None,
+                 interface: str = 'public', application_credential_id: Optional[str] = None,
+                 application_credential_secret: Optional[str] = None,
+                 pool: Optional[ConnectionPool] = None):
+        auth_url = auth_url.rstrip('/')
+        if not auth_url.endswith('/v3'):
+            auth_url += '/v3'
+        self.auth_url = auth_url
+        self.username = username
+        self.password = password
+        self.project_name = project_name
+        self.user_domain_name = user_domain_name
+        self.project_domain_name = project_domain_name
+        self.region_name = region_name
+        self.interface = interface
+        self.application_credential_id = application_credential_id
+        self.application_credential_secret = application_credential_secret
+        self.pool = pool or ConnectionPool()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._catalog: List[Dict[str, Any]] = []
+        self._auth_lock = threading.Lock()
+        self._lookups: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._lookup_lock = threading.Lock()
+        self.token_hits = 0
+        self.token_misses = 0
+        self.lookup_hits = 0
+        self.lookup_misses = 0
+
+    @classmethod
+    def from_env(cls) -> 'APIBackend':
+        auth_url = os.getenv('OS_AUTH_URL')
+        if not auth_url:
+            raise ValueError("使用API后端需要设置 OS_AUTH_URL")
+        return cls(
+            auth_url,
+            username=os.getenv('OS_USERNAME'),
+            password=os.getenv('OS_PASSWORD'),
+            project_name=os.getenv('OS_PROJECT_NAME'),
+            user_domain_name=os.getenv('OS_USER_DOMAIN_NAME', 'Default'),
+            project_domain_name=os.getenv('OS_PROJECT_DOMAIN_NAME', 'Default'),
+            region_name=os.getenv('OS_REGION_NAME'),
+            interface=os.getenv('OS_INTERFACE', 'public'),
+            application_credential_id=os.getenv('OS_APPLICATION_CREDENTIAL_ID'),
+            application_credential_secret=os.getenv('OS_APPLICATION_CREDENTIAL_SECRET'),
+            pool=ConnectionPool(int(os.getenv('OPENSTACK_API_POOL_SIZE', '10')),
+                                float(os.getenv('OPENSTACK_API_TIMEOUT', '30')))
+        )
+
+    @classmethod
+    def from_profile(cls, name: str, profile: Dict[str, Any]) -> 'APIBackend':
+        """由 clouds.yaml 中的一个云配置创建"""
+        auth = profile.get('auth', {})
+        if not auth.get('auth_url'):
+            raise ValueError(f"云配置 {name} 缺少 auth.auth_url")
+        return cls(
+            auth['auth_url'],
+            username=auth.get('username'),
+            password=auth.get('password'),
+            project_name=auth.get('project_name'),
+            user_domain_name=auth.get('user_domain_name', 'Default'),
+            project_domain_name=auth.get('project_domain_name', 'Default'),
+            region_name=profile.get('region_name'),
+            interface=profile.get('interface', 'public'),
+            application_credential_id=auth.get('application_credential_id'),
+            application_credential_secret=auth.get('application_credential_secret'),
+            pool=ConnectionPool(int(os.getenv('OPENSTACK_API_POOL_SIZE', '10')),
+                                float(os.getenv('OPENSTACK_API_TIMEOUT', '30')))
+        )
+
+    # ---- Keystone ----
+
+    def _auth_body(self) -> Dict[str, Any]:
+        if self.application_credential_id:
+            return {'auth': {'identity': {
+                'methods': ['application_credential'],
+                'application_credential': {
+                    'id': self.application_credential_id,
+                    'secret': self.application_credential_secret
+                }
+            }}}
+        return {'auth': {
+            'identity': {
+                'methods': ['password'],
+                'password': {'user': {
+                    'name': self.username,
+                    'domain': {'name': self.user_domain_name},
+                    'password': self.password
+                }}
+            },
+            'scope': {'project': {
+                'name': self.project_name,
+                'domain': {'name': self.project_domain_name}
+            }}
+        }}
+
+    def _authenticate(self):
+        self.token_misses += 1
+        with timed('keystone_auth'):
+            status, headers, data = self.pool.request(
+                'POST', f'{self.auth_url}/auth/tokens',
+                body=json.dumps(self._auth_body()).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+        API_REQUESTS.inc(service='identity', method='POST', status=status)
+        if status != 201:
+            raise BackendError(f'Keystone认证失败 ({status}): {data.decode("utf-8", "replace")}', status=status)
+        token = json.loads(data)['token']
+        self._token = headers['x-subject-token']
+        self._expires_at = _parse_expires_at(token['expires_at'])
+        self._catalog = token.get('catalog', [])
+        logger.info(f"Keystone token已获取，过期时间: {token['expires_at']}")
+
+    def _get_token(self) -> str:
+        if self._token and time.time() < self._expires_at - self.TOKEN_REFRESH_MARGIN:
+            self.token_hits += 1
+            return self._token
+        with self._auth_lock:
+            if not self._token or time.time() >= self._expires_at - self.TOKEN_REFRESH_MARGIN:
+                self._authenticate()
+            else:
+                self.token_hits += 1
+            return self._token
+
+    def invalidate_token(self):
+        with self._auth_lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _endpoint(self, service_type: str) -> str:
+        self._get_token()
+        for service in self._catalog:
+            if service.get('type') != service_type:
+                continue
+            for endpoint in service.get('endpoints', []):
+                if endpoint.get('interface') != self.interface:
+                    continue
+                if self.region_name and endpoint.get('region_id', endpoint.get('region')) != self.region_name:
+                    continue
+                return endpoint['url'].rstrip('/')
+        raise BackendError(f'服务目录中未找到 {service_type} 的 {self.interface} 端点')
+
+    # ---- HTTP ----
+
+    def _request(self, method: str, service_type: str, path: str, body: Optional[Dict[str, Any]] = None,
+                 headers: Optional[Dict[str, str]] = None) -> Any:
+        url = path if path.startswith('http') else f'{self._endpoint(service_type)}{path}'
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        for attempt in range(2):
+            request_headers = {'X-Auth-Token': self._get_token(), 'Accept': 'application/json'}
+            if service_type == 'compute':
+                request_headers['OpenStack-API-Version'] = f'compute {self.COMPUTE_MICROVERSION}'
+            if payload is not None:
+                request_headers['Content-Type'] = 'application/json'
+            request_headers.update(headers or {})
+            start = time.perf_counter()
+            with timed('openstack_api'):
+                status, _, data = self.pool.request(method, url, body=payload, headers=request_headers)
+            API_SECONDS.observe(time.perf_counter() - start, service=service_type, method=method)
+            API_REQUESTS.inc(service=service_type, method=method, status=status)
+            if status == 401 and attempt == 0:
+                # token可能已被提前吊销，重新认证后重试一次
+                self.invalidate_token()
+                continue
+            break
+        if status >= 400:
+            raise BackendError(f'{method} {path} 失败 ({status}): {data.decode("utf-8", "replace")}', status=status)
+        return json.loads(data) if data else None
+
+    def _cached_lookup(self, kind: str, key: str, fetch):
+        with self._lookup_lock:
+            cached = self._lookups.get((kind, key))
+            if cached and time.monotonic() - cached[0] < self.LOOKUP_TTL:
+                self.lookup_hits += 1
+                return cached[1]
+            self.lookup_misses += 1
+        # 查询OpenStack时不持有锁，并发的未命中可能各查询一次
+        value = fetch()
+        with self._lookup_lock:
+            self._lookups[(kind, key)] = (time.monotonic(), value)
+        return value
+
+    # ---- 名称解析 ----
+
+    def _image_id(self, image: str) -> str:
+        if _UUID_RE.match(image):
+            return image
+
+        def fetch():
+            images = self._request('GET', 'image', f'/v2/images?{urlencode({"name": image})}')['images']
+            if not images:
+                raise BackendError(f"No Image found for {image}")
+            return images[0]['id']
+        return self._cached_lookup('image', image, fetch)
+
+    def _flavor_id(self, flavor: str) -> str:
+        def fetch():
+            for item in self._request('GET', 'compute', '/flavors/detail')['flavors']:
+                if flavor in (item['id'], item['name']):
+                    return item['id']
+            raise BackendError(f"No Flavor found for {flavor}")
+        return self._cached_lookup('flavor', flavor, fetch)
+
+    def _network_id(self, network: str) -> str:
+        if _UUID_RE.match(network):
+            return network
+
+        def fetch():
+            networks = self._request('GET', 'network', f'/v2.0/networks?{urlencode({"name": network})}')['networks']
+            if not networks:
+                raise BackendError(f"No Network found for {network}")
+            return networks[0]['id']
+        return self._cached_lookup('network', network, fetch)
+
+    def _image_names(self) -> Dict[str, str]:
+        return self._cached_lookup('image_names', '', lambda: {
+            image.get('ID'): image.get('Name') for image in self.list_images()
+        })
+
+    def _paginate(self, service_type: str, path: str, key: str) -> List[Dict[str, Any]]:
+        items = []
+        while path:
+            data = self._request('GET', service_type, path)
+            items.extend(data.get(key, []))
+            path = None
+            for link in data.get(f'{key}_links', []):
+                if link.get('rel') == 'next':
+                    path = link['href']
+            if data.get('next'):
+                path = data['next']
+        return items
+
+    # ---- 服务器操作 ----
+
+    def prepare_user_data(self, user_data: Union[str, bytes]):
+        return nullcontext(None)
+
+    def create_server(self, params: Dict[str, Any], user_data: Union[str, bytes], min_count: int = 1,
+                      max_count: int = 1, user_data_file: Optional[str] = None) -> str:
+        if isinstance(user_data, str):
+            user_data = user_data.encode('utf-8')
+        server = {
+            'name': params['instance_name'],
+            'imageRef': self._image_id(params['image']),
+            'flavorRef': self._flavor_id(params['flavor']),
+            'networks': [{'uuid': self._network_id(params['network'])}],
+            'key_name': params['key_name'],
+            'user_data': base64.b64encode(user_data).decode('ascii')
+        }
+        if 'security_groups' in params:
+            server['security_groups'] = [{'name': sg} for sg in params['security_groups']]
+        if 'availability_zone' in params:
+            server['availability_zone'] = params['availability_zone']
+        if max_count > 1:
+            server['min_count'] = min_count
+            server['max_count'] = max_count
+
+        logger.info(f"Nova API: POST /servers ... {params['instance_name']}")
+        result = self._request('POST', 'compute', '/servers', body={'server': server})
+        return json.dumps(result['server'], ensure_ascii=False, indent=2)
+
+    def _format_server(self, server: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'id': server.get('id'),
+            'name': server.get('name'),
+            'status': server.get('status'),
+            'power_state': POWER_STATES.get(server.get('OS-EXT-STS:power_state'), server.get('OS-EXT-STS:power_state')),
+            'created': server.get('created'),
+            'updated': server.get('updated'),
+            'addresses': {
+                network: [address['addr'] for address in addresses]
+                for network, addresses in server.get('addresses', {}).items()
+            }
+        }
+
+    def show_server(self, name_or_id: str) -> Dict[str, Any]:
+        if _UUID_RE.match(name_or_id):
+            try:
+                return self._format_server(self._request('GET', 'compute', f'/servers/{quote(name_or_id)}')['server'])
+            except BackendError as e:
+                if e.status != 404:
+                    raise
+        name_filter = urlencode({'name': f'^{re.escape(name_or_id)}$'})
+        servers = self._request('GET', 'compute', f'/servers/detail?{name_filter}')['servers']
+        if not servers:
+            raise BackendError(f"No server with a name or ID of '{name_or_id}' exists.", status=404)
+        if len(servers) > 1:
+            raise BackendError(f"More than one server exists with the name '{name_or_id}'.", status=409)
+        return self._format_server(servers[0])
+
+    supports_sort = True
+
+    def list_servers(self, long: bool = False, status: Optional[str] = None, name: Optional[str] = None,
+                     limit: Optional[int] = None, marker: Optional[str] = None,
+                     sort_key: Optional[str] = None, sort_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+        """与 server list [--long] 的JSON输出列名一致；long 时额外返回 Created/Updated"""
+        params = {key: value for key, value in (
+            ('status', status), ('name', name), ('limit', limit), ('marker', marker),
+            ('sort_key', sort_key), ('sort_dir', sort_dir)
+        ) if value}
+        path = '/servers/detail' + (f'?{urlencode(params)}' if params else '')
+        if limit:
+            # 只取一页
+            servers = self._request('GET', 'compute', path)['servers']
+        else:
+            servers = self._paginate('compute', path, 'servers')
+        image_names = self._image_names() if servers else {}
+        result = []
+        for server in servers:
+            image = server.get('image') or {}
+            image_id = image.get('id') if isinstance(image, dict) else None
+            image_name = image_names.get(image_id, image_id) if image_id else 'N/A (booted from volume)'
+            flavor = server.get('flavor') or {}
+            flavor_name = flavor.get('original_name', flavor.get('id'))
+            row = {
+                'ID': server.get('id'),
+                'Name': server.get('name'),
+                'Status': server.get('status'),
+                'Networks': {
+                    network: [address['addr'] for address in addresses]
+                    for network, addresses in server.get('addresses', {}).items()
+                }
+            }
+            if long:
+                power_state = server.get('OS-EXT-STS:power_state')
+                row.update({
+                    'Task State': server.get('OS-EXT-STS:task_state'),
+                    'Power State': POWER_STATES.get(power_state, power_state),
+                    'Image Name': image_name,
+                    'Image ID': image_id,
+                    'Flavor Name': flavor_name,
+                    'Flavor ID': flavor.get('id'),
+                    'Availability Zone': server.get('OS-EXT-AZ:availability_zone'),
+                    'Host': server.get('OS-EXT-SRV-ATTR:host'),
+                    'Properties': server.get('metadata', {}),
+                    'Created': server.get('created'),
+                    'Updated': server.get('updated')
+                })
+            else:
+                row.update({'Image': image_name, 'Flavor': flavor_name})
+            result.append(row)
+        return result
+
+    def list_images(self) -> List[Dict[str, Any]]:
+        images = self._paginate('image', '/v2/images', 'images')
+        return [{
+            'ID': image.get('id'),
+            'Name': image.get('name'),
+            'Disk Format': image.get('disk_format'),
+            'Container Format': image.get('container_format'),
+            'Size': image.get('size'),
+            'Checksum': image.get('checksum'),
+            'Status': image.get('status'),
+            'Visibility': image.get('visibility'),
+            'Protected': image.get('protected'),
+            'Project': image.get('owner'),
+            'Tags': image.get('tags', []),
+            'Properties': {key: image[key] for key in ('os_distro', 'os_version', 'deployer_capabilities') if key in image}
+        } for image in images]
+
+    # 以下列表与对应CLI命令的JSON输出列名一致（只保留资源目录用到的列）
+
+    def list_flavors(self) -> List[Dict[str, Any]]:
+        flavors = self._paginate('compute', '/flavors/detail', 'flavors')
+        return [{'ID': flavor.get('id'), 'Name': flavor.get('name'), 'RAM': flavor.get('ram'),
+                 'Disk': flavor.get('disk'), 'VCPUs': flavor.get('vcpus')} for flavor in flavors]
+
+    def list_networks(self) -> List[Dict[str, Any]]:
+        networks = self._paginate('network', '/v2.0/networks', 'networks')
+        return [{'ID': network.get('id'), 'Name': network.get('name'), 'Subnets': network.get('subnets', [])}
+                for network in networks]
+
+    def list_keypairs(self) -> List[Dict[str, Any]]:
+        keypairs = self._request('GET', 'compute', '/os-keypairs')['keypairs']
+        return [{'Name': item['keypair'].get('name'), 'Fingerprint': item['keypair'].get('fingerprint'),
+                 'Type': item['keypair'].get('type')} for item in keypairs]
+
+    def list_security_groups(self) -> List[Dict[str, Any]]:
+        groups = self._paginate('network', '/v2.0/security-groups', 'security_groups')
+        return [{'ID': group.get('id'), 'Name': group.get('name'), 'Project': group.get('project_id')}
+                for group in groups]
+
+    def list_availability_zones(self) -> List[Dict[str, Any]]:
+        zones = self._request('GET', 'compute', '/os-availability-zone')['availabilityZoneInfo']
+        return [{'Zone Name': zone.get('zoneName'),
+                 'Zone Status': 'available' if (zone.get('zoneState') or {}).get('available') else 'not available'}
+                for zone in zones]
+
+    IMAGE_POLL_INTERVAL = 5.0
+
+    def create_image(self, server: str, image_name: str, properties: Dict[str, str], timeout: float) -> Dict[str, Any]:
+        """createImage 动作（2.45起直接返回image_id）后轮询Glance直到镜像可用"""
+        server_id = self.show_server(server)['id']
+        logger.info(f"Nova API: POST /servers/{server_id}/action createImage -> {image_name}")
+        result = self._request('POST', 'compute', f'/servers/{quote(server_id)}/action', body={
+            'createImage': {'name': image_name, 'metadata': properties}
+        })
+        image_id = result['image_id']
+        deadline = time.monotonic() + timeout
+        while True:
+            image = self._request('GET', 'image', f'/v2/images/{quote(image_id)}')
+            if image.get('status') == 'active':
+                return {'id': image_id, 'name': image.get('name', image_name), 'status': 'active'}
+            if image.get('status') in ('killed', 'deleted', 'deactivated'):
+                raise BackendError(f"镜像 {image_name} 创建失败，状态: {image.get('status')}")
+            if time.monotonic() >= deadline:
+                raise BackendError(f"等待镜像 {image_name} 可用超时（{timeout:.0f}秒）")
+            time.sleep(self.IMAGE_POLL_INTERVAL)
+
+
+# 可重入：get_backend 持有该锁创建后端时，create_backend 会调用 load_cloud_profiles
+_backend_lock = threading.RLock()
+_backend = None
+# 与 openstack CLI 相同的 clouds.yaml 格式：{clouds: {名称: {auth: {...}, region_name: ...}}}
+CLOUDS_FILE = os.getenv('OS_CLIENT_CONFIG_FILE', 'clouds.yaml')
+_cloud_backends: Dict[str, Any] = {}
+_cloud_profiles: Optional[Tuple[float, Dict[str, Any]]] = None
+
+
+def load_cloud_profiles() -> Dict[str, Any]:
+    """读取云配置（文件变化时重新读取），文件不存在时返回空字典"""
+    global _cloud_profiles
+    try:
+        mtime = os.stat(CLOUDS_FILE).st_mtime
+    except FileNotFoundError:
+        return {}
+    cached = _cloud_profiles
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(CLOUDS_FILE, encoding='utf-8') as f:
+        profiles = (yaml.safe_load(f) or {}).get('clouds') or {}
+    # 与 get_backend 使用同一把锁，避免按旧配置创建的后端在清空之后才放入缓存
+    with _backend_lock:
+        _cloud_profiles = (mtime, profiles)
+        # 认证信息可能已变化
+        _cloud_backends.clear()
+    return profiles
+
+
+def cloud_names() -> List[str]:
+    return list(load_cloud_profiles())
+
+
+def create_backend(kind: Optional[str] = None, cloud: Optional[str] = None):
+    """按 OPENSTACK_BACKEND（cli/api/auto）创建后端，auto 在设置了 OS_AUTH_URL（或云配置含 auth_url）时使用API
+
+    cloud 为 clouds.yaml 中的云配置名，为None时使用 OS_* 环境变量。
+    """
+    profile = None
+    if cloud is not None:
+        profile = load_cloud_profiles().get(cloud)
+        if profile is None:
+            raise ValueError(f"未知的云: {cloud}，可选: {', '.join(cloud_names()) or '无（未找到 ' + CLOUDS_FILE + '）'}")
+    kind = (kind or (profile or {}).get('backend') or os.getenv('OPENSTACK_BACKEND', 'auto')).lower()
+    if kind == 'auto':
+        auth_url = profile.get('auth', {}).get('auth_url') if profile is not None else os.getenv('OS_AUTH_URL')
+        kind = 'api' if auth_url else 'cli'
+    if kind == 'api':
+        return APIBackend.from_profile(cloud, profile) if profile is not None else APIBackend.from_env()
+    if kind == 'cli':
+        return CLIBackend(cloud)
+    raise ValueError(f"不支持的OpenStack后端: {kind}")
+
+
+def _api_cache_stats(kind: str) -> Dict[str, Any]:
+    backend = _backend
+    if not isinstance(backend, APIBackend):
+        return {}
+    if kind == 'keystone_token':
+        return {'hits': backend.token_hits, 'misses': backend.token_misses}
+    if kind == 'openstack_lookup':
+        return {'hits': backend.lookup_hits, 'misses': backend.lookup_misses, 'size': len(backend._lookups)}
+    return {'hits': backend.pool.reused, 'misses': backend.pool.created}
+
+
+for _kind in ('keystone_token', 'openstack_lookup', 'http_connections'):
+    registry.register_cache(_kind, lambda kind=_kind: _api_cache_stats(kind))
+
+
+def get_backend(cloud: Optional[str] = None):
+    """返回默认后端或指定云配置的后端（每个云只创建一次）"""
+    global _backend
+    if cloud is not None:
+        load_cloud_profiles()
+        backend = _cloud_backends.get(cloud)
+        if backend is None:
+            with _backend_lock:
+                backend = _cloud_backends.get(cloud)
+                if backend is None:
+                    backend = _cloud_backends[cloud] = create_backend(cloud=cloud)
+                    logger.info(f"云 {cloud} 的OpenStack后端: {backend.name}")
+        return backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+                logger.info(f"OpenStack后端: {_backend.name}")
+    return _backend
@@ -1,32 +1,38 @@
-import subprocess
-import tempfile
 import os
+import re
 import json
+import time
 import logging
-from contextlib import contextmanager
-from typing import Dict, Any
-from cloud_config_generator import generate_cloud_config
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, Iterable, List, Optional, Union
+from instance_query import InstanceQuery, SORT_KEYS
+from cloud_config_generator import build_user_data, user_data_options
+from config_manager import get_config_snapshot, register_baked_image, resolve_image_os
+from image_resolver import CAPABILITIES_PROPERTY
+import deployment_history
+from deployment_history import record_deployment
+from readiness import readiness_store, readiness_callback
+from openstack_backend import BackendError, get_backend, temp_yaml_file, cloud_names
+from instance_poller import InstanceSnapshot
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
-
-@contextmanager
-def temp_yaml_file(content: str):
-    """上下文管理器用于处理临时YAML文件"""
-    temp_file = None
-    try:
-        temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False)
-        temp_file.write(content)
-        temp_file.flush()
-        yield temp_file.name
-    finally:
-        if temp_file:
-            temp_file.close()
-            if os.path.exists(temp_file.name):
-                os.unlink(temp_file.name)
+FLEET_MAX_COUNT = int(os.getenv('FLEET_MAX_COUNT', '200'))
+FLEET_CONCURRENCY = int(os.getenv('FLEET_CONCURRENCY', '10'))
+IMAGE_BAKE_TIMEOUT = float(os.getenv('IMAGE_BAKE_TIMEOUT', '1800'))
+CLOUD_TIMEOUT = float(os.getenv('CLOUD_TIMEOUT', '10'))
+CLOUD_STATUS_TTL = float(os.getenv('CLOUD_STATUS_TTL', '5'))
+# 多云查询共用的线程池；超时的调用会继续占用线程直到返回
+_fanout_executor = ThreadPoolExecutor(max_workers=int(os.getenv('CLOUD_FANOUT_WORKERS', '32')),
+                                      thread_name_prefix='cloud-fanout')
 
 
 def deploy_to_openstack(config_data: Dict[str, Any]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    timings = {}
+    yaml_content = None
     try:
         if 'openstack' not in config_data:
             raise ValueError("缺少OpenStack配置")
@@ -40,65 +46,253 @@ def deploy_to_openstack(config_data: Dict[str, Any]) -> Dict[str, Any]:
         
         logger.info(f"开始部署实例: {openstack_config['instance_name']}")
         
-        yaml_content = generate_cloud_config(config_data)
-        
-        with temp_yaml_file(yaml_content) as temp_file_path:
-            cmd = [
-                'openstack', 'server', 'create',
-                '--image', openstack_config['image'],
-                '--flavor', openstack_config['flavor'],
-                '--network', openstack_config['network'],
-                '--user-data', temp_file_path,
-                '--key-name', openstack_config['key_name']
-            ]
-            
-            if 'security_groups' in openstack_config:
-                for sg in openstack_config['security_groups']:
-                    cmd.extend(['--security-group', sg])
-            
-            if 'availability_zone' in openstack_config:
-                cmd.extend(['--availability-zone', openstack_config['availability_zone']])
-
-            cmd.append(openstack_config['instance_name'])
-            
-            logger.info(f"OpenStack命令: {' '.join(cmd[:3])} ... {openstack_config['instance_name']}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            
-            logger.info(f"实例 {openstack_config['instance_name']} 创建成功")
-            
-            return {
-                'success': True,
-                'message': f'实例 {openstack_config["instance_name"]} 创建成功',
-                'output': result.stdout,
-                'user_data': yaml_content
-            }
+        backend = get_backend(openstack_config.get('cloud'))
+        yaml_content, payload, size, optimization = _checked_user_data(
+            backend, config_data, _callback_env(config_data, instance=openstack_config['instance_name']))
+        timings['render'] = round(time.perf_counter() - start, 3)
         
-    except subprocess.CalledProcessError as e:
-        error_msg = f'OpenStack命令执行失败: {e.stderr}'
+        output = backend.create_server(openstack_config, payload)
+        timings['create'] = round(time.perf_counter() - start - timings['render'], 3)
+        
+        logger.info(f"实例 {openstack_config['instance_name']} 创建成功")
+        if 'readiness' in optimization:
+            readiness_store.expect([openstack_config['instance_name']], optimization['readiness'],
+                                   cloud=openstack_config.get('cloud'))
+        
+        result = {
+            'success': True,
+            'message': f'实例 {openstack_config["instance_name"]} 创建成功',
+            'output': output,
+            'user_data': yaml_content,
+            'user_data_size': size,
+            'user_data_optimization': optimization
+        }
+        timings['total'] = round(time.perf_counter() - start, 3)
+        record_deployment('deploy', openstack_config, config_data.get('deployments', {}), result,
+                          yaml_content, timings)
+        return result
+        
+    except BackendError as e:
+        error_msg = f'OpenStack命令执行失败: {e.detail}'
         logger.error(error_msg)
-        return {
+        result = {
             'success': False,
-            'error': error_msg,
-            'returncode': e.returncode
+            'error': error_msg
         }
+        if e.returncode is not None:
+            result['returncode'] = e.returncode
+        timings['total'] = round(time.perf_counter() - start, 3)
+        record_deployment('deploy', config_data['openstack'], config_data.get('deployments', {}), result,
+                          yaml_content, timings)
+        return result
     except Exception as e:
         error_msg = str(e)
         logger.error(f'部署失败: {error_msg}')
-        return {
+        result = {
             'success': False,
             'error': error_msg
         }
+        openstack_config = config_data.get('openstack')
+        if isinstance(openstack_config, dict):
+            timings['total'] = round(time.perf_counter() - start, 3)
+            record_deployment('deploy', openstack_config, config_data.get('deployments') or {}, result,
+                              yaml_content, timings)
+        return result
+
 
+def expand_instance_names(pattern: str, count: int) -> List[str]:
+    """按名称模式生成实例名，模式中的 {index} 从1开始编号，未包含时追加 -{index}"""
+    if '{' not in pattern:
+        pattern += '-{index}'
+    return [pattern.format(index=index) for index in range(1, count + 1)]
 
-def get_instance_status(instance_name: str) -> Dict[str, Any]:
+
+def fleet_instance_names(pattern: str, count: int) -> List[str]:
+    """校验数量并展开实例名，参数错误时抛出ValueError"""
+    if not 1 <= count <= FLEET_MAX_COUNT:
+        raise ValueError(f"实例数量必须在1到{FLEET_MAX_COUNT}之间")
     try:
-        logger.info(f"查询实例状态: {instance_name}")
+        names = expand_instance_names(pattern, count)
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"无效的实例名模式 {pattern}: {str(e)}")
+    if len(set(names)) != count:
+        raise ValueError(f"实例名模式 {pattern} 生成了重复的名称")
+    return names
+
+
+def _multi_create_base(pattern: str) -> Optional[str]:
+    """模式与Nova批量创建的默认命名（name-1..name-N）一致时返回name"""
+    if '{' not in pattern:
+        return pattern
+    if pattern.endswith('-{index}') and '{' not in pattern[:-len('-{index}')]:
+        return pattern[:-len('-{index}')]
+    return None
+
+
+def _callback_env(config_data: Dict[str, Any], instance: Optional[str] = None,
+                  scope: Optional[str] = None) -> Optional[str]:
+    """启用就绪回调时返回写入实例的回调配置"""
+    if not user_data_options(config_data)['readiness']:
+        return None
+    return readiness_callback(instance, scope)
+
+
+def _checked_user_data(backend, config_data: Dict[str, Any], callback_env: Optional[str] = None):
+    """渲染并编码user-data，超出Nova上限或后端不支持该编码时抛出ValueError"""
+    yaml_content, payload, size, optimization = build_user_data(config_data, callback_env)
+    if not size['within_limit']:
+        raise ValueError(f"user-data经base64编码后为{size['base64']}字节，超过Nova上限{size['limit']}字节，"
+                         f"可尝试 user_data_options 中的 write_files 或 gzip 编码")
+    if isinstance(payload, bytes) and not backend.supports_binary_user_data:
+        raise ValueError(f"{backend.name}后端不支持{size['encoding']}编码的user-data，请使用api后端或 mime/none 编码")
+    return yaml_content, payload, size, optimization
+
+
+def _create_one(backend, openstack_config: Dict[str, Any], name: str, user_data: Union[str, bytes],
+                user_data_file: Optional[str] = None, count: int = 1) -> Dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        output = backend.create_server(dict(openstack_config, instance_name=name), user_data,
+                                       min_count=count, max_count=count, user_data_file=user_data_file)
+        return {'name': name, 'success': True, 'output': output,
+                'elapsed': round(time.perf_counter() - start, 3)}
+    except BackendError as e:
+        error_msg = f'OpenStack命令执行失败: {e.detail}'
+    except Exception as e:
+        error_msg = str(e)
+    logger.error(f'实例 {name} 创建失败: {error_msg}')
+    return {'name': name, 'success': False, 'error': error_msg,
+            'elapsed': round(time.perf_counter() - start, 3)}
+
+
+def _multi_create_members(backend, base_name: str, names: List[str], result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Nova批量创建只返回一次请求的结果，按名称查出每个成员实例，分别生成各实例的结果"""
+    if not result['success']:
+        return [dict(result, name=name) for name in names]
+    servers: Dict[str, List[Dict[str, Any]]] = {}
+    try:
+        for row in backend.list_servers(name=f'^{re.escape(base_name)}-'):
+            servers.setdefault(row.get('Name'), []).append(row)
+    except BackendError as e:
+        logger.error(f'查询批量创建的实例失败: {e.detail}')
+    except Exception as e:
+        logger.error(f'查询批量创建的实例失败: {str(e)}')
+    instances = []
+    for name in names:
+        matches = servers.get(name, [])
+        if len(matches) == 1:
+            instances.append({'name': name, 'success': True, 'id': matches[0].get('ID'),
+                              'output': json.dumps(matches[0], ensure_ascii=False), 'elapsed': result['elapsed']})
+            continue
+        error_msg = f'批量创建请求已成功，但未找到实例 {name}' if not matches else \
+            f'存在{len(matches)}个名为 {name} 的实例，无法确定批量创建的成员'
+        logger.error(error_msg)
+        instances.append({'name': name, 'success': False, 'error': error_msg, 'elapsed': result['elapsed']})
+    return instances
+
+
+def dry_run_deploy(config_data: Dict[str, Any], count: Optional[int] = None) -> Dict[str, Any]:
+    """走与部署相同的校验和user-data渲染，但不调用OpenStack创建实例；count 不为None时按批量部署展开实例名"""
+    openstack_config = config_data['openstack']
+    pattern = openstack_config['instance_name']
+    names = [pattern] if count is None else fleet_instance_names(pattern, count)
+    callback_env = _callback_env(config_data, instance=pattern) if count is None else \
+        _callback_env(config_data, scope=pattern)
+    yaml_content, payload, size, optimization = _checked_user_data(get_backend(openstack_config.get('cloud')),
+                                                                   config_data, callback_env)
+    logger.info(f"试运行通过: {pattern}" + ('' if count is None else f" x {count}"))
+    return {
+        'success': True,
+        'dry_run': True,
+        'message': f'试运行通过，未创建实例: {", ".join(names[:5])}' + (' ...' if len(names) > 5 else ''),
+        'instances': names,
+        'user_data': yaml_content,
+        'user_data_size': size,
+        'user_data_optimization': optimization
+    }
+
+
+def deploy_fleet(config_data: Dict[str, Any], count: int, concurrency: Optional[int] = None,
+                 multi_create: bool = False) -> Dict[str, Any]:
+    """只渲染一次user-data，按名称模式并发创建 count 个相同实例，参数错误时抛出ValueError"""
+    if 'openstack' not in config_data:
+        raise ValueError("缺少OpenStack配置")
+    
+    openstack_config = config_data['openstack']
+    required_fields = ['instance_name', 'image', 'flavor', 'network', 'key_name']
+    
+    for field in required_fields:
+        if field not in openstack_config:
+            raise ValueError(f"缺少必需的OpenStack配置字段: {field}")
+    
+    pattern = openstack_config['instance_name']
+    names = fleet_instance_names(pattern, count)
+    
+    concurrency = max(1, min(concurrency or FLEET_CONCURRENCY, FLEET_CONCURRENCY, count))
+    start = time.perf_counter()
+    try:
+        logger.info(f"开始批量部署: {pattern} x {count}")
+        
+        backend = get_backend(openstack_config.get('cloud'))
+        # 所有实例共用一份user-data，回调令牌按名称模式签发，实例名由实例自己上报
+        yaml_content, payload, size, optimization = _checked_user_data(
+            backend, config_data, _callback_env(config_data, scope=pattern))
+        
+        base_name = _multi_create_base(pattern) if multi_create and count > 1 else None
+        if base_name is not None:
+            # Nova批量创建：一次请求，全部成功或全部失败
+            mode = 'multi-create'
+            result = _create_one(backend, openstack_config, base_name, payload, count=count)
+            instances = _multi_create_members(backend, base_name, names, result)
+        else:
+            mode = 'parallel'
+            with backend.prepare_user_data(payload) as user_data_file:
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fleet') as executor:
+                    instances = list(executor.map(
+                        lambda name: _create_one(backend, openstack_config, name, payload, user_data_file),
+                        names
+                    ))
+        
+        succeeded = sum(1 for instance in instances if instance['success'])
+        elapsed = round(time.perf_counter() - start, 3)
+        if 'readiness' in optimization:
+            readiness_store.expect([instance['name'] for instance in instances if instance['success']],
+                                   optimization['readiness'], scope=pattern, cloud=openstack_config.get('cloud'))
+        for instance in instances:
+            record_deployment(f'fleet-{mode}', openstack_config, config_data.get('deployments', {}), instance,
+                              yaml_content, {'total': instance['elapsed']}, instance_name=instance['name'])
+        logger.info(f"批量部署结束: {succeeded}/{count} 成功，耗时 {elapsed}s")
         
-        cmd = ['openstack', 'server', 'show', instance_name, '--format', 'json']
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        return {
+            'success': succeeded == count,
+            'message': f'批量部署完成: {succeeded}/{count} 个实例创建成功',
+            'mode': mode,
+            'requested': count,
+            'succeeded': succeeded,
+            'failed': count - succeeded,
+            'concurrency': 1 if mode == 'multi-create' else concurrency,
+            'elapsed': elapsed,
+            'instances': instances,
+            'user_data': yaml_content,
+            'user_data_size': size,
+            'user_data_optimization': optimization
+        }
+        
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f'批量部署失败: {error_msg}')
+        return {
+            'success': False,
+            'error': error_msg,
+            'elapsed': round(time.perf_counter() - start, 3)
+        }
+
+
+def get_instance_status(instance_name: str, cloud: Optional[str] = None) -> Dict[str, Any]:
+    try:
+        logger.info(f"查询实例状态: {instance_name}")
         
-        instance_info = json.loads(result.stdout)
+        instance_info = get_backend(cloud).show_server(instance_name)
         
         return {
             'success': True,
@@ -112,8 +306,8 @@ def get_instance_status(instance_name: str) -> Dict[str, Any]:
             }
         }
         
-    except subprocess.CalledProcessError as e:
-        error_msg = f'无法获取实例状态: {e.stderr}'
+    except BackendError as e:
+        error_msg = f'无法获取实例状态: {e.detail}'
         logger.error(error_msg)
         return {
             'success': False,
@@ -135,22 +329,50 @@ def get_instance_status(instance_name: str) -> Dict[str, Any]:
         }
 
 
-def list_instances() -> Dict[str, Any]:
+def list_instances(query: Optional[InstanceQuery] = None, cloud: Optional[str] = None) -> Dict[str, Any]:
+    """列出实例；query 中后端支持的过滤、排序和分页条件会下推到后端"""
     try:
         logger.info("查询所有实例列表")
         
-        cmd = ['openstack', 'server', 'list', '--format', 'json']
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        backend = get_backend(cloud)
+        if query is None or query.is_empty:
+            return {
+                'success': True,
+                'instances': backend.list_servers()
+            }
+        
+        filters = {}
+        if len(query.statuses) == 1:
+            filters['status'] = query.statuses[0]
+        if query.name_prefix:
+            filters['name'] = f'^{re.escape(query.name_prefix)}'
+        if query.sort and backend.supports_sort:
+            filters['sort_key'] = SORT_KEYS[query.sort][1]
+            filters['sort_dir'] = 'desc' if query.sort_desc else 'asc'
+        # 只有全部过滤和排序都能下推时，后端分页的结果才与本地一致
+        push_page = query.limit and len(query.statuses) <= 1 and (not query.sort or backend.supports_sort)
+        if push_page:
+            filters['limit'] = query.limit + 1
+            if query.marker:
+                filters['marker'] = query.marker
         
-        instances = json.loads(result.stdout)
+        rows = backend.list_servers(**filters)
+        instances, next_marker = query.apply(rows, paginate=not push_page)
+        if push_page and len(instances) > query.limit:
+            instances = instances[:query.limit]
+            next_marker = instances[-1].get('ID')
         
         return {
             'success': True,
-            'instances': instances
+            'instances': instances,
+            'next_marker': next_marker
         }
         
-    except subprocess.CalledProcessError as e:
-        error_msg = f'无法获取实例列表: {e.stderr}'
+    except ValueError:
+        # 查询参数错误（如marker不存在）由调用方返回400
+        raise
+    except BackendError as e:
+        error_msg = f'无法获取实例列表: {e.detail}'
         logger.error(error_msg)
         return {
             'success': False,
@@ -169,4 +391,258 @@ def list_instances() -> Dict[str, Any]:
         return {
             'success': False,
             'error': error_msg
-        }
\ No newline at end of file
+        }
+
+
+def resolve_clouds(value: Optional[str]) -> Optional[List[str]]:
+    """解析 cloud 参数：all 表示全部云配置，逗号分隔表示多个；单个云或未指定时返回None"""
+    if not value or (',' not in value and value != 'all'):
+        return None
+    known = cloud_names()
+    if value == 'all':
+        if not known:
+            raise ValueError("未找到云配置（clouds.yaml）")
+        return known
+    clouds = [cloud.strip() for cloud in value.split(',') if cloud.strip()]
+    unknown = [cloud for cloud in clouds if cloud not in known]
+    if unknown:
+        raise ValueError(f"未知的云: {', '.join(unknown)}，可选: {', '.join(known)}")
+    return clouds
+
+
+def fan_out(func, clouds: List[str], timeout: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+    """对每个云并发调用 func(cloud)，总耗时取决于最慢的云；超时或出错的云记为失败，不影响其他云的结果
+
+    返回 {云: {'state': 'ok'/'error'/'timeout', 'result' 或 'error', 'elapsed'}}
+    """
+    timeout = CLOUD_TIMEOUT if timeout is None else timeout
+    start = time.perf_counter()
+    futures = {}
+    for cloud in clouds:
+        def call(cloud=cloud):
+            result = func(cloud)
+            return result, round(time.perf_counter() - start, 3)
+        futures[cloud] = _fanout_executor.submit(call)
+    wait(futures.values(), timeout=timeout)
+    outcomes = {}
+    for cloud, future in futures.items():
+        if not future.done():
+            future.cancel()
+            outcomes[cloud] = {'state': 'timeout', 'error': f'{timeout}秒内未返回', 'elapsed': timeout}
+            logger.warning(f"云 {cloud} 查询超时（{timeout}秒）")
+            continue
+        try:
+            result, elapsed = future.result()
+            outcomes[cloud] = {'state': 'ok', 'result': result, 'elapsed': elapsed}
+        except BackendError as e:
+            outcomes[cloud] = {'state': 'error', 'error': e.detail, 'elapsed': round(time.perf_counter() - start, 3)}
+        except Exception as e:
+            outcomes[cloud] = {'state': 'error', 'error': str(e), 'elapsed': round(time.perf_counter() - start, 3)}
+    return outcomes
+
+
+def _cloud_meta(outcomes: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    failed = {cloud: outcome['error'] for cloud, outcome in outcomes.items() if outcome['state'] != 'ok'}
+    return {
+        'clouds': {cloud: {'state': outcome['state'], 'elapsed': outcome['elapsed']}
+                   for cloud, outcome in outcomes.items()},
+        'errors': failed,
+        'partial': bool(failed)
+    }
+
+
+def list_instances_multi(query: InstanceQuery, clouds: List[str], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """并发列出多个云的实例并合并（每行带 Cloud 列）；部分云失败时返回其余云的结果"""
+    if query.marker:
+        raise ValueError("多云查询不支持 marker，请缩小过滤条件或按云分别查询")
+
+    def fetch(cloud):
+        result = list_instances(query, cloud)
+        if not result['success']:
+            raise Exception(result['error'])
+        return result['instances']
+
+    outcomes = fan_out(fetch, clouds, timeout)
+    rows = [dict(row, Cloud=cloud) for cloud, outcome in outcomes.items() if outcome['state'] == 'ok'
+            for row in outcome['result']]
+    # 各云已按同样条件过滤、排序并截断，合并后再统一排序和截断
+    instances, _ = query.apply(rows)
+    meta = _cloud_meta(outcomes)
+    return dict(meta, success=len(meta['errors']) < len(clouds), instances=instances)
+
+
+_cloud_snapshots: Dict[str, InstanceSnapshot] = {}
+_cloud_snapshot_locks: Dict[str, threading.Lock] = {}
+_cloud_snapshot_guard = threading.Lock()
+_cloud_snapshot_counts = {'hits': 0, 'misses': 0}
+
+
+def _after_fork():
+    global _cloud_snapshot_guard
+    _cloud_snapshot_guard = threading.Lock()
+    _cloud_snapshot_locks.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _count_snapshot(outcome: str):
+    with _cloud_snapshot_guard:
+        _cloud_snapshot_counts[outcome] += 1
+
+
+def _cloud_snapshot_stats() -> Dict[str, Any]:
+    with _cloud_snapshot_guard:
+        return dict(_cloud_snapshot_counts, size=len(_cloud_snapshots))
+
+
+registry.register_cache('cloud_status', _cloud_snapshot_stats)
+
+
+def _cloud_snapshot(cloud: str, fresh: bool = False) -> InstanceSnapshot:
+    """各云的实例列表快照：CLOUD_STATUS_TTL 秒内的状态查询共用一次 server list --long，同一个云同时只获取一次"""
+    snapshot = _cloud_snapshots.get(cloud)
+    if not fresh and snapshot is not None and snapshot.age < CLOUD_STATUS_TTL:
+        _count_snapshot('hits')
+        return snapshot
+    with _cloud_snapshot_guard:
+        lock = _cloud_snapshot_locks.setdefault(cloud, threading.Lock())
+    with lock:
+        # 等待期间其他请求已重新获取，结果不早于本次请求
+        current = _cloud_snapshots.get(cloud)
+        if current is not None and current is not snapshot and current.age < CLOUD_STATUS_TTL:
+            _count_snapshot('hits')
+            return current
+        _count_snapshot('misses')
+        current = _cloud_snapshots[cloud] = InstanceSnapshot(get_backend(cloud).list_servers(long=True))
+        return current
+
+
+def get_instance_status_multi(instance_name: str, clouds: List[str], timeout: Optional[float] = None,
+                              fresh: bool = False) -> Dict[str, Any]:
+    """并发在多个云中查找实例；找到唯一实例时与单云结果一致，另外返回所有匹配及各云状态
+
+    每个云按实例列表快照查找，fresh 为True时重新获取快照。
+    """
+    outcomes = fan_out(lambda cloud: _cloud_snapshot(cloud, fresh).lookup(instance_name), clouds, timeout)
+    matches = []
+    for cloud, outcome in outcomes.items():
+        if outcome['state'] != 'ok':
+            continue
+        for info in outcome['result']:
+            matches.append({
+                'cloud': cloud,
+                'name': info.get('name'),
+                'status': info.get('status'),
+                'power_state': info.get('power_state'),
+                'created': info.get('created'),
+                'updated': info.get('updated'),
+                'addresses': info.get('addresses', {})
+            })
+    result = dict(_cloud_meta(outcomes), success=bool(matches), instances=matches)
+    if len(matches) == 1:
+        result['instance'] = matches[0]
+    elif not matches:
+        result['error'] = f"在 {', '.join(clouds)} 中未找到实例 {instance_name}"
+    return result
+
+
+def list_images() -> Dict[str, Any]:
+    try:
+        logger.info("查询镜像列表")
+        
+        images = get_backend().list_images()
+        
+        return {
+            'success': True,
+            'images': images
+        }
+        
+    except BackendError as e:
+        error_msg = f'无法获取镜像列表: {e.detail}'
+        logger.error(error_msg)
+        return {
+            'success': False,
+            'error': error_msg
+        }
+    except json.JSONDecodeError as e:
+        error_msg = f'JSON解析错误: {str(e)}'
+        logger.error(error_msg)
+        return {
+            'success': False,
+            'error': error_msg
+        }
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f'获取镜像列表失败: {error_msg}')
+        return {
+            'success': False,
+            'error': error_msg
+        }
+
+
+def service_capabilities(services: Iterable[str], image_name: str) -> List[str]:
+    """已部署服务在镜像中留下的能力：镜像操作系统对应的Docker安装配置的 provides 以及各服务（含其依赖）的包"""
+    snapshot = get_config_snapshot()
+    deployments = snapshot.deployments
+    capabilities = set()
+    pending = list(services)
+    seen = set()
+    while pending:
+        service = pending.pop()
+        if service in seen:
+            continue
+        seen.add(service)
+        if service not in deployments:
+            raise ValueError(f"未知的服务: {service}")
+        if service == 'docker':
+            docker_config = snapshot.docker_install_configs.get(resolve_image_os(image_name, snapshot), {})
+            capabilities.update(docker_config.get('provides', []))
+        capabilities.update(deployments[service].get('packages', []))
+        pending.extend(deployments[service].get('depends_on', []))
+    return sorted(capabilities)
+
+
+def _deployed_image(instance_name: str) -> Optional[str]:
+    """部署历史中实例最近一次成功创建时使用的镜像"""
+    if deployment_history.history is None:
+        return None
+    try:
+        rows = deployment_history.history.query(instance_name=instance_name, success=True, limit=1)
+    except Exception as e:
+        logger.warning(f"查询实例 {instance_name} 的部署历史失败: {str(e)}")
+        return None
+    return rows[0]['image'] if rows else None
+
+
+def bake_image(instance_name: str, image_name: str, services: Optional[List[str]] = None,
+               capabilities: Optional[List[str]] = None, source_image: Optional[str] = None) -> Dict[str, Any]:
+    """由已完成部署的实例创建快照镜像，写入 deployer_capabilities 属性并登记能力
+
+    之后用该镜像部署时，渲染会省略镜像中已有的包和安装步骤。服务留下的能力按实例所用镜像的操作系统推导：
+    source_image 未指定时取部署历史中该实例的镜像，都没有时按烘焙镜像名识别。
+    """
+    try:
+        os_image = source_image or _deployed_image(instance_name) or image_name
+        baked = sorted(set(service_capabilities(services or [], os_image)) | set(capabilities or []))
+        if not baked:
+            raise ValueError("未指定烘焙镜像的服务或能力")
+        logger.info(f"由实例 {instance_name} 烘焙镜像 {image_name}，能力: {baked}")
+        start = time.perf_counter()
+        image = get_backend().create_image(instance_name, image_name, {CAPABILITIES_PROPERTY: ','.join(baked)},
+                                           IMAGE_BAKE_TIMEOUT)
+        entry = register_baked_image(image_name, image.get('id'), baked, source_instance=instance_name)
+        return {
+            'success': True,
+            'message': f'镜像 {image_name} 已创建并登记',
+            'image': image,
+            'capabilities': entry['capabilities'],
+            'elapsed': round(time.perf_counter() - start, 3)
+        }
+    except BackendError as e:
+        error_msg = f'OpenStack命令执行失败: {e.detail}'
+    except Exception as e:
+        error_msg = str(e)
+    logger.error(f'烘焙镜像 {image_name} 失败: {error_msg}')
+    return {'success': False, 'error': error_msg}
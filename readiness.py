@@ -0,0 +1,276 @@
+import os
+import json
+import hmac
+import time
+import shlex
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from boot_plan import READY_SERVICE
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+READY = 'ready'
+FAILED = 'failed'
+TERMINAL_STATES = (READY, FAILED)
+RUNNING = 'running'
+DONE = 'done'
+REMOTE_POLL_INTERVAL = 0.25
+SWEEP_EVERY = 100
+CALLBACK_PATH = '/api/readiness/report'
+
+READINESS_REPORTS = registry.counter('deployer_readiness_reports_total', '实例上报的就绪回调数', ('status',))
+
+
+class InvalidTokenError(Exception):
+    """回调令牌与实例不匹配"""
+
+
+class ReadinessStore:
+    """记录实例在cloud-init中上报的服务安装进度，供等待就绪的长轮询使用
+
+    每个实例的记录是一串事件（部署时登记预期的服务，实例上报服务开始/结束和最终就绪），
+    设置 state_dir 时以追加写入的JSONL文件保存，多个worker进程都能看到其他进程收到的上报。
+    令牌为密钥对实例名（批量部署为名称模式）的HMAC，不需要保存；没有密钥时不接受任何上报。
+    """
+
+    def __init__(self, secret: Optional[bytes], state_dir: Optional[str] = None, max_entries: int = 10000,
+                 retention: float = 7 * 86400):
+        self.secret = secret
+        self.state_dir = state_dir
+        self.max_entries = max_entries
+        self.retention = retention
+        self._events: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._changed = threading.Condition()
+        self._expected = 0
+        self.counts = {'reports': 0, 'rejected': 0, 'waits': 0}
+
+    def _after_fork(self):
+        self._changed = threading.Condition()
+
+    # ---- 令牌 ----
+
+    def token(self, instance: Optional[str] = None, scope: Optional[str] = None) -> str:
+        subject = f'fleet:{scope}' if scope else f'instance:{instance}'
+        return hmac.new(self.secret, subject.encode('utf-8'), hashlib.sha256).hexdigest()[:40]
+
+    def callback_env(self, base_url: str, instance: Optional[str] = None, scope: Optional[str] = None) -> str:
+        """生成写入实例的 callback.env；批量部署按名称模式共用一份，实例名由实例自己从元数据获取"""
+        settings = {
+            'DEPLOYER_CALLBACK_URL': base_url.rstrip('/') + CALLBACK_PATH,
+            'DEPLOYER_TOKEN': self.token(instance, scope),
+            'DEPLOYER_INSTANCE': '' if scope else instance,
+            'DEPLOYER_SCOPE': scope or ''
+        }
+        return ''.join(f'{name}={shlex.quote(value)}\n' for name, value in settings.items())
+
+    # ---- 事件存储 ----
+
+    def _path(self, instance: str) -> str:
+        return os.path.join(self.state_dir,
+                            f"ready-{hashlib.sha256(instance.encode('utf-8')).hexdigest()[:32]}.jsonl")
+
+    def _load(self, instance: str) -> List[Dict[str, Any]]:
+        if not self.state_dir:
+            with self._changed:
+                return list(self._events.get(instance, ()))
+        try:
+            with open(self._path(instance), encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # 另一个进程正在追加的行
+                continue
+        return events
+
+    def _append(self, instance: str, event: Dict[str, Any], reset: bool = False):
+        if self.state_dir:
+            line = (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8')
+            path = self._path(instance)
+            if reset:
+                temp_path = f'{path}.{os.getpid()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(line)
+                os.replace(temp_path, path)
+            else:
+                # O_APPEND 的单次写入不会与其他进程的追加交错
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+        with self._changed:
+            if not self.state_dir:
+                if reset or instance not in self._events:
+                    self._events[instance] = []
+                self._events[instance].append(event)
+                self._events.move_to_end(instance)
+                while len(self._events) > self.max_entries:
+                    self._events.popitem(last=False)
+            self._changed.notify_all()
+
+    def _sweep(self):
+        cutoff = time.time() - self.retention
+        try:
+            names = [name for name in os.listdir(self.state_dir) if name.startswith('ready-')]
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.state_dir, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    # ---- 部署与上报 ----
+
+    def expect(self, instances: Iterable[str], services: List[str], scope: Optional[str] = None,
+               cloud: Optional[str] = None):
+        """登记刚创建的实例及其将要上报的服务，覆盖同名实例以前的记录"""
+        now = time.time()
+        for instance in instances:
+            self._append(instance, {'type': 'expect', 'services': list(services), 'scope': scope, 'cloud': cloud,
+                                    'at': now}, reset=True)
+            self._expected += 1
+            if self.state_dir and self._expected % SWEEP_EVERY == 0:
+                self._sweep()
+
+    def report(self, data: Dict[str, Any], token: str) -> Dict[str, Any]:
+        """处理实例的上报，令牌无效时抛出InvalidTokenError，内容无效时抛出ValueError"""
+        instance = data.get('instance')
+        service = data.get('service')
+        status = str(data.get('status', ''))
+        if not isinstance(instance, str) or not instance:
+            raise ValueError('缺少 instance')
+        if not isinstance(service, str) or not service:
+            raise ValueError('缺少 service')
+        scope = data.get('scope') or None
+        if not self.secret:
+            self.counts['rejected'] += 1
+            raise InvalidTokenError('未设置 READINESS_SECRET，不接受就绪回调')
+        events = self._load(instance)
+        expected = events[0] if events and events[0]['type'] == 'expect' else None
+        # 批量部署的令牌只对登记在该名称模式下的实例有效
+        if scope is not None and (expected is None or expected.get('scope') != scope):
+            self.counts['rejected'] += 1
+            raise InvalidTokenError(f'实例 {instance} 不属于 {scope}')
+        if not hmac.compare_digest(token or '', self.token(instance, scope)):
+            self.counts['rejected'] += 1
+            raise InvalidTokenError(f'实例 {instance} 的回调令牌无效')
+        seconds = data.get('seconds')
+        if seconds is not None and not isinstance(seconds, (int, float)):
+            raise ValueError('seconds 必须是数字')
+
+        if service == READY_SERVICE:
+            event = {'type': 'ready', 'seconds': seconds, 'at': time.time()}
+        elif status == 'started':
+            event = {'type': 'service', 'service': service, 'status': RUNNING, 'at': time.time()}
+        elif status in ('done', '0'):
+            event = {'type': 'service', 'service': service, 'status': DONE, 'seconds': seconds, 'at': time.time()}
+        else:
+            try:
+                exit_code = int(status)
+            except ValueError:
+                raise ValueError(f'无效的状态: {status}')
+            event = {'type': 'service', 'service': service, 'status': FAILED, 'exit_code': exit_code,
+                     'seconds': seconds, 'at': time.time()}
+        self._append(instance, event)
+        self.counts['reports'] += 1
+        READINESS_REPORTS.inc(status='ready' if event['type'] == 'ready' else event['status'])
+        logger.info(f"实例 {instance} 上报: {service} {status}" + ('' if seconds is None else f" ({seconds}s)"))
+        return self._fold(instance, events + [event])
+
+    @staticmethod
+    def _fold(instance: str, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+        record = {'instance': instance, 'state': PENDING, 'services': {}, 'deployed_at': None, 'ready_at': None,
+                  'boot_seconds': None}
+        ready = None
+        for event in events:
+            if event['type'] == 'expect':
+                record['services'] = {service: {'status': PENDING} for service in event['services']}
+                record['deployed_at'] = event['at']
+                record['cloud'] = event.get('cloud')
+            elif event['type'] == 'service':
+                current = record['services'].get(event['service'], {})
+                # 后台上报可能乱序到达，开始的上报不覆盖已结束的状态
+                if event['status'] == RUNNING and current.get('status') in (DONE, FAILED):
+                    continue
+                record['services'][event['service']] = {name: value for name, value in event.items()
+                                                        if name not in ('type', 'service')}
+            elif event['type'] == 'ready':
+                ready = event
+        if ready is not None:
+            failed = any(service['status'] == FAILED for service in record['services'].values())
+            record['state'] = FAILED if failed else READY
+            record['ready_at'] = ready['at']
+            record['boot_seconds'] = ready.get('seconds')
+        record['failed_services'] = [name for name, service in record['services'].items()
+                                     if service['status'] == FAILED]
+        return record
+
+    def get(self, instance: str) -> Optional[Dict[str, Any]]:
+        events = self._load(instance)
+        return self._fold(instance, events) if events else None
+
+    @staticmethod
+    def _satisfied(record: Optional[Dict[str, Any]], services: Optional[List[str]]) -> bool:
+        if record is None:
+            return False
+        if record['state'] in TERMINAL_STATES:
+            return True
+        return bool(services) and all(record['services'].get(service, {}).get('status') in (DONE, FAILED)
+                                      for service in services)
+
+    def wait(self, instance: str, timeout: float,
+             services: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """等待实例就绪（或指定的服务全部结束），返回 (记录, 是否已满足)，只读取上报结果，不查询OpenStack"""
+        self.counts['waits'] += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.get(instance)
+            if self._satisfied(record, services):
+                return record, True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return record, False
+            with self._changed:
+                # 其他worker收到的上报只能通过共享目录看到
+                self._changed.wait(min(remaining, REMOTE_POLL_INTERVAL) if self.state_dir else remaining)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._changed:
+            size = len(self._events)
+        return {'size': size, 'shared': bool(self.state_dir), **self.counts}
+
+
+READINESS_CALLBACK_URL = os.getenv('READINESS_CALLBACK_URL', '')
+READINESS_WAIT_MAX = float(os.getenv('READINESS_WAIT_MAX', '300'))
+# 令牌和就绪记录都要在服务重启后继续有效，启用就绪回调必须设置固定的密钥和持久的 JOB_STATE_DIR
+_secret = os.getenv('READINESS_SECRET')
+readiness_store = ReadinessStore(_secret.encode('utf-8') if _secret else None,
+                                 os.getenv('JOB_STATE_DIR') or None,
+                                 int(os.getenv('READINESS_MAX_ENTRIES', '10000')),
+                                 float(os.getenv('READINESS_RETENTION', str(7 * 86400))))
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=readiness_store._after_fork)
+
+
+def readiness_callback(instance: Optional[str] = None, scope: Optional[str] = None) -> str:
+    """返回要写入实例的回调配置，未设置 READINESS_CALLBACK_URL、READINESS_SECRET 或 JOB_STATE_DIR 时抛出ValueError"""
+    if not READINESS_CALLBACK_URL:
+        raise ValueError('启用就绪回调需要设置 READINESS_CALLBACK_URL（实例可访问的部署服务地址）')
+    if not readiness_store.secret:
+        raise ValueError('启用就绪回调需要设置 READINESS_SECRET，否则服务重启后已部署实例的令牌失效')
+    if not os.getenv('JOB_STATE_DIR'):
+        raise ValueError('启用就绪回调需要设置 JOB_STATE_DIR（持久目录），否则服务重启后就绪记录丢失')
+    return readiness_store.callback_env(READINESS_CALLBACK_URL, instance, scope)
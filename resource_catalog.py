@@ -0,0 +1,379 @@
+import os
+import re
+import time
+import difflib
+import logging
+import threading
+from typing import Dict, Any, FrozenSet, List, Optional
+
+from openstack_backend import get_backend, cloud_names
+from metrics import registry, timed
+from shared_state import LeaderLock, SharedFile, SHARED_POLL_INTERVAL, touch, mtime
+
+logger = logging.getLogger(__name__)
+
+# 资源类型 -> (后端列表方法, 可用于引用资源的列, 请求中对应的OpenStack配置字段)
+RESOURCE_KINDS = {
+    'image': ('list_images', ('ID', 'Name'), 'image'),
+    'flavor': ('list_flavors', ('ID', 'Name'), 'flavor'),
+    'network': ('list_networks', ('ID', 'Name'), 'network'),
+    'keypair': ('list_keypairs', ('Name',), 'key_name'),
+    'security_group': ('list_security_groups', ('ID', 'Name'), 'security_groups'),
+    'availability_zone': ('list_availability_zones', ('Zone Name',), 'availability_zone')
+}
+MAX_SUGGESTIONS = 3
+
+
+class PreflightError(ValueError):
+    """请求引用了资源目录中不存在的资源，errors 为每个字段的错误及建议"""
+
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__('；'.join(f"{error['field']} 不存在: {error['value']}" +
+                                  (f"（是否为: {', '.join(error['suggestions'])}）" if error['suggestions'] else '')
+                                  for error in errors))
+        self.errors = errors
+
+
+class ResourceSet:
+    """一种资源的一次列表结果"""
+
+    __slots__ = ('names', 'display', 'fetched_at', 'fetched_time')
+
+    def __init__(self, rows: List[Dict[str, Any]], columns):
+        names = set()
+        display = set()
+        for row in rows:
+            if row.get('Zone Status', 'available') != 'available':
+                continue
+            for column in columns:
+                if row.get(column):
+                    names.add(str(row[column]))
+            label = row.get(columns[-1]) or row.get(columns[0])
+            if label:
+                display.add(str(label))
+        self.names: FrozenSet[str] = frozenset(names)
+        # 建议只从名称中选，不提示ID
+        self.display = sorted(display)
+        self.fetched_at = time.monotonic()
+        self.fetched_time = time.time()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ResourceSet':
+        """由leader写入共享目录的结果还原，age 按写入时间换算"""
+        resource_set = cls.__new__(cls)
+        resource_set.names = frozenset(data['names'])
+        resource_set.display = data['display']
+        resource_set.fetched_time = data['fetched_time']
+        resource_set.fetched_at = time.monotonic() - max(0.0, time.time() - data['fetched_time'])
+        return resource_set
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'names': sorted(self.names), 'display': self.display, 'fetched_time': self.fetched_time}
+
+    @property
+    def age(self) -> float:
+        return round(time.monotonic() - self.fetched_at, 3)
+
+
+class ResourceCatalog:
+    """后台定期刷新的OpenStack资源目录，用于在调用后端前校验请求中的资源名
+
+    某类资源从未成功获取时不校验该类资源；名称不在目录中且目录已超过 recheck_after 秒时，
+    先同步刷新该类资源（最多等待 recheck_timeout 秒）再判定，避免刚创建的资源被误拒。
+    设置 state_dir 时只有一个worker（leader）定期刷新，结果写入共享目录供其他worker读取。
+    cloud 为 clouds.yaml 中的云配置名，为None时对应默认云。
+    """
+
+    def __init__(self, interval: float = 300.0, recheck_after: float = 30.0, state_dir: Optional[str] = None,
+                 cloud: Optional[str] = None, recheck_timeout: float = 5.0):
+        self.interval = interval
+        self.recheck_after = recheck_after
+        self.recheck_timeout = recheck_timeout
+        self.state_dir = state_dir
+        self.cloud = cloud
+        # 共享目录中的文件名，具名云各用一组
+        self._suffix = '' if cloud is None else '-' + re.sub(r'[^A-Za-z0-9_.-]', '_', cloud)
+        self.resources: Dict[str, ResourceSet] = {}
+        self.errors: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.rechecks = 0
+        self._locks = {kind: threading.Lock() for kind in RESOURCE_KINDS}
+        self._rechecking: Dict[str, threading.Event] = {}
+        self._rechecking_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._leader: Optional[LeaderLock] = None
+        self._shared: Optional[SharedFile] = None
+        self._recheck_requested = False
+        self._poke_seen = 0.0
+
+    def _after_fork(self):
+        self._locks = {kind: threading.Lock() for kind in RESOURCE_KINDS}
+        self._rechecking = {}
+        self._rechecking_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if self._leader is not None:
+            self._leader._after_fork()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.state_dir:
+            self._leader = LeaderLock(self.state_dir, f'resource-catalog{self._suffix}')
+            self._shared = SharedFile(os.path.join(self.state_dir, f'catalog{self._suffix}.json'))
+        self._thread = threading.Thread(target=self._loop, name=f'resource-catalog{self._suffix}', daemon=True)
+        self._thread.start()
+        logger.info(f"资源目录刷新已启动{'' if self.cloud is None else f'（云 {self.cloud}）'}，间隔 {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def poke(self):
+        """请求尽快重新获取已超过 recheck_after 的资源"""
+        if self._leader is not None and not self._leader.held:
+            touch(self._poke_path())
+        self._recheck_requested = True
+        self._wakeup.set()
+
+    def _poke_path(self) -> str:
+        return os.path.join(self.state_dir, f'catalog{self._suffix}.poke')
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _loop(self):
+        next_refresh = 0.0
+        while not self._stop.is_set():
+            if self._lead():
+                if time.monotonic() >= next_refresh:
+                    self.refresh()
+                    next_refresh = time.monotonic() + self.interval
+                elif self._poke_requested():
+                    self.refresh(min_age=self.recheck_after)
+                timeout = next_refresh - time.monotonic()
+                if self._leader is not None:
+                    timeout = min(timeout, SHARED_POLL_INTERVAL)
+            else:
+                self._follow()
+                timeout = SHARED_POLL_INTERVAL
+            self._wakeup.wait(max(0.0, timeout))
+            self._wakeup.clear()
+
+    def _lead(self) -> bool:
+        if self._leader is None or self._leader.held:
+            return True
+        if not self._leader.acquire():
+            return False
+        self._follow()
+        return True
+
+    def _poke_requested(self) -> bool:
+        requested, self._recheck_requested = self._recheck_requested, False
+        if self._leader is not None:
+            poked = mtime(self._poke_path())
+            if poked > self._poke_seen:
+                self._poke_seen = poked
+                requested = True
+        return requested
+
+    def _follow(self):
+        data = self._shared.load_if_changed()
+        if data is None:
+            return
+        self.resources = {kind: ResourceSet.from_dict(resource_set)
+                          for kind, resource_set in data['resources'].items() if kind in RESOURCE_KINDS}
+        self.errors = data.get('errors', {})
+
+    def _publish(self):
+        if self._shared is None or not self._leader.held:
+            return
+        try:
+            resources = self.resources
+            self._shared.write({'resources': {kind: resource_set.to_dict() for kind, resource_set in resources.items()},
+                                'errors': dict(self.errors)})
+        except OSError as e:
+            logger.warning(f"写入共享资源目录失败: {str(e)}")
+
+    def refresh(self, kinds=None, min_age: float = 0.0):
+        for kind in kinds or RESOURCE_KINDS:
+            self.refresh_kind(kind, min_age)
+
+    def refresh_kind(self, kind: str, min_age: float = 0.0) -> Optional[ResourceSet]:
+        """刷新一种资源；并发请求只刷新一次（等待中的请求在刷新完成后直接使用新结果）"""
+        method, columns, _ = RESOURCE_KINDS[kind]
+        with self._locks[kind]:
+            current = self.resources.get(kind)
+            if current is not None and current.age < min_age:
+                return current
+            try:
+                with timed('catalog_refresh'):
+                    rows = getattr(get_backend(self.cloud), method)()
+            except Exception as e:
+                # 保留旧结果，通过 age 体现数据陈旧程度
+                self.errors[kind] = str(e)
+                logger.warning(f"刷新资源目录 {kind} 失败: {str(e)}")
+                self._publish()
+                return current
+            resource_set = ResourceSet(rows, columns)
+            self.resources = dict(self.resources, **{kind: resource_set})
+            self.errors.pop(kind, None)
+            self._publish()
+            return resource_set
+
+    def _recheck(self, kind: str) -> Optional[ResourceSet]:
+        """同步刷新一种资源，同一类资源同时只刷新一次；超过 recheck_timeout 秒返回None，刷新在后台继续"""
+        with self._rechecking_lock:
+            done = self._rechecking.get(kind)
+            if done is None:
+                done = self._rechecking[kind] = threading.Event()
+                threading.Thread(target=self._run_recheck, args=(kind, done), name=f'catalog-recheck-{kind}',
+                                 daemon=True).start()
+        if not done.wait(self.recheck_timeout):
+            logger.warning(f"重新获取资源目录 {kind} 超过 {self.recheck_timeout}s，按现有目录校验")
+            return None
+        return self.resources.get(kind)
+
+    def _run_recheck(self, kind: str, done: threading.Event):
+        try:
+            self.refresh_kind(kind, min_age=self.recheck_after)
+        finally:
+            with self._rechecking_lock:
+                self._rechecking.pop(kind, None)
+            done.set()
+
+    def _check(self, kind: str, field: str, value: str, errors: List[Dict[str, Any]], checked: List[str]):
+        resource_set = self.resources.get(kind)
+        if resource_set is None:
+            return
+        checked.append(field)
+        if value in resource_set.names:
+            self.hits += 1
+            return
+        if resource_set.age >= self.recheck_after:
+            # 目录可能早于资源的创建，先重新获取该类资源再判定
+            self.rechecks += 1
+            resource_set = self._recheck(kind) or resource_set
+            if value in resource_set.names:
+                self.hits += 1
+                return
+        self.misses += 1
+        errors.append({
+            'field': field,
+            'kind': kind,
+            'value': value,
+            'suggestions': difflib.get_close_matches(value, resource_set.display, n=MAX_SUGGESTIONS, cutoff=0.5)
+        })
+
+    def validate(self, openstack_config: Dict[str, Any]) -> Dict[str, Any]:
+        """按资源目录校验OpenStack配置中的资源名，存在未知资源时抛出PreflightError"""
+        errors: List[Dict[str, Any]] = []
+        checked: List[str] = []
+        with timed('preflight'):
+            for kind, (_, _, field) in RESOURCE_KINDS.items():
+                value = openstack_config.get(field)
+                if value is None:
+                    continue
+                if field == 'security_groups':
+                    for index, group in enumerate(value):
+                        self._check(kind, f'{field}[{index}]', str(group), errors, checked)
+                else:
+                    self._check(kind, field, str(value), errors, checked)
+        if errors:
+            raise PreflightError(errors)
+        return {
+            'checked': checked,
+            'skipped': [kind for kind in RESOURCE_KINDS if kind not in self.resources],
+            'catalog_age': max((resource_set.age for resource_set in self.resources.values()), default=None)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cloud': self.cloud,
+            'enabled': self.running,
+            'interval': self.interval,
+            'recheck_after': self.recheck_after,
+            'role': None if self._leader is None else ('leader' if self._leader.held else 'follower'),
+            'resources': {
+                kind: {
+                    'count': len(self.resources[kind].display) if kind in self.resources else None,
+                    'age': self.resources[kind].age if kind in self.resources else None,
+                    'last_error': self.errors.get(kind)
+                } for kind in RESOURCE_KINDS
+            }
+        }
+
+    def names(self, kind: str) -> Optional[List[str]]:
+        resource_set = self.resources.get(kind)
+        return resource_set.display if resource_set else None
+
+
+CATALOG_INTERVAL = float(os.getenv('RESOURCE_CATALOG_INTERVAL', '300'))
+resource_catalog = ResourceCatalog(CATALOG_INTERVAL, float(os.getenv('RESOURCE_CATALOG_RECHECK', '30')),
+                                   os.getenv('JOB_STATE_DIR') or None,
+                                   recheck_timeout=float(os.getenv('RESOURCE_CATALOG_RECHECK_TIMEOUT', '5')))
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=resource_catalog._after_fork)
+registry.register_cache('resource_catalog', lambda: {'hits': resource_catalog.hits,
+                                                     'misses': resource_catalog.misses,
+                                                     'rechecks': resource_catalog.rechecks})
+
+
+_cloud_catalogs: Dict[str, ResourceCatalog] = {}
+_cloud_catalogs_lock = threading.Lock()
+
+
+def _after_fork():
+    global _cloud_catalogs_lock
+    _cloud_catalogs_lock = threading.Lock()
+    for catalog in _cloud_catalogs.values():
+        catalog._after_fork()
+    _cloud_catalogs.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def start_resource_catalog():
+    """RESOURCE_CATALOG_INTERVAL 大于0时启动后台刷新"""
+    if CATALOG_INTERVAL > 0:
+        resource_catalog.start()
+
+
+def catalog_for(cloud: Optional[str]) -> ResourceCatalog:
+    """默认云使用 resource_catalog；每个具名云有自己的目录，第一次使用时创建并在后台开始刷新"""
+    if cloud is None:
+        return resource_catalog
+    catalog = _cloud_catalogs.get(cloud)
+    if catalog is None:
+        with _cloud_catalogs_lock:
+            catalog = _cloud_catalogs.get(cloud)
+            if catalog is None:
+                catalog = ResourceCatalog(resource_catalog.interval, resource_catalog.recheck_after,
+                                          resource_catalog.state_dir, cloud=cloud,
+                                          recheck_timeout=resource_catalog.recheck_timeout)
+                if resource_catalog.running:
+                    catalog.start()
+                _cloud_catalogs[cloud] = catalog
+    return catalog
+
+
+def cloud_catalog_stats() -> Dict[str, Any]:
+    return {cloud: catalog.stats() for cloud, catalog in list(_cloud_catalogs.items())}
+
+
+def preflight(openstack_config: Dict[str, Any]) -> Dict[str, Any]:
+    """资源目录已启用时按请求所用云的目录校验资源名；未启用时不做任何检查
+
+    具名云的目录在第一次请求时才开始获取，获取完成前该云的请求不做检查；未知的云由后端调用报错。
+    """
+    cloud = openstack_config.get('cloud')
+    if not resource_catalog.running or (cloud is not None and cloud not in cloud_names()):
+        return {'checked': [], 'skipped': list(RESOURCE_KINDS), 'catalog_age': None}
+    return catalog_for(cloud).validate(openstack_config)
@@ -0,0 +1,313 @@
+import os
+import gc
+import sys
+import time
+import errno
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Optional
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+SERVE_HOST = os.getenv('SERVE_HOST', '0.0.0.0')
+SERVE_PORT = int(os.getenv('SERVE_PORT', '5000'))
+SERVE_WORKERS = int(os.getenv('SERVE_WORKERS', str(os.cpu_count() or 1)))
+SERVE_THREADS = int(os.getenv('SERVE_THREADS', '16'))
+SERVE_GRACEFUL_TIMEOUT = float(os.getenv('SERVE_GRACEFUL_TIMEOUT', '30'))
+SERVE_KEEPALIVE_TIMEOUT = float(os.getenv('SERVE_KEEPALIVE_TIMEOUT', '5'))
+CONFIG_WATCH_INTERVAL = float(os.getenv('CONFIG_WATCH_INTERVAL', '2'))
+
+# worker 停止时在 master 强制结束前预留的时间（秒）
+SHUTDOWN_MARGIN = 1.0
+
+# worker 启动后这么快就退出视为启动失败，重启前等待一下避免空转
+MIN_WORKER_LIFETIME = 5.0
+
+
+def preload() -> Dict[str, Any]:
+    """在master中加载配置、预编译模板并预热镜像解析，fork后worker通过写时复制共享"""
+    from config_manager import get_config_snapshot, resolve_image_os
+    from cloud_config_generator import get_compiled_templates
+    try:
+        snapshot = get_config_snapshot()
+    except FileNotFoundError:
+        logger.warning("部署配置文件不存在，跳过预加载")
+        return {'version': None}
+    templates = get_compiled_templates()
+    for image_name in snapshot.image_mapping:
+        resolve_image_os(image_name, snapshot)
+    return {'version': snapshot.version, 'fragments': len(templates.fragments)}
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # 空闲keep-alive连接占用线程池中的线程，超时后关闭
+    timeout = SERVE_KEEPALIVE_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """固定大小线程池处理请求的WSGI服务，可使用继承来的监听socket"""
+
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, threads: int, fd: Optional[int] = None,
+                 drain_timeout: float = SERVE_GRACEFUL_TIMEOUT):
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        self.drain_timeout = drain_timeout
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self._active = 0
+        self._idle = threading.Condition()
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self._active += 1
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._idle:
+                self._active -= 1
+                self._idle.notify_all()
+
+    def server_close(self):
+        super().server_close()
+        # 使用继承的socket时父类的__init__也会调用这里，此时线程池还未创建
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            # 等待处理中的请求完成；SSE等长连接不会自己结束，超时后不再等待
+            with self._idle:
+                if not self._idle.wait_for(lambda: self._active == 0, timeout=self.drain_timeout):
+                    logger.warning(f"worker {os.getpid()} 仍有 {self._active} 个请求未在 "
+                                   f"{self.drain_timeout:.1f}s 内结束")
+
+
+def drain_background_work(timeout: float):
+    """进程退出前等待异步部署任务结束（超时的任务标记为中断），并写完部署历史"""
+    from job_manager import job_manager
+    from deployment_history import history
+    deadline = time.monotonic() + timeout
+    job_manager.shutdown(deadline - time.monotonic())
+    if history is not None:
+        history.close(max(0.0, deadline - time.monotonic()))
+
+
+def run_worker(app_factory: Callable[[], Any], listener: socket.socket, host: str, port: int, threads: int,
+               graceful_timeout: float = SERVE_GRACEFUL_TIMEOUT):
+    """worker进程：在继承的socket上处理请求，收到SIGTERM后停止接受新连接和新任务，
+    在 graceful_timeout 内等待处理中的请求与异步部署任务"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    app = app_factory()
+    # master 在 graceful_timeout 后强制结束worker，留出写入任务状态的时间
+    budget = max(0.0, graceful_timeout - SHUTDOWN_MARGIN)
+    server = PooledWSGIServer(host, port, app, threads, fd=listener.fileno(), drain_timeout=budget / 2)
+    stopping = {}
+
+    def shutdown(signum, frame):
+        from job_manager import job_manager
+        stopping.setdefault('at', time.monotonic())
+        job_manager.close()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    logger.info(f"worker {os.getpid()} 已启动，线程数 {threads}")
+    # serve_forever 退出时会调用 server_close
+    server.serve_forever()
+    elapsed = time.monotonic() - stopping.get('at', time.monotonic())
+    drain_background_work(budget - elapsed)
+    logger.info(f"worker {os.getpid()} 已退出")
+
+
+class Master:
+    """预加载共享状态后fork出多个worker，负责重启异常退出的worker与平滑重载"""
+
+    def __init__(self, app_factory: Callable[[], Any], host: str = SERVE_HOST, port: int = SERVE_PORT,
+                 workers: int = SERVE_WORKERS, threads: int = SERVE_THREADS,
+                 graceful_timeout: float = SERVE_GRACEFUL_TIMEOUT, watch_interval: float = CONFIG_WATCH_INTERVAL):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.threads = max(1, threads)
+        self.graceful_timeout = graceful_timeout
+        self.watch_interval = watch_interval
+        self.listener: Optional[socket.socket] = None
+        self.children: Dict[int, Dict[str, Any]] = {}
+        self.retiring: Dict[int, float] = {}
+        self.generation = 0
+        self.version: Optional[str] = None
+        self._reload_requested = False
+        self._stopping = False
+
+    def _bind(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.listener = socket.create_server((self.host, self.port), family=family, backlog=2048)
+        self.listener.set_inheritable(True)
+        self.port = self.listener.getsockname()[1]
+
+    def _preload(self):
+        started = time.perf_counter()
+        info = preload()
+        self.version = info['version']
+        # 把预加载的对象移出GC跟踪，减少worker中因GC写入引用计数导致的页复制
+        gc.freeze()
+        logger.info(f"预加载完成，配置版本 {self.version}，耗时 {time.perf_counter() - started:.3f}s")
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app_factory, self.listener, self.host, self.port, self.threads,
+                           self.graceful_timeout)
+            except Exception:
+                logger.exception("worker异常退出")
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = {'generation': self.generation, 'started_at': time.monotonic()}
+
+    def _retire(self, pids):
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            self.children.pop(pid, None)
+            self.retiring[pid] = deadline
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.retiring:
+                del self.retiring[pid]
+                continue
+            child = self.children.pop(pid, None)
+            if child is None or self._stopping:
+                continue
+            logger.warning(f"worker {pid} 意外退出（状态 {status}），重新启动")
+            if time.monotonic() - child['started_at'] < MIN_WORKER_LIFETIME:
+                time.sleep(1.0)
+            self._spawn()
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                logger.warning(f"worker {pid} 未在 {self.graceful_timeout}s 内退出，强制结束")
+                self._signal(pid, signal.SIGKILL)
+                self.retiring[pid] = float('inf')
+
+    def reload(self):
+        """重新加载配置并滚动替换worker：新worker启动后旧worker再平滑退出"""
+        self._preload()
+        old = list(self.children)
+        self.generation += 1
+        for _ in range(self.workers):
+            self._spawn()
+        self._retire(old)
+        logger.info(f"已滚动重启 {len(old)} 个worker，代次 {self.generation}")
+
+    def _config_changed(self) -> bool:
+        from config_manager import get_config_version
+        return get_config_version() != self.version
+
+    def run(self):
+        self._bind()
+        state_dir = os.getenv('JOB_STATE_DIR')
+        temporary = not state_dir
+        if temporary:
+            state_dir = tempfile.mkdtemp(prefix='deployer-jobs-')
+            logger.warning(f"未设置 JOB_STATE_DIR，使用临时目录 {state_dir} 保存任务、幂等和就绪记录，"
+                           f"服务停止时会被删除；生产环境请设置为持久目录")
+        else:
+            os.makedirs(state_dir, exist_ok=True)
+        from job_manager import job_manager
+        from idempotency import idempotency_store
+        from readiness import readiness_store
+        from instance_poller import instance_poller
+        from resource_catalog import resource_catalog
+        job_manager.state_dir = state_dir
+        idempotency_store.state_dir = state_dir
+        readiness_store.state_dir = state_dir
+        # 各worker都启动后台线程，但只有持有锁的一个查询OpenStack，其他worker读取共享快照
+        instance_poller.state_dir = state_dir
+        resource_catalog.state_dir = state_dir
+        self._preload()
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, '_reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, '_stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, '_stopping', True))
+
+        for _ in range(self.workers):
+            self._spawn()
+        logger.info(f"服务已启动: http://{self.host}:{self.port}，{self.workers}个worker，每个{self.threads}个线程")
+
+        last_check = time.monotonic()
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                self._reap()
+                self._kill_overdue()
+                if self.watch_interval > 0 and time.monotonic() - last_check >= self.watch_interval:
+                    last_check = time.monotonic()
+                    if self._config_changed():
+                        logger.info("检测到部署配置变化，开始重载")
+                        self._reload_requested = True
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload()
+        finally:
+            self.stop()
+            if temporary:
+                shutil.rmtree(state_dir, ignore_errors=True)
+
+    def stop(self):
+        self._stopping = True
+        self._retire(list(self.children))
+        while self.retiring:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+        if self.listener is not None:
+            self.listener.close()
+        logger.info("服务已停止")
+
+
+def serve(app_factory: Callable[[], Any], host: str = SERVE_HOST, port: int = SERVE_PORT,
+          workers: int = SERVE_WORKERS, threads: int = SERVE_THREADS,
+          graceful_timeout: float = SERVE_GRACEFUL_TIMEOUT, watch_interval: float = CONFIG_WATCH_INTERVAL):
+    """生产模式运行服务，不支持fork的平台上退化为单进程"""
+    if not hasattr(os, 'fork'):
+        logger.warning("当前平台不支持fork，以单进程模式运行")
+        preload()
+        PooledWSGIServer(host, port, app_factory(), threads).serve_forever()
+        return
+    try:
+        Master(app_factory, host, port, workers, threads, graceful_timeout, watch_interval).run()
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE:
+            logger.error(f"端口 {port} 已被占用")
+            sys.exit(1)
+        raise
@@ -0,0 +1,114 @@
+import os
+import json
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # 非POSIX平台（serve 以单进程运行）
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 跟随者检查共享快照文件是否更新的间隔（秒）
+SHARED_POLL_INTERVAL = 0.5
+
+
+class LeaderLock:
+    """多个worker进程中选出一个执行后台轮询：持有共享目录下锁文件的独占flock的进程为leader
+
+    leader退出（包括被强制结束）时锁由内核释放，其他worker下次尝试时接替。
+    """
+
+    def __init__(self, state_dir: str, name: str):
+        self.path = os.path.join(state_dir, f'{name}.lock')
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self) -> bool:
+        """尝试成为leader（不阻塞），已是leader时返回True"""
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        logger.info(f"进程 {os.getpid()} 成为 {os.path.basename(self.path)} 的leader")
+        return True
+
+    def _after_fork(self):
+        # fork出的子进程（如批量渲染进程池）不继承leader身份，关闭自己的副本不会释放父进程的锁
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+
+def write_json(path: str, data: Dict[str, Any]):
+    """原子替换写入，读取方不会看到写了一半的文件"""
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+class SharedFile:
+    """leader写入、其他worker读取的共享快照文件，只在文件变化后重新读取"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._signature: Optional[Tuple[int, int, int]] = None
+
+    def load_if_changed(self) -> Optional[Dict[str, Any]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        if signature == self._signature:
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取共享快照失败: {self.path}: {str(e)}")
+            return None
+        self._signature = signature
+        return data
+
+    def write(self, data: Dict[str, Any]):
+        write_json(self.path, data)
+        # leader自己写入的内容不需要再读回
+        try:
+            stat = os.stat(self.path)
+            self._signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        except OSError:
+            pass
+
+
+def touch(path: str):
+    """更新请求文件的修改时间，通知leader提前执行一次"""
+    try:
+        with open(path, 'a'):
+            pass
+        os.utime(path)
+    except OSError as e:
+        logger.warning(f"写入共享请求文件失败: {path}: {str(e)}")
+
+
+def mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
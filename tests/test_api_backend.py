@@ -0,0 +1,174 @@
+"""APIBackend 对接本地模拟的 Keystone/Nova/Glance/Neutron（loadtest/fake_cloud.py）"""
+import os
+import sys
+import json
+import socket
+import threading
+
+import pytest
+
+from openstack_backend import APIBackend, BackendError, CLIBackend, ConnectionPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'loadtest'))
+import fake_cloud  # noqa: E402
+
+PARAMS = {'instance_name': 'vm-test', 'image': 'Ubuntu 22.04', 'flavor': 'p1', 'network': 'pku', 'key_name': 'load'}
+
+
+@pytest.fixture
+def cloud():
+    cloud = fake_cloud.FakeCloud(fleet_size=3)
+    server = fake_cloud.start(cloud)
+    yield cloud, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(cloud):
+    backend = APIBackend(cloud[1], username='u', password='p', project_name='x',
+                         pool=ConnectionPool(maxsize=4, timeout=5))
+    yield backend
+    backend.pool.close()
+
+
+def test_token_is_reused(cloud, backend):
+    fake, _ = cloud
+    backend.list_servers()
+    backend.list_servers(long=True)
+    backend.show_server('fleet-0')
+    assert fake.counters['auth'] == 1
+    assert backend.token_misses == 1
+    assert backend.token_hits > 0
+    # keep-alive连接被复用
+    assert backend.pool.reused > 0
+
+
+def test_reauthenticates_on_401(cloud, backend):
+    fake, _ = cloud
+    backend.list_servers()
+    fake.revoke_tokens()
+    assert len(backend.list_servers()) == 3
+    assert fake.counters['auth'] == 2
+
+
+def test_create_show_list(cloud, backend):
+    fake, _ = cloud
+    created = json.loads(backend.create_server(PARAMS, '#cloud-config\n'))
+    assert created['id'] in fake.servers
+
+    by_name = backend.show_server('vm-test')
+    assert by_name['id'] == created['id']
+    assert by_name['name'] == 'vm-test'
+    assert by_name['addresses']['pku']
+    assert backend.show_server(created['id'])['name'] == 'vm-test'
+
+    rows = {row['Name']: row for row in backend.list_servers(long=True)}
+    assert set(rows) == {'fleet-0', 'fleet-1', 'fleet-2', 'vm-test'}
+    assert rows['vm-test']['Image Name'] == 'Ubuntu 22.04'
+    assert rows['vm-test']['Flavor Name'] == 'p1'
+    assert rows['vm-test']['Power State'] in ('NOSTATE', 'Running')
+
+    # 镜像/规格/网络的名称解析结果被缓存
+    misses = backend.lookup_misses
+    backend.create_server(dict(PARAMS, instance_name='vm-test-2'), b'#cloud-config\n')
+    assert backend.lookup_misses == misses
+
+
+def test_show_missing_server(backend):
+    with pytest.raises(BackendError) as excinfo:
+        backend.show_server('missing')
+    assert excinfo.value.status == 404
+
+
+def test_pool_timeout_raises_backend_error():
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+    # 接受连接但从不响应
+    thread = threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True)
+    thread.start()
+    pool = ConnectionPool(timeout=0.2)
+    try:
+        with pytest.raises(BackendError):
+            pool.request('GET', f'http://127.0.0.1:{listener.getsockname()[1]}/')
+        assert not any(pool._idle.values())
+    finally:
+        listener.close()
+        for conn, _ in accepted:
+            conn.close()
+
+
+def test_pool_connection_refused_raises_backend_error():
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    with pytest.raises(BackendError):
+        ConnectionPool(timeout=1).request('GET', f'http://127.0.0.1:{port}/')
+
+
+def test_cli_create_image_goes_through_run(monkeypatch):
+    calls = []
+
+    def run(self, cmd, timeout=None):
+        calls.append((cmd[1:4], timeout))
+        return json.dumps({'id': 'image-1', 'name': 'baked', 'status': 'active'})
+
+    monkeypatch.setattr(CLIBackend, '_run', run)
+    image = CLIBackend().create_image('vm-test', 'baked', {'deployer_capabilities': 'docker'}, timeout=60)
+    assert image == {'id': 'image-1', 'name': 'baked', 'status': 'active'}
+    assert calls == [(['server', 'image', 'create'], 60), (['image', 'set', '--property'], None)]
+
+
+def _drop_after_first_response():
+    """第一个请求正常响应（keep-alive），同一连接上的后续请求读完后直接断开；返回监听socket和收到的请求行"""
+    listener = socket.create_server(('127.0.0.1', 0))
+    seen = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                stream = conn.makefile('rb')
+                for index in range(2):
+                    line = stream.readline()
+                    if not line:
+                        break
+                    seen.append(line.split()[0].decode())
+                    length = 0
+                    while True:
+                        header = stream.readline()
+                        if header in (b'\r\n', b''):
+                            break
+                        if header.lower().startswith(b'content-length:'):
+                            length = int(header.split(b':')[1])
+                    stream.read(length)
+                    if index == 0:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+                stream.close()
+                conn.shutdown(socket.SHUT_RDWR)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener, seen
+
+
+@pytest.mark.parametrize('method,attempts', [('GET', 2), ('POST', 1)])
+def test_reused_connection_retry_only_for_idempotent_methods(method, attempts):
+    listener, seen = _drop_after_first_response()
+    url = f'http://127.0.0.1:{listener.getsockname()[1]}/servers'
+    pool = ConnectionPool(timeout=2)
+    try:
+        pool.request('GET', url)
+        if method == 'GET':
+            # 服务端在请求送达后断开，GET换新连接重试
+            assert pool.request(method, url)[0] == 200
+        else:
+            # POST可能已被处理，不重试
+            with pytest.raises(BackendError):
+                pool.request(method, url, body=b'{}')
+        assert seen[1:] == [method] * attempts
+    finally:
+        pool.close()
+        listener.close()
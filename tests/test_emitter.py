@@ -0,0 +1,110 @@
+"""直接拼接的YAML输出与原先 yaml.dump 整个配置字典的结果逐字节一致"""
+import json
+import itertools
+
+import pytest
+import yaml
+
+from cloud_config_generator import generate_cloud_config
+
+with open('deployment-configs.json', encoding='utf-8') as f:
+    CONFIGS = json.load(f)
+
+SERVICES = list(CONFIGS['deployments'])
+IMAGES = list(CONFIGS['image_mapping']) + ['unknown-image', 'Ubuntu 24.04', 'debian-12']
+# 原实现按字典顺序做子串匹配，debian-12 不匹配任何条目而退回ubuntu；现在按 debian 解析
+RESOLVER_CHANGES = {'debian-12': 'debian'}
+LEGACY_OPTIONS = {'optimize': False, 'package_upgrade': True}
+
+
+def legacy_os_type(image_name):
+    for pattern, os_type in CONFIGS['image_mapping'].items():
+        if pattern.lower() in image_name.lower():
+            return os_type
+    return 'ubuntu'
+
+
+def legacy_lobechat_files(service_config):
+    compose = {
+        'version': service_config['docker_compose']['version'],
+        'services': json.loads(json.dumps(service_config['docker_compose']['services']))
+    }
+    for service in compose['services'].values():
+        for key, value in service.get('environment', {}).items():
+            if value.startswith('${') and value.endswith('}') and value[2:-1] in service_config['environment']:
+                service['environment'][key] = service_config['environment'][value[2:-1]]
+    commands = ["cat > /opt/lobechat/docker-compose.yml << 'EOF'",
+                yaml.dump(compose, default_flow_style=False, allow_unicode=True, indent=2).strip(),
+                'EOF']
+    script = service_config.get('auto_update_script', '')
+    if script:
+        commands += ["cat > /opt/lobechat/auto-update-lobe-chat.sh << 'EOF'", script, 'EOF',
+                     'chmod +x /opt/lobechat/auto-update-lobe-chat.sh',
+                     "(crontab -l 2>/dev/null; echo '0 2 * * * /opt/lobechat/auto-update-lobe-chat.sh >> "
+                     "/var/log/lobe-chat-update.log 2>&1') | crontab -"]
+    return commands
+
+
+def legacy_render(services, os_type, package_upgrade=True):
+    """原先 generate_cloud_config 的实现：组装完整的字典后整体 yaml.dump"""
+    docker = CONFIGS['docker_install_configs'][os_type]
+    packages, commands = set(), []
+    for service in services:
+        service_config = dict(CONFIGS['deployments'][service])
+        if service == 'docker':
+            service_config['packages'] = docker['packages']
+            service_config['commands'] = docker['commands']
+        packages.update(service_config.get('packages', []))
+        commands.append(f'# {service} 配置')
+        commands.extend(service_config.get('commands', []))
+        if service == 'lobechat':
+            if 'docker' not in services:
+                packages.update(docker['packages'])
+                commands.append('# Docker 自动配置')
+                commands.extend(docker['commands'])
+            commands.extend(legacy_lobechat_files(service_config))
+            commands.append('cd /opt/lobechat && docker-compose up -d')
+        if service_config.get('test_container', False) and 'test_commands' in service_config:
+            commands.extend(service_config['test_commands'])
+    return '#cloud-config\n\n' + yaml.dump({
+        'package_update': True,
+        'package_upgrade': package_upgrade,
+        'packages': sorted(packages),
+        'runcmd': commands,
+        'final_message': '应用部署完成'
+    }, default_flow_style=False, allow_unicode=True, indent=2)
+
+
+def render(services, image, options=LEGACY_OPTIONS):
+    config = {
+        'openstack': {'image': image},
+        'deployments': {service: dict(CONFIGS['deployments'][service]) for service in services}
+    }
+    if options is not None:
+        config['user_data_options'] = dict(options)
+    return generate_cloud_config(config)
+
+
+SUBSETS = [combo for size in range(len(SERVICES) + 1) for combo in itertools.permutations(SERVICES, size)]
+
+
+@pytest.mark.parametrize('image', IMAGES)
+@pytest.mark.parametrize('services', SUBSETS, ids=lambda combo: '+'.join(combo) or 'none')
+def test_matches_legacy_yaml_dump(services, image):
+    os_type = RESOLVER_CHANGES.get(image, legacy_os_type(image))
+    assert render(services, image) == legacy_render(services, os_type)
+
+
+@pytest.mark.parametrize('services', SUBSETS, ids=lambda combo: '+'.join(combo) or 'none')
+def test_default_options_match_legacy(services):
+    # 未指定 user_data_options 时（USER_DATA_OPTIMIZE、PACKAGE_UPGRADE 未设置）不优化、不升级全部软件包
+    image = 'Ubuntu 22.04'
+    assert render(services, image, options=None) == legacy_render(services, legacy_os_type(image),
+                                                                  package_upgrade=False)
+
+
+@pytest.mark.parametrize('image', sorted(RESOLVER_CHANGES))
+def test_resolver_change_is_the_only_difference(image):
+    services = ('docker',)
+    assert legacy_os_type(image) != RESOLVER_CHANGES[image]
+    assert render(services, image) != legacy_render(services, legacy_os_type(image))
@@ -0,0 +1,89 @@
+"""IdempotencyStore 的合并、失败后重新执行和等待超时（同一进程内，以及通过共享目录协调的两个worker）"""
+import threading
+import time
+
+import pytest
+
+from idempotency import IdempotencyStore, IdempotencyConflictError, EXECUTED, COALESCED, REPLAYED
+
+
+@pytest.fixture(params=['memory', 'shared', 'workers'])
+def stores(request, tmp_path):
+    """按请求序号返回处理该请求的store；workers 模拟两个worker进程，各有自己的store"""
+    state_dir = None if request.param == 'memory' else str(tmp_path)
+    workers = [IdempotencyStore(state_dir=state_dir, wait_timeout=5) for _ in range(2)]
+    if request.param != 'workers':
+        workers = workers[:1]
+    return [workers[index % len(workers)] for index in range(3)]
+
+
+def run_concurrently(stores, funcs, key='k', fingerprint='f'):
+    """依次启动请求（第一个先开始执行），返回各请求的 (结果, outcome) 或异常"""
+    results = [None] * len(funcs)
+
+    def call(index):
+        try:
+            results[index] = stores[index].run(key, fingerprint, funcs[index], 60,
+                                               lambda result: result['success'])
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def slow(result, seconds=0.3):
+    def func():
+        time.sleep(seconds)
+        return result
+    return func
+
+
+def test_concurrent_duplicates_share_success(stores):
+    calls = []
+
+    def deploy():
+        calls.append(1)
+        time.sleep(0.3)
+        return {'success': True}
+
+    results = run_concurrently(stores, [deploy, deploy, deploy])
+    assert len(calls) == 1
+    assert sorted(outcome for _, outcome in results) == [COALESCED, COALESCED, EXECUTED]
+    assert stores[1].run('k', 'f', deploy, 60, lambda result: True)[1] == REPLAYED
+
+
+def test_waiter_reexecutes_after_failure(stores):
+    results = run_concurrently(stores, [slow({'success': False, 'attempt': 1}), slow({'success': True, 'attempt': 2})])
+    assert results[0] == ({'success': False, 'attempt': 1}, EXECUTED)
+    assert results[1] == ({'success': True, 'attempt': 2}, EXECUTED)
+
+
+def test_waiter_reexecutes_after_exception(stores):
+    def broken():
+        time.sleep(0.3)
+        raise RuntimeError('boom')
+
+    results = run_concurrently(stores, [broken, slow({'success': True})])
+    assert isinstance(results[0], RuntimeError)
+    assert results[1] == ({'success': True}, EXECUTED)
+
+
+def test_wait_is_bounded(stores):
+    for store in stores:
+        store.wait_timeout = 0.3
+    results = run_concurrently(stores, [slow({'success': True}, 1.0), slow({'success': True})])
+    assert results[0] == ({'success': True}, EXECUTED)
+    assert isinstance(results[1], IdempotencyConflictError) and results[1].status_code == 409
+
+
+def test_different_content_for_same_key(stores):
+    stores[0].run('k', 'f', lambda: {'success': True}, 60, lambda result: True)
+    with pytest.raises(IdempotencyConflictError) as error:
+        stores[1].run('k', 'other', lambda: {'success': True}, 60, lambda result: True)
+    assert error.value.status_code == 422
@@ -0,0 +1,62 @@
+"""ResourceCatalog 的预检：目录过期时先重新获取再判定，拼写错误仍被拒绝"""
+import time
+
+import pytest
+
+import resource_catalog
+from resource_catalog import ResourceCatalog, PreflightError
+
+
+class FakeBackend:
+    def __init__(self, flavors, delay=0.0):
+        self.flavors = list(flavors)
+        self.delay = delay
+        self.calls = 0
+
+    def list_flavors(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return [{'ID': f'id-{name}', 'Name': name} for name in self.flavors]
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FakeBackend(['p1', 'p2', 'p4'])
+    monkeypatch.setattr(resource_catalog, 'get_backend', lambda cloud=None: backend)
+    return backend
+
+
+def stale_catalog(backend, recheck_timeout=5.0):
+    catalog = ResourceCatalog(recheck_after=0.0, recheck_timeout=recheck_timeout)
+    catalog.refresh(['flavor'])
+    backend.calls = 0
+    return catalog
+
+
+def test_typo_rejected_when_catalog_is_stale(backend):
+    catalog = stale_catalog(backend)
+    with pytest.raises(PreflightError) as error:
+        catalog.validate({'flavor': 'p3'})
+    assert error.value.errors[0]['suggestions'][0] in ('p1', 'p2', 'p4')
+    # 判定前重新获取了一次
+    assert backend.calls == 1
+
+
+def test_new_resource_accepted_after_recheck(backend):
+    catalog = stale_catalog(backend)
+    backend.flavors.append('p8')
+    assert catalog.validate({'flavor': 'p8'})['checked'] == ['flavor']
+
+
+def test_recheck_is_bounded(backend):
+    catalog = stale_catalog(backend, recheck_timeout=0.2)
+    backend.delay = 1.0
+    backend.flavors.append('p8')
+    started = time.monotonic()
+    with pytest.raises(PreflightError):
+        catalog.validate({'flavor': 'p8'})
+    assert time.monotonic() - started < 0.8
+    # 刷新在后台完成后按新目录判定
+    time.sleep(1.0)
+    catalog.recheck_after = 60.0
+    assert catalog.validate({'flavor': 'p8'})['checked'] == ['flavor']